@@ -0,0 +1,213 @@
+"""
+Compare the threaded flask worker against the asgi worker for thread replies.
+
+Slack and gemini are replaced with local stand-ins that sleep to mimic
+network latency, then a burst of concurrent pubsub pushes is sent to each
+worker, with its default admission control. The threaded worker is driven
+through flask's test client on as many threads as gunicorn would run, the
+asgi app is called directly on one loop.
+
+    python bench_async.py --requests 400 --threads 8 --slack-ms 80 --model-ms 800
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+# no gcp or slack access needed
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-bench")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "bench")
+os.environ.setdefault("SLACK_TOKEN_VERIFICATION", "false")
+os.environ.setdefault("WARM_CLIENTS", "false")
+os.environ.setdefault("PROJECT_ID", "bench")
+import main  # noqa: E402
+import asgi  # noqa: E402
+
+
+class Latency:
+    slack = 0.0
+    model = 0.0
+    chunks = 4
+
+
+def thread_messages(channel, thread_ts):
+    return [
+        {"ts": thread_ts, "user": "U1", "text": "hey bot, what changed in the deploy?"},
+        {"ts": f"{float(thread_ts) + 1:.6f}", "bot_id": "B1", "text": "the config."},
+        {"ts": f"{float(thread_ts) + 2:.6f}", "user": "U1", "text": "which part?"},
+    ]
+
+
+class FakeResult(dict):
+    # enough of SlackResponse for the handlers
+    @property
+    def data(self):
+        return self
+
+
+class FakeSlack:
+    def _call(self, **kwargs):
+        time.sleep(Latency.slack)
+        return FakeResult(ok=True, ts="1.0", messages=[], user_id="UBOT")
+
+    chat_postMessage = chat_update = chat_postEphemeral = _call
+    conversations_history = auth_test = _call
+
+    def conversations_replies(self, channel, ts, **kwargs):
+        time.sleep(Latency.slack)
+        return FakeResult(
+            ok=True, messages=thread_messages(channel, ts), has_more=False
+        )
+
+
+class FakeAsyncSlack:
+    async def _call(self, **kwargs):
+        await asyncio.sleep(Latency.slack)
+        return FakeResult(ok=True, ts="1.0", messages=[], user_id="UBOT")
+
+    chat_postMessage = chat_update = chat_postEphemeral = _call
+    conversations_history = auth_test = _call
+
+    async def conversations_replies(self, channel, ts, **kwargs):
+        await asyncio.sleep(Latency.slack)
+        return FakeResult(
+            ok=True, messages=thread_messages(channel, ts), has_more=False
+        )
+
+
+class FakeResponse:
+    text = "it was the timeout setting. "
+
+
+class FakeModel:
+    def generate_content(self, contents, generation_config=None, stream=False):
+        if not stream:
+            time.sleep(Latency.model)
+            return FakeResponse()
+        return self._stream()
+
+    def _stream(self):
+        for _ in range(Latency.chunks):
+            time.sleep(Latency.model / Latency.chunks)
+            yield FakeResponse()
+
+    async def generate_content_async(
+        self, contents, generation_config=None, stream=False
+    ):
+        if not stream:
+            await asyncio.sleep(Latency.model)
+            return FakeResponse()
+        return self._stream_async()
+
+    async def _stream_async(self):
+        for _ in range(Latency.chunks):
+            await asyncio.sleep(Latency.model / Latency.chunks)
+            yield FakeResponse()
+
+
+def envelope(i, mode):
+    thread_ts = f"{1700000000 + i}.{'1' if mode == 'threaded' else '2'}00000"
+    # a different person and channel each, so no one is rate limited
+    main.remember_bot_thread(f"C{i}", thread_ts)
+    message = {
+        "entrypoint": "thread_reply",
+        "channel": f"C{i}",
+        "user": f"U{i}",
+        "thread_ts": thread_ts,
+        "ts": f"{float(thread_ts) + 2:.6f}",
+    }
+    data = base64.b64encode(json.dumps(message).encode("utf-8")).decode("utf-8")
+    return json.dumps({"message": {"data": data}, "subscription": "bench"}).encode()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(label, elapsed, latencies, shed):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{label:<10} total {elapsed:7.3f}s  {len(latencies) / elapsed:7.1f} req/s  "
+        f"p50 {percentile(latencies, 50) * 1000:8.1f}ms  "
+        f"p95 {percentile(latencies, 95) * 1000:8.1f}ms  "
+        f"p99 {percentile(latencies, 99) * 1000:8.1f}ms  "
+        f"peak rss {rss:6.1f}MB  shed {shed}"
+    )
+
+
+def run_threaded(request_count, threads):
+    client = main.flask_app.test_client()
+    bodies = [envelope(i, "threaded") for i in range(request_count)]
+    latencies = []
+
+    def timed(body):
+        # from the start of the burst, so time queued for a thread counts
+        client.post("/", data=body, content_type="application/json")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, bodies))
+    report("threaded", time.perf_counter() - start, latencies, main.admission.shed)
+
+
+async def push(body):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(event):
+        sent.append(event)
+
+    scope = {"type": "http", "method": "POST", "path": "/"}
+    start = time.perf_counter()
+    await asgi.app(scope, receive, send)
+    return time.perf_counter() - start
+
+
+async def run_async(request_count):
+    bodies = [envelope(i, "asgi") for i in range(request_count)]
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(push(body) for body in bodies))
+    report("asgi", time.perf_counter() - start, latencies, asgi.admission.shed)
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--slack-ms", type=float, default=80)
+    parser.add_argument("--model-ms", type=float, default=800)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    Latency.slack = args.slack_ms / 1000
+    Latency.model = args.model_ms / 1000
+    # main imports vertexai on first use, keep that out of both measurements
+    import vertexai.generative_models  # noqa: F401
+
+    fake_model = FakeModel()
+    main.get_generation_model = lambda *args, **kwargs: fake_model
+    main.slack_client = FakeSlack()
+    asgi.async_slack_client = FakeAsyncSlack()
+
+    print(
+        f"{args.requests} thread replies, slack {args.slack_ms}ms, "
+        f"gemini {args.model_ms}ms, streaming {main.STREAM_REPLIES}"
+    )
+    run_threaded(args.requests, args.threads)
+    asyncio.run(run_async(args.requests))
+
+
+if __name__ == "__main__":
+    run_benchmark()
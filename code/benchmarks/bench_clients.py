@@ -0,0 +1,80 @@
+"""
+Compare building clients per request against the shared ClientRegistry.
+
+Uses local stand-ins whose constructors sleep to mimic the grpc channel
+and auth handshake cost of PublisherClient / vertexai.init + GenerativeModel.
+
+    python bench_clients.py --requests 400 --threads 8 --setup-ms 40
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+from utils import ClientRegistry  # noqa: E402
+
+
+class StandInClient:
+    setup_seconds = 0.0
+
+    def __init__(self):
+        # channel creation + auth handshake
+        time.sleep(self.setup_seconds)
+
+    def call(self):
+        return "ok"
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(label, handler, request_count, threads):
+    latencies = []
+
+    def timed(_):
+        start = time.perf_counter()
+        handler()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, range(request_count)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<12} total {elapsed:7.3f}s  "
+        f"mean {statistics.mean(latencies) * 1000:7.2f}ms  "
+        f"p95 {percentile(latencies, 95) * 1000:7.2f}ms  "
+        f"p99 {percentile(latencies, 99) * 1000:7.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--setup-ms", type=float, default=40)
+    args = parser.parse_args()
+    StandInClient.setup_seconds = args.setup_ms / 1000
+
+    def per_request():
+        # what send_pubsub_message / handle_slack_message used to do
+        StandInClient().call()
+
+    registry = ClientRegistry()
+
+    def pooled():
+        registry.get("stand-in", StandInClient).call()
+
+    run("per-request", per_request, args.requests, args.threads)
+    run("pooled", pooled, args.requests, args.threads)
+    registry.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Exercise the ContextBuilder over synthetic 10k message channels.
+
+Reports the time spent fitting the transcript, how many (fake) model fold
+calls were made and the size of what would be sent to gemini, both for a
+cold build and for a thread growing one message at a time.
+
+    python bench_context.py --messages 10000 --budget 32000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+from context_builder import ContextBuilder, estimate_tokens  # noqa: E402
+
+
+WORDS = "the deploy failed again after we rolled back the config so please check the dashboard before merging".split()
+
+
+def synthetic_channel(count, seed=7):
+    rng = random.Random(seed)
+    lines = []
+    ids = []
+    ts = 1700000000.0
+    for i in range(count):
+        ts += rng.uniform(1, 120)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 80)))
+        lines.append(f"user{rng.randint(1, 40)}: {text}\n")
+        ids.append(f"{ts:.6f}")
+    return lines, ids
+
+
+class FakeFolder:
+    # stands in for a gemini summary call, returns a fixed size summary
+    def __init__(self, summary_tokens):
+        self.calls = 0
+        self.tokens_in = 0
+        self.summary = "x" * (summary_tokens * 4 // 2)
+
+    def __call__(self, summary, lines):
+        self.calls += 1
+        self.tokens_in += sum(estimate_tokens(line) for line in lines)
+        return self.summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--budget", type=int, default=32000)
+    parser.add_argument("--growth", type=int, default=500)
+    args = parser.parse_args()
+
+    lines, ids = synthetic_channel(args.messages)
+    tokens = [estimate_tokens(line) for line in lines]
+    print(f"{args.messages} messages, ~{sum(tokens)} tokens, budget {args.budget}")
+
+    # cold, everything older than the budget folded at once
+    builder = ContextBuilder(budget_tokens=args.budget)
+    fold = FakeFolder(builder.summary_tokens)
+    start = time.perf_counter()
+    summary, recent = builder.fit("channel", lines, tokens, ids, fold)
+    elapsed = time.perf_counter() - start
+    sent = sum(estimate_tokens(line) for line in recent) + estimate_tokens(summary)
+    print(
+        f"cold      fit {elapsed * 1000:8.2f}ms  folds {fold.calls:4d}  "
+        f"kept {len(recent):5d} lines  sent ~{sent} tokens"
+    )
+
+    # a thread growing one message at a time, rolling summary reused
+    builder = ContextBuilder(budget_tokens=args.budget)
+    fold = FakeFolder(builder.summary_tokens)
+    base = args.messages - args.growth
+    start = time.perf_counter()
+    for end in range(base, args.messages + 1):
+        builder.fit("thread", lines[:end], tokens[:end], ids[:end], fold)
+    elapsed = time.perf_counter() - start
+    print(
+        f"growing   fit {elapsed / (args.growth + 1) * 1000:8.2f}ms/turn  "
+        f"folds {fold.calls:4d} over {args.growth + 1} turns  "
+        f"folded ~{fold.tokens_in} tokens"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+End to end load test of the flask app against fake slack, pubsub and gemini.
+
+Every request goes the whole way: a signed slack event (or /summarize
+command) is posted to /slack/events, the lazy listener publishes it to the
+fake pubsub, which pushes it to / on one of --workers threads, where
+handle_slack_message does the work against the fakes in fakes.py. Each
+request uses its own channel and thread so no cache hides the work.
+
+Latency is from the slack post to the end of the push request, ack is how
+long /slack/events took to answer slack. Each scenario runs in a fresh
+process so peak rss is its own. A scenario is entrypoint:size, size is the
+thread length for thread entrypoints and the channel's message count for
+summarize_channel_request.
+
+    python bench_load.py
+    python bench_load.py --scenario thread_reply:500 --requests 100 --files 2
+    python bench_load.py --save baseline.json
+    python bench_load.py --baseline baseline.json --max-regression 0.2
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+SIGNING_SECRET = "bench"
+ENTRYPOINTS = (
+    "greetings",
+    "thread_reply",
+    "summarize_thread_request",
+    "summarize_channel_request",
+)
+DEFAULT_SCENARIOS = (
+    "greetings",
+    "thread_reply:10",
+    "thread_reply:200",
+    "summarize_thread_request:10",
+    "summarize_thread_request:200",
+    "summarize_channel_request:100",
+    "summarize_channel_request:2000",
+)
+# compared against a saved baseline, higher is worse for all but throughput
+GATED = ("p95_ms", "p99_ms", "throughput", "rss_mb")
+
+
+def parse_scenario(scenario):
+    entrypoint, _, size = scenario.partition(":")
+    if entrypoint not in ENTRYPOINTS:
+        raise argparse.ArgumentTypeError(f"unknown entrypoint {entrypoint}")
+    return entrypoint, int(size or 0)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def signed_headers(body, content_type):
+    timestamp = str(int(time.time()))
+    basestring = f"v0:{timestamp}:{body}".encode("utf-8")
+    signature = hmac.new(
+        SIGNING_SECRET.encode("utf-8"), basestring, hashlib.sha256
+    ).hexdigest()
+    return {
+        "Content-Type": content_type,
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": f"v0={signature}",
+    }
+
+
+def slack_request(entrypoint, i, slack_api, hours):
+    # (request id, body, content type) of the slack request for request i
+    request_id = f"Ev{i:06d}"
+    channel = f"C{i:06d}"
+    user = f"UREQ{i:06d}"
+    now = f"{slack_api.now + 30 + i / 1000:.6f}"
+    if entrypoint == "summarize_channel_request":
+        request_id = f"T{i:06d}"
+        body = urllib.parse.urlencode(
+            {
+                "token": "bench",
+                "team_id": "T1",
+                "api_app_id": "A1",
+                "channel_id": channel,
+                "channel_name": "bench",
+                "user_id": user,
+                "user_name": "bench",
+                "command": "/summarize",
+                "text": f"last {hours} hours",
+                "response_url": "https://hooks.slack.test/commands/1",
+                "trigger_id": request_id,
+            }
+        )
+        return request_id, body, "application/x-www-form-urlencoded"
+
+    thread_ts = slack_api.thread_roots(channel)[-1]["ts"]
+    if entrypoint == "greetings":
+        event = {"type": "message", "text": "hello ai", "ts": now}
+    elif entrypoint == "thread_reply":
+        event = {
+            "type": "message",
+            "text": "what changed in the deploy?",
+            "ts": now,
+            "thread_ts": thread_ts,
+            "parent_user_id": "U1",
+        }
+    else:
+        event = {
+            "type": "reaction_added",
+            "reaction": "summarize",
+            "item_user": "U1",
+            "item": {"type": "message", "channel": channel, "ts": thread_ts},
+        }
+    event.update(channel=channel, user=user, event_ts=now, channel_type="channel")
+    body = json.dumps(
+        {
+            "token": "bench",
+            "team_id": "T1",
+            "api_app_id": "A1",
+            "type": "event_callback",
+            "event_id": request_id,
+            "event_time": int(time.time()),
+            "event": event,
+        }
+    )
+    return request_id, body, "application/json"
+
+
+def run_scenario(args):
+    # in the child process, prints one json line of results
+    os.environ.update(
+        {
+            "SLACK_BOT_TOKEN": "xoxb-bench",
+            "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+            "SLACK_TOKEN_VERIFICATION": "false",
+            "WARM_CLIENTS": "false",
+            "PROJECT_ID": "bench",
+            "DEDUPE_BACKEND": "memory",
+            "SLACK_REPLIES_PER_MINUTE": str(args.replies_per_minute),
+        }
+    )
+    sys.path.insert(0, SOURCE)
+    import logging
+
+    import fakes
+    import main
+    import metrics
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # main imports vertexai on first use, keep that out of the measurement
+    import vertexai.generative_models  # noqa: F401
+
+    entrypoint, size = parse_scenario(args.run)
+    workload = fakes.Workload(
+        thread_size=size if "thread" in entrypoint else args.thread_size,
+        channel_messages=size if entrypoint == "summarize_channel_request" else 20,
+        channel_hours=args.hours,
+        files_per_thread=args.files,
+        file_bytes=args.file_kb * 1024,
+    )
+    slack_api = fakes.FakeSlackAPI(workload, latency=args.slack_ms / 1000)
+    slack_api.install()
+    model = fakes.FakeGemini(
+        latency=args.model_ms / 1000, ms_per_1k_tokens=args.model_ms_per_1k
+    )
+    main.get_generation_model = lambda *a, **kw: model
+    files = fakes.FakeFileSession(workload, latency=args.slack_ms / 1000)
+    main.attachment_fetcher.get_session = lambda: files
+
+    started = {}
+    ack_latencies = []
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+    clients = threading.local()
+
+    def client():
+        if not hasattr(clients, "client"):
+            clients.client = main.flask_app.test_client()
+        return clients.client
+
+    def deliver(envelope):
+        # the push subscription, runs on a fake pubsub worker thread
+        message = main.decode_pubsub_envelope(envelope) or {}
+        response = client().post("/", json=envelope)
+        finished = time.perf_counter()
+        request_id = message.get("event_id") or message.get("trigger_id")
+        with lock:
+            if response.status_code >= 300:
+                errors.append(f"push {response.status_code}")
+            if request_id in started:
+                latencies.append(finished - started[request_id])
+        done.release()
+
+    pubsub = fakes.FakePubSub(
+        deliver, latency=args.pubsub_ms / 1000, workers=args.workers
+    )
+    main.message_publisher.get_client = lambda: pubsub
+
+    def send(i, measured=True):
+        request_id, body, content_type = slack_request(
+            entrypoint, i, slack_api, args.hours
+        )
+        start = time.perf_counter()
+        if measured:
+            with lock:
+                started[request_id] = start
+        response = client().post(
+            "/slack/events", data=body, headers=signed_headers(body, content_type)
+        )
+        with lock:
+            if response.status_code != 200:
+                errors.append(f"slack {response.status_code}")
+            elif measured:
+                ack_latencies.append(time.perf_counter() - start)
+
+    # warm up on requests of their own, then measure a burst
+    for i in range(args.warmup):
+        send(args.requests + i, measured=False)
+    for _ in range(args.warmup):
+        done.acquire(timeout=args.timeout)
+    calls_before = slack_api.calls
+    model_before = model.calls
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.requests)))
+    for _ in range(args.requests):
+        if not done.acquire(timeout=args.timeout):
+            errors.append("timed out waiting for pushes")
+            break
+    elapsed = time.perf_counter() - start
+    pubsub.stop()
+
+    completed = len(latencies)
+    result = {
+        "scenario": args.run,
+        "requests": args.requests,
+        "completed": completed,
+        "errors": errors[:10],
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+        "ack_p99_ms": percentile(ack_latencies, 99) * 1000 if ack_latencies else None,
+        "throughput": completed / elapsed if elapsed else 0.0,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "slack_calls": (slack_api.calls - calls_before) / max(completed, 1),
+        "model_calls": (model.calls - model_before) / max(completed, 1),
+        "download_mb": metrics.DOWNLOAD_BYTES.value() / 1024 / 1024,
+    }
+    print(json.dumps(result))
+
+
+def child_args(args, scenario):
+    return [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--run",
+        scenario,
+        "--requests",
+        str(args.requests),
+        "--warmup",
+        str(args.warmup),
+        "--concurrency",
+        str(args.concurrency),
+        "--workers",
+        str(args.workers),
+        "--slack-ms",
+        str(args.slack_ms),
+        "--pubsub-ms",
+        str(args.pubsub_ms),
+        "--model-ms",
+        str(args.model_ms),
+        "--model-ms-per-1k",
+        str(args.model_ms_per_1k),
+        "--thread-size",
+        str(args.thread_size),
+        "--hours",
+        str(args.hours),
+        "--files",
+        str(args.files),
+        "--file-kb",
+        str(args.file_kb),
+        "--timeout",
+        str(args.timeout),
+        "--replies-per-minute",
+        str(args.replies_per_minute),
+    ]
+
+
+def report(result):
+    def ms(value):
+        return f"{value:8.1f}ms" if value is not None else "       -  "
+
+    print(
+        f"{result['scenario']:<32} {result['completed']:>4}/{result['requests']:<4} "
+        f"p50 {ms(result['p50_ms'])} p95 {ms(result['p95_ms'])} "
+        f"p99 {ms(result['p99_ms'])} ack p99 {ms(result['ack_p99_ms'])} "
+        f"{result['throughput']:6.1f} req/s  rss {result['rss_mb']:6.1f}MB  "
+        f"slack {result['slack_calls']:5.1f}/req  model {result['model_calls']:4.1f}/req"
+    )
+    for error in result["errors"]:
+        print(f"    error: {error}")
+
+
+def regressions(results, baseline, max_regression):
+    # what got worse than the baseline by more than max_regression
+    found = []
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if not before:
+            continue
+        for key in GATED:
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            if key == "throughput":
+                worse = new < old * (1 - max_regression)
+            else:
+                worse = new > old * (1 + max_regression)
+            if worse:
+                found.append(f"{result['scenario']} {key} {old:.1f} -> {new:.1f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scenario", action="append", type=str)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--warmup", type=int, default=3)
+    # slack delivering events to ingress at once, and worker threads
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--slack-ms", type=float, default=50)
+    parser.add_argument("--pubsub-ms", type=float, default=20)
+    parser.add_argument("--model-ms", type=float, default=500)
+    parser.add_argument("--model-ms-per-1k", type=float, default=20)
+    parser.add_argument("--thread-size", type=int, default=10)
+    parser.add_argument("--hours", type=int, default=4)
+    parser.add_argument("--files", type=int, default=0)
+    parser.add_argument("--file-kb", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120)
+    # the fake slack doesn't rate limit, pass 50 to measure with the real limit
+    parser.add_argument("--replies-per-minute", type=int, default=100000)
+    parser.add_argument("--save", help="write results to this json file")
+    parser.add_argument("--baseline", help="fail on regressions against this file")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args)
+        return
+
+    scenarios = args.scenario or list(DEFAULT_SCENARIOS)
+    for scenario in scenarios:
+        parse_scenario(scenario)
+    print(
+        f"{args.requests} requests per scenario, {args.concurrency} at once, "
+        f"{args.workers} worker threads, slack {args.slack_ms}ms, "
+        f"pubsub {args.pubsub_ms}ms, gemini {args.model_ms}ms"
+    )
+    results = []
+    failed = False
+    for scenario in scenarios:
+        run = subprocess.run(
+            child_args(args, scenario), capture_output=True, text=True, cwd=SOURCE
+        )
+        if run.returncode != 0 or not run.stdout.strip():
+            print(f"{scenario:<32} FAILED\n{run.stderr[-2000:]}")
+            failed = True
+            continue
+        result = json.loads(run.stdout.strip().splitlines()[-1])
+        report(result)
+        results.append(result)
+        if result["errors"] or result["completed"] < result["requests"]:
+            failed = True
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({r["scenario"]: r for r in results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for regression in found:
+            print(f"REGRESSION: {regression}")
+        failed = failed or bool(found)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
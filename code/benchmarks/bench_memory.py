@@ -0,0 +1,158 @@
+"""
+Memory used building a channel summary transcript from a long history.
+
+The first part compares two ways of turning api pages into a transcript:
+"dicts" keeps every message dict, extends them into one list, sorts it by
+its string ts and grows the transcript with +=, "records" keeps compact
+MessageRecords made as each page arrives, heap-merges the ts ordered
+channel and thread streams and joins the lines once. Pages go through
+json so every message is a fresh dict, the way the api client returns them.
+
+The second part runs main.channel_conversation and the summarizer's
+timeline against the fake slack api with full size messages.
+
+Peaks are from tracemalloc, which slows everything down, so times are
+only good for comparing the two.
+
+    python bench_memory.py --messages 20000 --thread-size 10
+"""
+import argparse
+import gc
+import heapq
+import json
+import os
+import sys
+import time
+import tracemalloc
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+# no gcp or slack access needed
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-bench")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "bench")
+os.environ.setdefault("SLACK_TOKEN_VERIFICATION", "false")
+os.environ.setdefault("WARM_CLIENTS", "false")
+os.environ.setdefault("PROJECT_ID", "bench")
+os.environ.setdefault("SLACK_REPLIES_PER_MINUTE", "1000000")
+import fakes  # noqa: E402
+from message_record import MessageRecord, by_ts  # noqa: E402
+
+
+PAGE_SIZE = 200
+
+
+def pages(slack_api, channel_id):
+    # history pages newest first, then each thread, as freshly decoded dicts
+    history = list(reversed(slack_api.channel(channel_id)))
+    for offset in range(0, len(history), PAGE_SIZE):
+        yield "history", json.loads(json.dumps(history[offset : offset + PAGE_SIZE]))
+    for root in slack_api.thread_roots(channel_id):
+        thread = slack_api.thread(channel_id, root["ts"])
+        yield "thread", json.loads(json.dumps(thread))
+
+
+def transcript_from_dicts(slack_api, channel_id):
+    messages = []
+    for _, page in pages(slack_api, channel_id):
+        messages.extend(page)
+    messages.sort(key=itemgetter("ts"))
+    transcript = ""
+    last_ts = None
+    for message in messages:
+        if message["ts"] == last_ts:
+            continue
+        last_ts = message["ts"]
+        transcript += f"{message.get('user')}: {message.get('text', '')}\n"
+    return transcript
+
+
+def transcript_from_records(slack_api, channel_id):
+    history = []
+    threads = []
+    for kind, page in pages(slack_api, channel_id):
+        records = [MessageRecord.from_slack(message) for message in page]
+        if kind == "history":
+            history.extend(records)
+        else:
+            threads.append(sorted(records, key=by_ts))
+        del page
+    history.reverse()
+    lines = []
+    last_ts = None
+    for record in heapq.merge(history, *threads, key=by_ts):
+        if record.ts == last_ts:
+            continue
+        last_ts = record.ts
+        lines.append(f"{record.user}: {record.text}\n")
+    return "".join(lines)
+
+
+def measure(fn, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak / 1024 / 1024, elapsed
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--thread-size", type=int, default=10)
+    parser.add_argument("--thread-every", type=int, default=10)
+    parser.add_argument("--hours", type=int, default=72)
+    args = parser.parse_args()
+
+    workload = fakes.Workload(
+        thread_size=args.thread_size,
+        channel_messages=args.messages,
+        channel_hours=args.hours,
+        thread_every=args.thread_every,
+        rich_messages=True,
+    )
+    slack_api = fakes.FakeSlackAPI(workload, latency=0)
+    channel_id = "CBENCH"
+    # generate the workspace outside the measurements
+    total = len(slack_api.channel(channel_id)) + sum(
+        len(slack_api.thread(channel_id, root["ts"])) - 1
+        for root in slack_api.thread_roots(channel_id)
+    )
+    print(f"{total} messages over {args.hours}h, threads of {args.thread_size}")
+
+    for label, fn in (
+        ("dicts", transcript_from_dicts),
+        ("records", transcript_from_records),
+    ):
+        transcript, peak, elapsed = measure(fn, slack_api, channel_id)
+        print(
+            f"{label:<24} peak {peak:8.1f}MB  {elapsed:7.2f}s  "
+            f"transcript {len(transcript) / 1024 / 1024:6.1f}MB"
+        )
+
+    import logging
+
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    slack_api.install()
+    oldest = slack_api.now - args.hours * 60 * 60 - 1
+
+    def conversation_timeline():
+        channel_lines, thread_lines = main.channel_conversation(channel_id, oldest)
+        timeline, _ = main.summarizer._split(channel_id, channel_lines, thread_lines)
+        return timeline
+
+    timeline, peak, elapsed = measure(conversation_timeline)
+    print(
+        f"{'channel_conversation':<24} peak {peak:8.1f}MB  {elapsed:7.2f}s  "
+        f"{len(timeline)} timeline lines"
+    )
+
+
+if __name__ == "__main__":
+    run_benchmark()
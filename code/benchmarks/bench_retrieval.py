@@ -0,0 +1,89 @@
+"""
+Channel history retrieval index: build, reload and search speed.
+
+Messages are embedded with the deterministic HashEmbedder, so no model is
+called and every run gives the same results. Recall is how often a message
+(or one with the same words) comes back first when searched for by its
+own text.
+
+    python bench_retrieval.py --messages 100000 --k 8
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+from retrieval import RetrievalIndex, HashEmbedder  # noqa: E402
+
+TOPICS = (
+    "deploy rollback config timeout",
+    "database migration index vacuum",
+    "oncall pager alert latency",
+    "budget invoice vendor contract",
+    "release notes changelog version",
+    "login sso token expiry",
+)
+
+
+def message_lines(count, rng):
+    lines = []
+    for i in range(count):
+        words = rng.choice(TOPICS).split() + [f"item{rng.randrange(5000)}"]
+        rng.shuffle(words)
+        lines.append((f"{1700000000 + i}.000100", f"U{i % 40}: {' '.join(words)}\n"))
+    return lines
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    lines = message_lines(args.messages, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        index = RetrievalIndex(HashEmbedder(args.dim), directory)
+        start = time.perf_counter()
+        # in the steps a channel would be refreshed in
+        for offset in range(0, len(lines), 500):
+            index.add("CBENCH", lines[offset : offset + 500])
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(index.channel("CBENCH").vectors_path) / 1024 / 1024
+        print(
+            f"indexed {args.messages} messages in {elapsed:6.2f}s "
+            f"({args.messages / elapsed:8.0f}/s), vectors {size:6.1f}MB"
+        )
+
+        start = time.perf_counter()
+        reloaded = RetrievalIndex(HashEmbedder(args.dim), directory)
+        reloaded.latest_ts("CBENCH")
+        print(f"reloaded in {(time.perf_counter() - start) * 1000:8.1f}ms")
+
+        latencies = []
+        found = 0
+        for _, line in rng.sample(lines, args.queries):
+            start = time.perf_counter()
+            hits = reloaded.search("CBENCH", line, k=args.k)
+            latencies.append(time.perf_counter() - start)
+            # another message with the same words is as good a match
+            found += bool(hits) and hits[0][2] == line
+        print(
+            f"search k={args.k}  p50 {percentile(latencies, 50) * 1000:7.2f}ms  "
+            f"p99 {percentile(latencies, 99) * 1000:7.2f}ms  "
+            f"recall@1 {found / args.queries:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    run_benchmark()
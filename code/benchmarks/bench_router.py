@@ -0,0 +1,117 @@
+"""
+Tail latency of routed gemini calls when a model or region misbehaves.
+
+Two fake models stand in for the targets of one route: every call takes
+--model-ms, but --slow-rate of the primary's calls take --slow-ms instead
+and --error-rate of them fail. Calls are made from --threads threads, with
+no hedging and then hedged after --hedge-ms, reporting latency percentiles,
+how many calls were hedged and the extra model calls that cost.
+
+    python bench_router.py --slow-rate 0.05 --hedge-ms 300
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+from metrics import MODEL_HEDGES  # noqa: E402
+from model_router import ModelRouter, Route  # noqa: E402
+
+
+class FlakyModel:
+    def __init__(self, latency, slow_latency=0, slow_rate=0, error_rate=0, seed=1):
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_rate = slow_rate
+        self.error_rate = error_rate
+        self.calls = 0
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        with self._lock:
+            self.calls += 1
+            roll = self.rng.random()
+        if roll < self.error_rate:
+            time.sleep(self.latency / 10)
+            raise RuntimeError("503 unavailable")
+        if roll < self.error_rate + self.slow_rate:
+            time.sleep(self.slow_latency)
+        else:
+            time.sleep(self.latency)
+        return SimpleNamespace(text="1")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run(label, args, hedge_after):
+    primary = FlakyModel(
+        args.model_ms / 1000,
+        slow_latency=args.slow_ms / 1000,
+        slow_rate=args.slow_rate,
+        error_rate=args.error_rate,
+    )
+    fallback = FlakyModel(args.model_ms / 1000, seed=2)
+    models = {("primary", "r1"): primary, ("fallback", "r2"): fallback}
+    router = ModelRouter(
+        lambda model_name, location: models[(model_name, location)],
+        {"default": Route(list(models), hedge_after=hedge_after)},
+        hedge_workers=args.hedge_workers,
+    )
+    hedges = MODEL_HEDGES.value(task=label)
+    latencies = []
+    errors = 0
+
+    def call(_):
+        start = time.perf_counter()
+        router.generate(label, "how many hours?")
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [executor.submit(call, i) for i in range(args.requests)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    router.close()
+    extra = primary.calls + fallback.calls - args.requests
+    print(
+        f"{label:<10} p50 {percentile(latencies, 50) * 1000:8.1f}ms  "
+        f"p95 {percentile(latencies, 95) * 1000:8.1f}ms  "
+        f"p99 {percentile(latencies, 99) * 1000:8.1f}ms  "
+        f"hedged {MODEL_HEDGES.value(task=label) - hedges:4}  "
+        f"extra calls {extra:4}  errors {errors}"
+    )
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--model-ms", type=float, default=100)
+    parser.add_argument("--slow-ms", type=float, default=2000)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--hedge-ms", type=float, default=300)
+    parser.add_argument("--hedge-workers", type=int, default=64)
+    args = parser.parse_args()
+
+    print(
+        f"{args.requests} calls, {args.threads} at once, {args.model_ms}ms per call, "
+        f"{args.slow_rate:.0%} take {args.slow_ms}ms, {args.error_rate:.0%} fail"
+    )
+    run("failover", args, None)
+    run("hedged", args, args.hedge_ms / 1000)
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,129 @@
+"""
+Cold start check: how long a fresh interpreter takes to import main, or
+with --module ingress the slack facing service on its own.
+
+Each run is a new python process (nothing cached in sys.modules) with the
+slack secrets in the environment, so only imports and module level setup
+are measured. Fails if the median import is over --threshold-ms or if any
+of the heavy modules kept off the ingress path were imported. ingress
+also fails if it imported any of the worker's modules.
+
+    python bench_startup.py --runs 5 --threshold-ms 1000
+    python bench_startup.py --module ingress --threshold-ms 500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+# imported lazily by main, only on the paths that need them
+LAZY_MODULES = (
+    "vertexai",
+    "google.cloud.aiplatform",
+    "google.cloud.pubsub_v1",
+    "google.cloud.secretmanager",
+    "requests",
+)
+# only the worker needs these, the ingress image doesn't even ship them
+WORKER_MODULES = (
+    "main",
+    "attachments",
+    "summarizer",
+    "model_router",
+    "retrieval",
+    "numpy",
+)
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def probe_env():
+    env = dict(os.environ)
+    env.update(
+        {
+            "SLACK_BOT_TOKEN": "xoxb-bench",
+            "SLACK_SIGNING_SECRET": "bench",
+            "SLACK_TOKEN_VERIFICATION": "false",
+            "WARM_CLIENTS": "false",
+            "PROJECT_ID": "bench",
+        }
+    )
+    return env
+
+
+def import_once(env, module, forbidden):
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE % (module, forbidden)],
+        cwd=SOURCE,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, module, count):
+    # python -X importtime, sorted by cumulative microseconds
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SOURCE,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threshold-ms", type=float, default=1000)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--module", choices=("main", "ingress"), default="main")
+    args = parser.parse_args()
+
+    env = probe_env()
+    forbidden = LAZY_MODULES
+    if args.module == "ingress":
+        forbidden += WORKER_MODULES
+    runs = [import_once(env, args.module, forbidden) for _ in range(args.runs)]
+    seconds = [run["seconds"] for run in runs]
+    median_ms = statistics.median(seconds) * 1000
+    print(
+        f"import {args.module}  median {median_ms:8.1f}ms  "
+        f"min {min(seconds) * 1000:8.1f}ms  max {max(seconds) * 1000:8.1f}ms"
+    )
+    print("slowest imports (cumulative):")
+    for cumulative, name in slowest_imports(env, args.module, args.top):
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    failed = False
+    if median_ms > args.threshold_ms:
+        print(f"FAIL: median import over {args.threshold_ms}ms")
+        failed = True
+    loaded = sorted({module for run in runs for module in run["loaded"]})
+    if loaded:
+        print(f"FAIL: imported at startup: {', '.join(loaded)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+Offline stand-ins for slack, pubsub and gemini, shared by the benchmarks.
+
+FakeSlackAPI answers web api calls at slack_sdk's http layer, so the real
+WebClient methods, pagination arguments and the metrics wrapper all run as
+they do in production. The workspace it serves is generated from a Workload:
+how many messages a channel has, how long threads are, how many files they
+carry. Every call sleeps for the configured latency.
+"""
+import base64
+import functools
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+
+BOT_USER_ID = "UBOT"
+BOT_ID = "BBOT"
+USERS = ("U1", "U2", "U3", "U4")
+FILE_HOST = "https://files.slack.test/"
+
+
+class Workload:
+    """
+    The shape of the fake workspace. Every channel holds channel_messages
+    top level messages spread over the last channel_hours, every
+    thread_every'th one starts a thread of thread_size replies, the first
+    files_per_thread user replies carry a file_bytes text file each.
+    rich_messages adds the blocks, reactions and metadata real messages
+    carry, for measuring memory.
+    """
+
+    def __init__(
+        self,
+        thread_size=10,
+        channel_messages=50,
+        channel_hours=4,
+        thread_every=10,
+        files_per_thread=0,
+        file_bytes=64 * 1024,
+        words_per_message=20,
+        rich_messages=False,
+    ):
+        self.thread_size = thread_size
+        self.channel_messages = channel_messages
+        self.channel_hours = channel_hours
+        self.thread_every = thread_every
+        self.files_per_thread = files_per_thread
+        self.file_bytes = file_bytes
+        self.words_per_message = words_per_message
+        self.rich_messages = rich_messages
+
+
+def rich_fields(message):
+    # what the api sends along with a user message, roughly
+    return {
+        "client_msg_id": f"{abs(hash(message['ts'])):032x}",
+        "team": "T1",
+        "blocks": [
+            {
+                "type": "rich_text",
+                "block_id": message["ts"][-5:],
+                "elements": [
+                    {
+                        "type": "rich_text_section",
+                        "elements": [{"type": "text", "text": message["text"]}],
+                    }
+                ],
+            }
+        ],
+        "reactions": [{"name": "eyes", "users": list(USERS[:2]), "count": 2}],
+        "edited": {"user": message.get("user"), "ts": message["ts"]},
+        "user_profile": {
+            "avatar_hash": "g0123456789a",
+            "image_72": "https://avatars.slack-edge.test/72.png",
+            "first_name": "Bench",
+            "real_name": f"User {message.get('user')}",
+            "display_name": str(message.get("user")).lower(),
+            "team": "T1",
+            "name": str(message.get("user")).lower(),
+            "is_restricted": False,
+            "is_ultra_restricted": False,
+        },
+    }
+
+
+def message_text(key, index, words):
+    # different in every channel, so no two prompts are the same
+    return f"{key} " + " ".join(f"word{(index + i) % 97}" for i in range(words))
+
+
+class FakeSlackAPI:
+    def __init__(self, workload, latency=0.05, now=None):
+        self.workload = workload
+        self.latency = latency
+        # the newest message in every channel, a minute ago
+        self.now = (now or time.time()) - 60
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._ts = itertools.count()
+
+    @functools.lru_cache(maxsize=256)
+    def channel(self, channel_id):
+        # top level messages, oldest first
+        count = self.workload.channel_messages
+        spacing = self.workload.channel_hours * 60 * 60 / max(count, 1)
+        messages = []
+        for i in range(count):
+            ts = f"{self.now - (count - 1 - i) * spacing:.6f}"
+            message = {
+                "type": "message",
+                "ts": ts,
+                "user": USERS[i % len(USERS)],
+                "text": message_text(channel_id, i, self.workload.words_per_message),
+            }
+            if self.workload.rich_messages:
+                message.update(rich_fields(message))
+            if i % self.workload.thread_every == 0 or i == count - 1:
+                message.update(
+                    thread_ts=ts,
+                    reply_count=self.workload.thread_size,
+                    reply_users=[USERS[i % len(USERS)], BOT_USER_ID],
+                )
+            messages.append(message)
+        return messages
+
+    def thread_roots(self, channel_id):
+        return [m for m in self.channel(channel_id) if "thread_ts" in m]
+
+    @functools.lru_cache(maxsize=256)
+    def thread(self, channel_id, thread_ts):
+        # root then replies, oldest first
+        root = next(
+            (m for m in self.channel(channel_id) if m["ts"] == thread_ts),
+            {"type": "message", "ts": thread_ts, "user": USERS[0], "text": "hi"},
+        )
+        messages = [dict(root, thread_ts=thread_ts)]
+        files = 0
+        for j in range(1, self.workload.thread_size + 1):
+            reply = {
+                "type": "message",
+                "ts": f"{float(thread_ts) + j / 1000:.6f}",
+                "thread_ts": thread_ts,
+                "text": message_text(channel_id, j, self.workload.words_per_message),
+            }
+            if j % 3 == 0:
+                reply.update(user=BOT_USER_ID, bot_id=BOT_ID)
+            else:
+                reply["user"] = USERS[j % len(USERS)]
+                if files < self.workload.files_per_thread:
+                    files += 1
+                    file_id = f"F{channel_id}{thread_ts.replace('.', '')}{j}"
+                    reply["files"] = [
+                        {
+                            "id": file_id,
+                            "name": f"{file_id}.txt",
+                            "mimetype": "text/plain",
+                            "size": self.workload.file_bytes,
+                            "url_private": FILE_HOST + file_id,
+                        }
+                    ]
+            if self.workload.rich_messages:
+                reply.update(rich_fields(reply))
+            messages.append(reply)
+        return messages
+
+    def call(self, method, params):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+        handler = getattr(self, method.replace(".", "_"), None)
+        if handler is None:
+            return {"ok": True}
+        return handler(params)
+
+    def _page(self, messages, params, key):
+        # cursor is an offset into messages
+        limit = int(params.get("limit") or 100)
+        offset = int(params.get("cursor") or 0)
+        page = messages[offset : offset + limit]
+        more = offset + limit < len(messages)
+        return {
+            "ok": True,
+            key: page,
+            "has_more": more,
+            "response_metadata": {"next_cursor": str(offset + limit) if more else ""},
+        }
+
+    def conversations_history(self, params):
+        inclusive = str(params.get("inclusive", "0")) in ("1", "true", "True")
+        oldest = float(params.get("oldest") or 0)
+        latest = float(params.get("latest") or "inf")
+        messages = [
+            m
+            for m in reversed(self.channel(params["channel"]))
+            if (float(m["ts"]) > oldest or (inclusive and float(m["ts"]) == oldest))
+            and (float(m["ts"]) < latest or (inclusive and float(m["ts"]) == latest))
+        ]
+        return self._page(messages, params, "messages")
+
+    def conversations_replies(self, params):
+        messages = self.thread(params["channel"], params["ts"])
+        oldest = float(params.get("oldest") or 0)
+        # the parent is always returned
+        messages = messages[:1] + [m for m in messages[1:] if float(m["ts"]) > oldest]
+        return self._page(messages, params, "messages")
+
+    def conversations_info(self, params):
+        return {"ok": True, "channel": {"id": params["channel"], "is_member": True}}
+
+    def conversations_open(self, params):
+        return {"ok": True, "channel": {"id": "D" + str(params.get("users"))}}
+
+    def users_info(self, params):
+        user = params["user"]
+        return {
+            "ok": True,
+            "user": {
+                "id": user,
+                "name": user.lower(),
+                "profile": {"real_name": f"User {user}"},
+            },
+        }
+
+    def users_list(self, params):
+        return {"ok": True, "members": [], "response_metadata": {"next_cursor": ""}}
+
+    def auth_test(self, params):
+        return {
+            "ok": True,
+            "user_id": BOT_USER_ID,
+            "bot_id": BOT_ID,
+            "team_id": "T1",
+            "team": "bench",
+        }
+
+    def _posted(self, params):
+        return {
+            "ok": True,
+            "channel": params.get("channel"),
+            "ts": f"{self.now + next(self._ts) / 1000:.6f}",
+        }
+
+    chat_postMessage = chat_update = chat_postEphemeral = _posted
+
+    def install(self):
+        """
+        Route every WebClient and response_url call in this process here.
+        """
+        from slack_sdk.web.base_client import BaseClient
+        from slack_sdk.webhook.client import WebhookClient
+        from slack_sdk.webhook.webhook_response import WebhookResponse
+
+        api = self
+
+        def perform(client, *, url, args):
+            params = {}
+            for key in ("params", "data", "json"):
+                params.update(args.get(key) or {})
+            body = api.call(url.rsplit("/", 1)[-1], params)
+            return {
+                "status": 200,
+                "headers": {"content-type": "application/json"},
+                "body": json.dumps(body),
+            }
+
+        def respond(client, *, body, headers):
+            time.sleep(api.latency)
+            return WebhookResponse(
+                url=client.url, status_code=200, body="ok", headers={}
+            )
+
+        BaseClient._perform_urllib_http_request = perform
+        WebhookClient._perform_http_request = respond
+
+
+class FakeFileResponse:
+    def __init__(self, size):
+        self.size = size
+        self.headers = {"Content-Length": str(size)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        remaining = self.size
+        while remaining > 0:
+            chunk = min(chunk_size, remaining)
+            remaining -= chunk
+            yield b"x" * chunk
+
+
+class FakeFileSession:
+    # requests.Session stand-in for slack file downloads
+    def __init__(self, workload, latency=0.05):
+        self.workload = workload
+        self.latency = latency
+        self.downloads = 0
+
+    def get(self, url, stream=False, timeout=None):
+        time.sleep(self.latency)
+        self.downloads += 1
+        return FakeFileResponse(self.workload.file_bytes)
+
+
+def content_chars(contents):
+    # rough size of a prompt, a string or a list of Content
+    if isinstance(contents, str):
+        return len(contents)
+    chars = 0
+    for content in contents:
+        for part in getattr(content, "parts", []):
+            try:
+                chars += len(part.text)
+            except Exception:
+                # files
+                chars += 1000
+    return chars
+
+
+class FakeGemini:
+    """
+    GenerativeModel stand-in. Each call takes latency seconds plus
+    ms_per_1k_tokens for every thousand prompt tokens, streams come back in
+    chunks pieces. Responses carry usage_metadata like the real ones.
+    """
+
+    def __init__(self, latency=0.5, ms_per_1k_tokens=20, chunks=4):
+        self.latency = latency
+        self.ms_per_1k_tokens = ms_per_1k_tokens
+        self.chunks = chunks
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _response(self, text, prompt_tokens, response_tokens):
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=response_tokens,
+            ),
+        )
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        with self._lock:
+            self.calls += 1
+        prompt_tokens = content_chars(contents) // 4
+        duration = self.latency + prompt_tokens / 1000 * self.ms_per_1k_tokens / 1000
+        # the /summarize time frame question wants a bare number
+        text = "it was the timeout setting, rolled back at noon. "
+        if "Answer with only the number" in str(contents):
+            text = "1"
+        if not stream:
+            time.sleep(duration)
+            return self._response(text, prompt_tokens, len(text) // 4)
+        return self._stream(text, prompt_tokens, duration)
+
+    def _stream(self, text, prompt_tokens, duration):
+        for i in range(1, self.chunks + 1):
+            time.sleep(duration / self.chunks)
+            yield self._response(text, prompt_tokens, i * len(text) // 4)
+
+
+class FakePubSub:
+    """
+    PublisherClient stand-in that acts as a push subscription as well,
+    every published message is handed to deliver(envelope) on one of
+    workers threads, the way pubsub pushes to a worker with that many
+    gunicorn threads.
+    """
+
+    def __init__(self, deliver, latency=0.02, workers=8):
+        self.deliver = deliver
+        self.latency = latency
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="fake-pubsub"
+        )
+        self._ids = itertools.count(1)
+
+    def publish(self, topic, data, **attributes):
+        future = Future()
+        self.executor.submit(self._push, future, str(next(self._ids)), data, attributes)
+        return future
+
+    def _push(self, future, message_id, data, attributes):
+        time.sleep(self.latency)
+        future.set_result(message_id)
+        self.deliver(
+            {
+                "message": {
+                    "data": base64.b64encode(data).decode("utf-8"),
+                    "attributes": attributes,
+                    "messageId": message_id,
+                },
+                "subscription": "projects/bench/subscriptions/slack-messages",
+            }
+        )
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
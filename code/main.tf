@@ -29,6 +29,22 @@ locals {
     "artifactregistry.googleapis.com",
     "pubsub.googleapis.com",
   "aiplatform.googleapis.com"]
+
+  # the split ingress only forwards replies in threads the worker is in, so
+  # both services share the thread index through redis when one is given
+  thread_index_env = var.split_ingress && var.thread_index_redis_url != "" ? {
+    THREAD_INDEX_BACKEND = "redis"
+    REDIS_URL            = var.thread_index_redis_url
+  } : {}
+  # without one the ingress never hears about threads the worker joins, so it
+  # doesn't remember threads as not ours and asks slack each time instead
+  ingress_env = merge(local.thread_index_env,
+    var.split_ingress && var.thread_index_redis_url == "" ? { THREAD_CACHE_NEGATIVE_TTL = "0" } : {}
+  )
+  vpc_annotations = var.vpc_connector != "" ? {
+    "run.googleapis.com/vpc-access-connector" = var.vpc_connector
+    "run.googleapis.com/vpc-access-egress"    = "private-ranges-only"
+  } : {}
 }
 
 
@@ -150,14 +166,30 @@ resource "google_cloud_run_service" "default" {
   autogenerate_revision_name = true
 
   template {
+    dynamic "metadata" {
+      for_each = var.split_ingress && var.vpc_connector != "" ? [1] : []
+      content {
+        annotations = local.vpc_annotations
+      }
+    }
     spec {
       service_account_name = google_service_account.cloudrun_service_identity.email
+      # with ingress split off every request here is a long pubsub push, scale
+      # out rather than queue them behind gunicorn's threads
+      container_concurrency = var.split_ingress ? var.worker_concurrency : null
       containers {
         image = "${local.location}-docker.pkg.dev/${local.project_id}/${local.gar_repo_name}/${local.service_name}"
         env {
           name  = "PROJECT_ID"
           value = local.project_id
         }
+        dynamic "env" {
+          for_each = local.thread_index_env
+          content {
+            name  = env.key
+            value = env.value
+          }
+        }
       }
     }
   }
@@ -174,9 +206,97 @@ data "google_iam_policy" "noauth" {
 }
 
 resource "google_cloud_run_service_iam_policy" "noauth" {
+  # slack calls the ingress service instead when it is split off
+  count    = var.split_ingress ? 0 : 1
+  location = google_cloud_run_service.default.location
+  project  = local.project_id
+  service  = google_cloud_run_service.default.name
+
+  policy_data = data.google_iam_policy.noauth.policy_data
+}
+
+moved {
+  from = google_cloud_run_service_iam_policy.noauth
+  to   = google_cloud_run_service_iam_policy.noauth[0]
+}
+
+# the worker is private when split, only pubsub's push (oidc token) gets in
+resource "google_cloud_run_service_iam_member" "push_invoker" {
+  count    = var.split_ingress ? 1 : 0
   location = google_cloud_run_service.default.location
   project  = local.project_id
   service  = google_cloud_run_service.default.name
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${google_service_account.cloudrun_service_identity.email}"
+}
+
+/**
+slack facing ingress, only when split_ingress is set
+**/
+
+resource "null_resource" "cloudbuild_ingress_container" {
+  count = var.split_ingress ? 1 : 0
+  triggers = {
+    dir_sha1 = sha1(join("", [for f in fileset(path.root, "source/**") : filesha1(f)]))
+  }
+
+  provisioner "local-exec" {
+    command = <<EOT
+      gcloud builds submit ./source/ --project ${local.project_id} --config=./source/cloudbuild.yaml --substitutions=_SERVICE_NAME=${local.service_name}-ingress,_DOCKERFILE=Dockerfile.ingress
+  EOT
+  }
+}
+
+resource "google_cloud_run_service" "ingress" {
+  count                      = var.split_ingress ? 1 : 0
+  name                       = "${local.service_name}-ingress"
+  location                   = local.location
+  project                    = local.project_id
+  autogenerate_revision_name = true
+
+  template {
+    metadata {
+      # warm instances so an ack never waits on a cold start, and cpu after
+      # the response since the lazy listeners publish once the ack is sent
+      annotations = merge({
+        "autoscaling.knative.dev/minScale"     = var.ingress_min_instances
+        "run.googleapis.com/cpu-throttling"    = "false"
+        "run.googleapis.com/startup-cpu-boost" = "true"
+      }, local.vpc_annotations)
+    }
+    spec {
+      service_account_name = google_service_account.cloudrun_service_identity.email
+      containers {
+        image = "${local.location}-docker.pkg.dev/${local.project_id}/${local.gar_repo_name}/${local.service_name}-ingress"
+        env {
+          name  = "PROJECT_ID"
+          value = local.project_id
+        }
+        dynamic "env" {
+          for_each = local.ingress_env
+          content {
+            name  = env.key
+            value = env.value
+          }
+        }
+        resources {
+          limits = {
+            cpu    = "1"
+            memory = "256Mi"
+          }
+        }
+      }
+    }
+  }
+
+  depends_on = [null_resource.cloudbuild_ingress_container]
+}
+
+resource "google_cloud_run_service_iam_policy" "ingress_noauth" {
+  count    = var.split_ingress ? 1 : 0
+  location = google_cloud_run_service.ingress[0].location
+  project  = local.project_id
+  service  = google_cloud_run_service.ingress[0].name
 
   policy_data = data.google_iam_policy.noauth.policy_data
 }
@@ -214,13 +334,17 @@ resource "google_pubsub_subscription" "subscription" {
   project = local.project_id
 
   ack_deadline_seconds = 360
-  push_config {
-    push_endpoint = google_cloud_run_service.default.status[0].url
-    oidc_token {
-      service_account_email = google_service_account.cloudrun_service_identity.email
-    }
-    attributes = {
-      x-goog-version = "v1"
+  # pull workers (worker.py) read the subscription themselves
+  dynamic "push_config" {
+    for_each = var.pull_workers ? [] : [1]
+    content {
+      push_endpoint = google_cloud_run_service.default.status[0].url
+      oidc_token {
+        service_account_email = google_service_account.cloudrun_service_identity.email
+      }
+      attributes = {
+        x-goog-version = "v1"
+      }
     }
   }
 
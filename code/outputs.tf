@@ -2,3 +2,8 @@ output "cloudrun_url" {
   description = "cloud run service url"
   value       = google_cloud_run_service.default.status[0].url
 }
+
+output "slack_events_url" {
+  description = "request url to give slack for events and the /summarize command"
+  value       = "${var.split_ingress ? google_cloud_run_service.ingress[0].status[0].url : google_cloud_run_service.default.status[0].url}/slack/events"
+}
@@ -0,0 +1,176 @@
+import logging
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from utils import TTLCache, TokenBucket
+
+
+logger = logging.getLogger()
+
+# lower runs first, people waiting in a thread before bulk summaries
+PRIORITIES = {
+    "greetings": 0,
+    "thread_reply": 0,
+    "summarize_thread_request": 1,
+    "summarize_channel_request": 2,
+}
+DEFAULT_PRIORITY = 1
+
+
+class AdmissionController:
+    """
+    Keeps one person or one busy channel from taking every worker thread
+    and all of our gemini quota.
+
+    admit() takes a token from the user's and the channel's bucket, then
+    waits up to max_wait seconds for one of max_concurrent slots. Freed
+    slots go to the highest priority waiter, oldest first. It returns None
+    once the request holds a slot (call release() when done) or why the
+    request was shed: "user", "channel" or "busy".
+    """
+
+    def __init__(
+        self,
+        user_rate=10 / 60,
+        user_burst=5,
+        channel_rate=30 / 60,
+        channel_burst=10,
+        max_concurrent=8,
+        max_wait=30,
+        max_waiting=100,
+        max_keys=10000,
+        clock=time.monotonic,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.clock = clock
+        # idle buckets are full again by the time they expire
+        self.users = TTLCache(max_size=max_keys, ttl=60 * 60, clock=clock)
+        self.channels = TTLCache(max_size=max_keys, ttl=60 * 60, clock=clock)
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._order = itertools.count()
+        self.active = 0
+        self.shed = 0
+
+    def _take(self, buckets, key, rate, burst):
+        # a token from key's bucket, requests without a user/channel always get one
+        if not key:
+            return True
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate=rate, capacity=burst, clock=self.clock)
+            buckets.set(key, bucket)
+        return bucket.try_acquire()
+
+    def _take_tokens(self, user, channel):
+        # None, or which rate limit the request is over
+        if not self._take(self.users, user, self.user_rate, self.user_burst):
+            return "user"
+        if not self._take(
+            self.channels, channel, self.channel_rate, self.channel_burst
+        ):
+            return "channel"
+        return None
+
+    def _count_shed(self, entrypoint, user, channel, reason):
+        if reason:
+            self.shed += 1
+            logger.info(f"shed {entrypoint} from {user} in {channel}: {reason}")
+
+    def admit(self, entrypoint, user, channel):
+        reason = self._take_tokens(user, channel)
+        if not reason:
+            reason = self._wait_for_slot(PRIORITIES.get(entrypoint, DEFAULT_PRIORITY))
+        self._count_shed(entrypoint, user, channel, reason)
+        return reason
+
+    def _wait_for_slot(self, priority):
+        with self._condition:
+            if not self._waiting and self.active < self.max_concurrent:
+                self.active += 1
+                return None
+            if len(self._waiting) >= self.max_waiting:
+                return "busy"
+            entry = (priority, next(self._order))
+            heapq.heappush(self._waiting, entry)
+            deadline = self.clock() + self.max_wait
+            while not (self._waiting[0] == entry and self.active < self.max_concurrent):
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    # the next waiter may be runnable now
+                    self._condition.notify_all()
+                    return "busy"
+                self._condition.wait(remaining)
+            heapq.heappop(self._waiting)
+            self.active += 1
+            self._condition.notify_all()
+            return None
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    AdmissionController for the asgi worker, requests wait for a slot on the
+    event loop instead of holding a thread. admit() is a coroutine, and it
+    and release() must be called from the one event loop.
+    """
+
+    async def admit(self, entrypoint, user, channel):
+        reason = self._take_tokens(user, channel)
+        if not reason:
+            reason = await self._wait_for_slot(
+                PRIORITIES.get(entrypoint, DEFAULT_PRIORITY)
+            )
+        self._count_shed(entrypoint, user, channel, reason)
+        return reason
+
+    async def _wait_for_slot(self, priority):
+        if not self._waiting and self.active < self.max_concurrent:
+            self.active += 1
+            return None
+        if len(self._waiting) >= self.max_waiting:
+            return "busy"
+        # release() hands its slot straight to the first waiter
+        slot = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._order), slot)
+        heapq.heappush(self._waiting, entry)
+        try:
+            await asyncio.wait({slot}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if slot.done():
+                # cancelled just as the slot arrived, pass it on
+                self.release()
+            else:
+                self._leave(entry)
+            raise
+        if not slot.done():
+            self._leave(entry)
+            return "busy"
+        return None
+
+    def _leave(self, entry):
+        entry[2].cancel()
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+
+    def release(self):
+        while self._waiting:
+            _, _, slot = heapq.heappop(self._waiting)
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
@@ -0,0 +1,333 @@
+import logging
+import asyncio
+import json
+import os
+import httpx
+from slack_sdk.web.async_client import AsyncWebClient
+
+import main
+from admission import AsyncAdmissionController
+from utils import async_slack_call
+from metrics import (
+    stage,
+    request,
+    record_usage,
+    counted_stream_async,
+    instrument_slack_client,
+    registry as metrics_registry,
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+)
+from streaming import AsyncStreamingReply, markdown_blocks
+
+
+# async worker for the pubsub push endpoint, run with
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+# thread replies and greetings are fully async (slack, gemini and file downloads)
+# so one instance can hold hundreds of conversations waiting on the network.
+# summaries still run the threaded handle_slack_message on a bounded pool.
+
+logger = logging.getLogger()
+
+# how many sync handle_slack_message calls (summaries) may run at once
+ASYNC_SYNC_WORKERS = int(os.environ.get("ASYNC_SYNC_WORKERS", "8"))
+ASYNC_HTTP_CONNECTIONS = int(os.environ.get("ASYNC_HTTP_CONNECTIONS", "100"))
+# requests working with gemini at once here, and how many may wait for a turn.
+# waiting costs a coroutine rather than a thread, so both are well above the
+# threaded worker's MODEL_MAX_CONCURRENT
+ASYNC_MODEL_MAX_CONCURRENT = int(os.environ.get("ASYNC_MODEL_MAX_CONCURRENT", "256"))
+ASYNC_ADMISSION_MAX_WAITING = int(os.environ.get("ASYNC_ADMISSION_MAX_WAITING", "1000"))
+
+async_slack_client = instrument_slack_client(AsyncWebClient(token=main.slack_token))
+sync_slots = asyncio.Semaphore(ASYNC_SYNC_WORKERS)
+# the same per user/channel limits as main.admission, waiting on the event loop
+admission = AsyncAdmissionController(
+    user_rate=main.ADMISSION_USER_PER_MINUTE / 60,
+    user_burst=main.ADMISSION_USER_BURST,
+    channel_rate=main.ADMISSION_CHANNEL_PER_MINUTE / 60,
+    channel_burst=main.ADMISSION_CHANNEL_BURST,
+    max_concurrent=ASYNC_MODEL_MAX_CONCURRENT,
+    max_wait=main.ADMISSION_MAX_WAIT,
+    max_waiting=ASYNC_ADMISSION_MAX_WAITING,
+)
+_http_client = None
+_bot_user_id = None
+
+
+def get_async_http_client():
+    # created on first use so it belongs to the running event loop
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            headers={"Authorization": "Bearer %s" % main.slack_token},
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_CONNECTIONS),
+            follow_redirects=True,
+        )
+    return _http_client
+
+
+async def get_bot_user_id_async():
+    global _bot_user_id
+    if _bot_user_id is None:
+        slack_identity = await async_slack_client.auth_test()
+        _bot_user_id = slack_identity["user_id"]
+    return _bot_user_id
+
+
+async def bot_in_thread_async(channel, thread_ts):
+    # main.bot_in_thread on the event loop
+    in_thread = main.thread_index.lookup(channel, thread_ts)
+    if in_thread is not None:
+        return in_thread
+    slack_result = await async_slack_client.conversations_history(
+        channel=channel,
+        oldest=thread_ts,
+        inclusive=True,
+        limit=1,
+    )
+    bot_user_id = await get_bot_user_id_async()
+    in_thread = bool(
+        slack_result.get("messages")
+        and bot_user_id in slack_result["messages"][0].get("reply_users", [])
+    )
+    if in_thread:
+        main.thread_index.add(channel, thread_ts)
+    else:
+        main.thread_index.add_negative(channel, thread_ts)
+    return in_thread
+
+
+async def get_message_thread_async(channel, thread_ts, oldest=None):
+    thread_history = []
+    extra_args = {} if oldest is None else {"oldest": oldest}
+    cursor = None
+    while True:
+        if cursor:
+            extra_args["cursor"] = cursor
+        result = await async_slack_call(
+            async_slack_client.conversations_replies,
+            channel=channel,
+            ts=thread_ts,
+            **extra_args,
+        )
+        thread_history.extend(result.get("messages", []))
+        cursor = (result.get("response_metadata") or {}).get("next_cursor")
+        if not result.get("has_more") or not cursor:
+            return thread_history
+
+
+async def build_thread_contents_async(channel, thread_ts):
+    # main.build_thread_contents, fetching slack messages and files without blocking
+    state = main.thread_states.get(channel, thread_ts)
+    with stage("thread_replies"):
+        thread_history = await get_message_thread_async(
+            channel, thread_ts, oldest=state.last_ts
+        )
+    new_messages = [m for m in thread_history if state.is_new(m["ts"])]
+    with stage("attachments"):
+        thread_files = await main.attachment_fetcher.fetch_all_async(
+            get_async_http_client(),
+            [
+                thread_file
+                for thread_message in new_messages
+                for thread_file in thread_message.get("files", [])
+            ],
+        )
+    with stage("build_contents"):
+        # no awaits while holding the lock
+        with state.lock:
+            main.add_thread_messages(state, new_messages, thread_files)
+        # folding old turns into a summary is rare and uses the sync model call
+        return await asyncio.to_thread(
+            main.fit_thread_contents, channel, thread_ts, state
+        )
+
+
+async def greet_async(message):
+    # the pool only calls gemini when it needs refilling
+    greeting = await asyncio.to_thread(main.greeting_text)
+    with stage("post"):
+        await async_slack_client.chat_postMessage(
+            channel=message["channel"],
+            text=f".. <@{message['user']}> {greeting}",
+            mrkdwn=True,
+            thread_ts=message["ts"],
+        )
+    main.remember_bot_thread(message["channel"], message["ts"])
+
+
+async def thread_reply_async(message):
+    with stage("thread_lookup"):
+        in_thread = await bot_in_thread_async(message["channel"], message["thread_ts"])
+    if not in_thread:
+        logger.debug("THIS ISN'T A THREAD FOR US")
+        return
+    thread_messages = await build_thread_contents_async(
+        message["channel"], message["thread_ts"]
+    )
+    if main.retrieval_index is not None and message.get("text"):
+        # history fetches and embedding calls are sync, off the loop
+        history = await asyncio.to_thread(
+            main.relevant_history,
+            message["channel"],
+            message["thread_ts"],
+            message["text"],
+        )
+        if history:
+            thread_messages = main.with_context(thread_messages, history)
+    if main.STREAM_REPLIES:
+        with stage("stream_reply"):
+            chunks = await main.model_router.stream_async(
+                "reply",
+                contents=thread_messages,
+                generation_config=main.generation_config,
+            )
+            await AsyncStreamingReply(
+                async_slack_client,
+                channel=message["channel"],
+                thread_ts=message["ts"],
+                format_text=main.slack_markdown,
+                min_interval=main.STREAM_UPDATE_INTERVAL,
+            ).run(counted_stream_async(chunks))
+    else:
+        with stage("model"):
+            vertext_response = await main.model_router.generate_async(
+                "reply",
+                contents=thread_messages,
+                generation_config=main.generation_config,
+            )
+        record_usage(vertext_response)
+        ai_response = vertext_response.text or "Hrm.. dunno how to respond"
+        with stage("post"):
+            await async_slack_client.chat_postMessage(
+                channel=message["channel"],
+                blocks=markdown_blocks(main.slack_markdown(ai_response)),
+                thread_ts=message["ts"],
+            )
+    main.remember_bot_thread(message["channel"], message["thread_ts"])
+
+
+async def admit_message_async(message):
+    # main.admit_message on the event loop
+    user = message.get("user") or message.get("user_id")
+    channel = message.get("channel") or message.get("channel_id")
+    reason = await admission.admit(message.get("entrypoint"), user, channel)
+    notice = main.busy_notice(message, reason) if reason else None
+    if notice:
+        try:
+            await async_slack_client.chat_postEphemeral(**notice)
+        except Exception as e:
+            logger.error(f"Error posting busy notice: {e}")
+    return reason
+
+
+async def handle_slack_message_async(message):
+    # same entrypoint dispatch as main.handle_slack_message
+    logger.debug(f"handle_slack_message_async received: {message}")
+    try:
+        # per user/channel limits and the model cap, summaries included
+        with stage("admission", entrypoint=message.get("entrypoint")):
+            reason = await admit_message_async(message)
+        if reason:
+            return
+        try:
+            if message["entrypoint"] == "greetings" and "thread_ts" not in message:
+                with request(message["entrypoint"]):
+                    await greet_async(message)
+            elif message["entrypoint"] == "thread_reply" and "thread_ts" in message:
+                with request(message["entrypoint"]):
+                    await thread_reply_async(message)
+            else:
+                async with sync_slots:
+                    await asyncio.to_thread(main.handle_slack_message, message)
+        finally:
+            admission.release()
+    except Exception as e:
+        logger.error(f"Error posting message: {e}")
+
+
+# this worker's admission, in place of main's
+metrics_registry.gauge(
+    "slackbot_admission_active",
+    "Requests holding a model slot.",
+    lambda: admission.active,
+)
+metrics_registry.gauge(
+    "slackbot_admission_shed_total",
+    "Requests turned away by admission control.",
+    lambda: admission.shed,
+    metric_type="counter",
+)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+
+async def respond(send, status, body=b"", content_type=b"text/plain"):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def close():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await close()
+            main.clients.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/" and scope["method"] == "GET":
+        # a simple hello to help debug cloud run url access
+        name = os.environ.get("NAME", "World")
+        return await respond(send, 200, "HELLO {}!".format(name).encode("utf-8"))
+
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        return await respond(
+            send,
+            200,
+            metrics_registry.render().encode("utf-8"),
+            content_type=METRICS_CONTENT_TYPE.encode("utf-8"),
+        )
+
+    if scope["path"] == "/" and scope["method"] == "POST":
+        body = await read_body(receive)
+        try:
+            envelope = json.loads(body)
+        except Exception as e:
+            logger.error(f"pubsub envelope error: {e}")
+            envelope = {}
+        message_dict = main.decode_pubsub_envelope(envelope)
+        if message_dict is not None and main.first_delivery(envelope, message_dict):
+            await handle_slack_message_async(message_dict)
+        # let pubsub know we are done with this message
+        return await respond(send, 204)
+
+    return await respond(send, 404)
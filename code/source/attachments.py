@@ -0,0 +1,230 @@
+import logging
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import DOWNLOAD_BYTES
+
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class ByteBudget:
+    """
+    Bytes left for one thread's files, drawn on by its downloads as the
+    bytes arrive so concurrent downloads can't overrun it together.
+    """
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        with self._lock:
+            if size > self.remaining:
+                return False
+            self.remaining -= size
+            return True
+
+    def give_back(self, size):
+        with self._lock:
+            self.remaining += size
+
+
+class AttachmentCache:
+    """
+    Content addressed LRU cache of downloaded slack files. Slack file ids
+    map to a sha256 digest so identical uploads share one copy, and the
+    least recently used bodies are evicted past max_bytes.
+    """
+
+    def __init__(self, max_bytes=100 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._blobs = OrderedDict()
+
+    def get(self, file_id):
+        with self._lock:
+            digest = self._ids.get(file_id)
+            if digest is None or digest not in self._blobs:
+                return None
+            self._blobs.move_to_end(digest)
+            return self._blobs[digest]
+
+    def put(self, file_id, data):
+        if len(data) > self.max_bytes:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._ids[file_id] = digest
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+                return
+            self._blobs[digest] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                evicted_digest, evicted = self._blobs.popitem(last=False)
+                self.size -= len(evicted)
+                for evicted_id in [
+                    k for k, v in self._ids.items() if v == evicted_digest
+                ]:
+                    del self._ids[evicted_id]
+
+
+class AttachmentFetcher:
+    """
+    Downloads slack thread files through a bounded pool, enforcing per file
+    and per thread byte caps on the bytes actually received, since slack's
+    declared sizes can be missing or wrong.
+    """
+
+    def __init__(
+        self,
+        get_session,
+        max_workers=4,
+        max_file_bytes=20 * 1024 * 1024,
+        max_thread_bytes=50 * 1024 * 1024,
+        cache=None,
+        timeout=30,
+    ):
+        self.get_session = get_session
+        self.max_file_bytes = max_file_bytes
+        self.max_thread_bytes = max_thread_bytes
+        self.cache = cache if cache is not None else AttachmentCache()
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="attachments"
+        )
+
+    def _receive(self, name, chunks, chunk, budget):
+        # add a chunk of the body, within the file cap and the thread's budget
+        received = sum(map(len, chunks)) + len(chunk)
+        if received > self.max_file_bytes:
+            raise AttachmentTooLarge(name)
+        if budget is not None and not budget.take(len(chunk)):
+            raise AttachmentTooLarge(f"{name}, thread byte cap reached")
+        chunks.append(chunk)
+
+    def download(self, thread_file, budget=None):
+        # the file's bytes, budget is the thread's ByteBudget if any
+        name = thread_file.get("name", thread_file["id"])
+        if thread_file.get("size", 0) > self.max_file_bytes:
+            raise AttachmentTooLarge(name)
+        chunks = []
+        try:
+            with self.get_session().get(
+                thread_file["url_private"], stream=True, timeout=self.timeout
+            ) as r:
+                r.raise_for_status()
+                if int(r.headers.get("Content-Length") or 0) > self.max_file_bytes:
+                    raise AttachmentTooLarge(name)
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    self._receive(name, chunks, chunk, budget)
+        except BaseException:
+            # a file we don't keep doesn't count against the thread
+            if budget is not None:
+                budget.give_back(sum(map(len, chunks)))
+            raise
+        return b"".join(chunks)
+
+    async def download_async(self, client, thread_file, budget=None):
+        # download() for an httpx.AsyncClient
+        name = thread_file.get("name", thread_file["id"])
+        if thread_file.get("size", 0) > self.max_file_bytes:
+            raise AttachmentTooLarge(name)
+        chunks = []
+        try:
+            async with client.stream(
+                "GET", thread_file["url_private"], timeout=self.timeout
+            ) as r:
+                r.raise_for_status()
+                if int(r.headers.get("Content-Length") or 0) > self.max_file_bytes:
+                    raise AttachmentTooLarge(name)
+                async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                    self._receive(name, chunks, chunk, budget)
+        except BaseException:
+            if budget is not None:
+                budget.give_back(sum(map(len, chunks)))
+            raise
+        return b"".join(chunks)
+
+    def _plan(self, thread_files):
+        # split files into cached ones and ones to download, within the thread
+        # cap, and the budget the downloads draw on as their bytes arrive
+        fetched = {}
+        pending = []
+        seen = set()
+        budget = ByteBudget(self.max_thread_bytes)
+        for thread_file in thread_files:
+            file_id = thread_file["id"]
+            if file_id in seen:
+                continue
+            seen.add(file_id)
+            data = self.cache.get(file_id)
+            if data is not None:
+                if not budget.take(len(data)):
+                    logger.info(f"skipping file {file_id}, thread byte cap reached")
+                    continue
+                fetched[file_id] = data
+            elif thread_file.get("size", 0) > budget.remaining:
+                # slack's declared size only rules out what can't fit
+                logger.info(f"skipping file {file_id}, thread byte cap reached")
+            else:
+                pending.append(thread_file)
+        return fetched, pending, budget
+
+    async def fetch_all_async(self, client, thread_files):
+        # fetch_all() on the event loop, at most max_workers downloads at once
+        fetched, pending, budget = self._plan(thread_files)
+        slots = asyncio.Semaphore(self.max_workers)
+
+        async def bounded(thread_file):
+            async with slots:
+                return await self.download_async(client, thread_file, budget)
+
+        results = await asyncio.gather(
+            *(bounded(thread_file) for thread_file in pending), return_exceptions=True
+        )
+        for thread_file, data in zip(pending, results):
+            if isinstance(data, BaseException):
+                logger.error(f"Error downloading file {thread_file['id']}: {data}")
+                continue
+            fetched[thread_file["id"]] = data
+            DOWNLOAD_BYTES.inc(len(data))
+            self.cache.put(thread_file["id"], data)
+        return fetched
+
+    def fetch_all(self, thread_files):
+        """
+        Returns a dict of slack file id to bytes for every file that could be
+        fetched within the caps, skipped files are left out.
+        """
+        fetched, to_download, budget = self._plan(thread_files)
+        pending = {
+            thread_file["id"]: self.executor.submit(self.download, thread_file, budget)
+            for thread_file in to_download
+        }
+
+        for file_id, future in pending.items():
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.error(f"Error downloading file {file_id}: {e}")
+                continue
+            fetched[file_id] = data
+            DOWNLOAD_BYTES.inc(len(data))
+            self.cache.put(file_id, data)
+        return fetched
+
+    def close(self):
+        self.executor.shutdown(wait=False)
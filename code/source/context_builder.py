@@ -0,0 +1,86 @@
+import hashlib
+from utils import TTLCache
+
+
+# gemini bills a fixed number of tokens per image/file part
+FILE_PART_TOKENS = 258
+
+
+def estimate_tokens(text):
+    # rough estimate, gemini averages ~4 characters per token
+    return len(text) // 4 + 1
+
+
+def _digest(ids):
+    return hashlib.sha256("\n".join(str(i) for i in ids).encode("utf-8")).hexdigest()
+
+
+class ContextBuilder:
+    """
+    Keeps the newest items (thread turns or transcript lines) under a token
+    budget and folds everything older into a rolling summary.
+
+    Summaries are cached per key along with how many items they cover, so
+    as a thread grows only the newly folded items are summarized. Folding
+    goes down to low_water of the budget so the next few turns fit without
+    another summary call.
+    """
+
+    def __init__(
+        self,
+        budget_tokens=32000,
+        summary_tokens=1024,
+        chunk_tokens=16000,
+        low_water=0.75,
+        cache=None,
+    ):
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.chunk_tokens = chunk_tokens
+        self.low_water = low_water
+        self.cache = cache if cache is not None else TTLCache(max_size=1000, ttl=21600)
+
+    def fit(self, key, items, tokens, ids, fold):
+        """
+        Returns (summary, recent_items). summary is None when everything fits.
+        fold(previous_summary, items) returns a new summary string.
+        """
+        if sum(tokens) <= self.budget_tokens:
+            return None, items
+
+        folded, summary = 0, None
+        cached = self.cache.get(key)
+        if cached and cached[0] < len(items) and cached[1] == _digest(ids[: cached[0]]):
+            folded, summary = cached[0], cached[2]
+
+        recent_budget = self.budget_tokens - self.summary_tokens
+        if sum(tokens[folded:]) > recent_budget:
+            # walk back from the newest item to the low water mark
+            target = recent_budget * self.low_water
+            cut = len(items)
+            running = 0
+            while cut > folded and running + tokens[cut - 1] <= target:
+                cut -= 1
+                running += tokens[cut]
+            # always keep the newest item
+            cut = min(cut, len(items) - 1)
+            summary = self._fold(summary, items[folded:cut], tokens[folded:cut], fold)
+            folded = cut
+            self.cache.set(key, (folded, _digest(ids[:folded]), summary))
+
+        return summary, items[folded:]
+
+    def _fold(self, summary, items, tokens, fold):
+        # roll the summary forward a chunk at a time so no call exceeds the budget
+        chunk = []
+        chunk_tokens = 0
+        for item, item_tokens in zip(items, tokens):
+            if chunk and chunk_tokens + item_tokens > self.chunk_tokens:
+                summary = fold(summary, chunk)
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(item)
+            chunk_tokens += item_tokens
+        if chunk:
+            summary = fold(summary, chunk)
+        return summary
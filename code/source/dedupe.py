@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from utils import TTLCache
+
+
+logger = logging.getLogger()
+
+
+class RedisDedupeBackend:
+    """
+    Any redis compatible client that supports set(key, value, nx=True, ex=seconds),
+    so instances agree on who handles a message.
+    """
+
+    def __init__(self, client, prefix="slackbot:seen:"):
+        self.client = client
+        self.prefix = prefix
+
+    def claim(self, key, ttl):
+        # True if nobody had claimed key yet
+        return bool(self.client.set(self.prefix + key, 1, nx=True, ex=int(ttl)))
+
+    def release(self, keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+class DedupeStore:
+    """
+    Remembers the slack events and pubsub deliveries already handled.
+
+    Slack retries events it thinks weren't acked in time and pubsub
+    redelivers pushes that ran past the ack deadline, either way the same
+    message would be answered twice. claim() records a message's keys in a
+    bounded local LRU and, if configured, a shared backend, and returns False
+    when any of them was seen before.
+    """
+
+    def __init__(
+        self, backend=None, ttl=6 * 60 * 60, max_size=20000, clock=time.monotonic
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.seen = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+        self._lock = threading.Lock()
+
+    def claim(self, keys):
+        keys = [key for key in keys if key]
+        with self._lock:
+            if any(self.seen.get(key) for key in keys):
+                return False
+            for key in keys:
+                self.seen.set(key, True)
+        if self.backend is None:
+            return True
+        try:
+            # claim every key, a retry may share only some with the original
+            claimed = [self.backend.claim(key, self.ttl) for key in keys]
+        except Exception as e:
+            # better a rare duplicate than a dropped message
+            logger.error(f"dedupe backend error: {e}")
+            return True
+        return all(claimed)
+
+    def release(self, keys):
+        keys = [key for key in keys if key]
+        with self._lock:
+            for key in keys:
+                self.seen.pop(key)
+        if self.backend is None:
+            return
+        try:
+            self.backend.release(keys)
+        except Exception as e:
+            # the redelivery will be skipped as a duplicate
+            logger.error(f"dedupe backend error: {e}")
+
+
+def message_keys(message, pubsub_message_id=None):
+    # the ids that identify one slack message for one entrypoint
+    entrypoint = message.get("entrypoint", "")
+    keys = []
+    if pubsub_message_id:
+        keys.append(f"pubsub:{pubsub_message_id}")
+    if message.get("event_id"):
+        keys.append(f"{entrypoint}:event:{message['event_id']}")
+    if message.get("client_msg_id"):
+        keys.append(f"{entrypoint}:msg:{message['client_msg_id']}")
+    if message.get("trigger_id"):
+        # slash commands
+        keys.append(f"{entrypoint}:trigger:{message['trigger_id']}")
+    elif message.get("ts"):
+        # reactions on the same message by different people are separate requests
+        keys.append(
+            f"{entrypoint}:ts:{message.get('channel')}:{message['ts']}"
+            f":{message.get('user')}:{message.get('event_ts', '')}"
+        )
+    return keys
+
+
+def dedupe_store_from_env(ttl, max_size):
+    # DEDUPE_BACKEND is memory (default) or redis
+    backend_name = os.environ.get("DEDUPE_BACKEND", "memory").lower()
+    backend = None
+    try:
+        if backend_name == "redis":
+            import redis
+
+            backend = RedisDedupeBackend(
+                redis.Redis.from_url(
+                    os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+                )
+            )
+    except Exception as e:
+        logger.error(f"dedupe backend {backend_name} unavailable: {e}")
+    return DedupeStore(backend=backend, ttl=ttl, max_size=max_size)
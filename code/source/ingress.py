@@ -0,0 +1,314 @@
+import logging
+import atexit
+import functools
+import os
+from slack_bolt import App
+from slack_bolt.adapter.flask import SlackRequestHandler
+from flask import Flask, request
+from utils import get_secrets, ClientRegistry
+from thread_index import thread_index_from_env
+from publisher import MessagePublisher
+from metrics import (
+    stage,
+    instrument_slack_client,
+    registry as metrics_registry,
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+)
+
+# the slack facing half of the bot: verifies slack's signature, acks within
+# slack's 3 seconds and publishes the message to pubsub for the worker (main.py)
+# run on its own with
+#   gunicorn ingress:flask_app
+# it must not import vertexai, numpy or anything else only the worker needs,
+# main imports it so a single service can still serve both
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+PROJECT_ID = os.environ.get("PROJECT_ID", "")
+# just the ID not the projects/project-id replace if exists
+PROJECT_ID = PROJECT_ID.replace("projects/", "")
+
+# how long we remember whether we are part of a thread
+THREAD_CACHE_SIZE = int(os.environ.get("THREAD_CACHE_SIZE", "10000"))
+THREAD_CACHE_TTL = int(os.environ.get("THREAD_CACHE_TTL", str(6 * 60 * 60)))
+# threads we aren't in are rechecked sooner in case we joined elsewhere
+THREAD_CACHE_NEGATIVE_TTL = int(os.environ.get("THREAD_CACHE_NEGATIVE_TTL", "120"))
+# pubsub publishing from ingress, batches go out when any limit is hit
+PUBSUB_BATCH_MAX_MESSAGES = int(os.environ.get("PUBSUB_BATCH_MAX_MESSAGES", "100"))
+PUBSUB_BATCH_MAX_BYTES = int(os.environ.get("PUBSUB_BATCH_MAX_BYTES", "1000000"))
+PUBSUB_BATCH_MAX_LATENCY = float(os.environ.get("PUBSUB_BATCH_MAX_LATENCY", "0.01"))
+PUBSUB_MAX_IN_FLIGHT = int(os.environ.get("PUBSUB_MAX_IN_FLIGHT", "1000"))
+# messages at least this big are deflated, unset to never compress
+PUBSUB_COMPRESS_MIN_BYTES = os.environ.get("PUBSUB_COMPRESS_MIN_BYTES")
+
+
+# we may use the slack_token later for file retrieval
+# SLACK_BOT_TOKEN / SLACK_SIGNING_SECRET override secret manager for local runs
+secret_names = {
+    "SLACK_BOT_TOKEN": os.environ.get("SLACK_BOT_TOKEN_NAME", "slack_bot_token"),
+    "SLACK_SIGNING_SECRET": os.environ.get(
+        "SLACK_SIGNING_SECRET_NAME", "slack_signing_secret"
+    ),
+}
+# whatever isn't in the environment is fetched concurrently
+missing_secrets = [env for env in secret_names if not os.environ.get(env)]
+secrets = dict(
+    zip(
+        missing_secrets,
+        get_secrets(PROJECT_ID, [secret_names[env] for env in missing_secrets]),
+    )
+)
+slack_token = os.environ.get("SLACK_BOT_TOKEN") or secrets["SLACK_BOT_TOKEN"]
+slack_signing_secret = (
+    os.environ.get("SLACK_SIGNING_SECRET") or secrets["SLACK_SIGNING_SECRET"]
+)
+# bolt calls auth.test on startup, can be turned off for local runs
+SLACK_TOKEN_VERIFICATION = (
+    os.environ.get("SLACK_TOKEN_VERIFICATION", "true").lower() == "true"
+)
+# initialize slack
+# process_before_response must be True when running on cloud functions, must be false for cloud run
+# no ssl check needed, no way to deploy cloud run without it
+slack_app = App(
+    process_before_response=False,
+    ssl_check_enabled=False,
+    token=slack_token,
+    signing_secret=slack_signing_secret,
+    token_verification_enabled=SLACK_TOKEN_VERIFICATION,
+)
+
+slack_client = instrument_slack_client(slack_app.client)
+
+# shared clients, built once per worker rather than once per message
+clients = ClientRegistry()
+
+
+def get_publisher():
+    def build_publisher():
+        from google.cloud import pubsub_v1
+
+        return pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(
+                max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+                max_bytes=PUBSUB_BATCH_MAX_BYTES,
+                max_latency=PUBSUB_BATCH_MAX_LATENCY,
+            )
+        )
+
+    return clients.get("publisher", build_publisher, closer=lambda p: p.stop())
+
+
+message_publisher = MessagePublisher(
+    get_publisher,
+    f"projects/{PROJECT_ID}/topics/slack-messages",
+    max_in_flight=PUBSUB_MAX_IN_FLIGHT,
+    compress_min_bytes=(
+        int(PUBSUB_COMPRESS_MIN_BYTES) if PUBSUB_COMPRESS_MIN_BYTES else None
+    ),
+)
+
+# publishing is the one thing every ack does, connect before the first one
+if os.environ.get("WARM_CLIENTS", "true").lower() == "true":
+    try:
+        get_publisher()
+    except Exception as e:
+        logger.error(f"client warm up error: {e}")
+# flush pending publishes and close connections when the process exits
+atexit.register(clients.close)
+
+
+# threads the bot is part of, optionally shared across instances
+# so ingress can drop replies in other threads before publishing
+thread_index = thread_index_from_env(
+    ttl=THREAD_CACHE_TTL,
+    negative_ttl=THREAD_CACHE_NEGATIVE_TTL,
+    max_size=THREAD_CACHE_SIZE,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_bot_user_id():
+    # our identity doesn't change for the life of the process
+    return slack_client.auth_test()["user_id"]
+
+
+def remember_bot_thread(channel, thread_ts):
+    # we posted into this thread, future replies are for us
+    thread_index.add(channel, thread_ts)
+
+
+def bot_in_thread(channel, thread_ts):
+    # check if we are in the thread so we don't reply to random threads
+    in_thread = thread_index.lookup(channel, thread_ts)
+    if in_thread is not None:
+        return in_thread
+
+    # see if this thread involves us
+    # search the history based on this thread timestamp
+    slack_result = slack_client.conversations_history(
+        channel=channel,
+        oldest=thread_ts,
+        inclusive=True,
+        limit=1,
+    )
+    logger.debug("HERE IS THE THREAD LEAD IN")
+    logger.debug(slack_result)
+    in_thread = bool(
+        slack_result
+        and slack_result.get("messages")
+        and get_bot_user_id() in slack_result["messages"][0].get("reply_users", [])
+    )
+    if in_thread:
+        thread_index.add(channel, thread_ts)
+    else:
+        thread_index.add_negative(channel, thread_ts)
+    return in_thread
+
+
+def send_pubsub_message(message):
+    # send a slack message to our pubsub topic
+    # only the fields the worker reads are sent, publish results are counted
+    try:
+        with stage("publish", entrypoint=message.get("entrypoint")):
+            message_publisher.publish(message)
+    except Exception as e:
+        logger.error(f"pubsub message error: {e}")
+
+
+def ack_message(ack):
+    # lazy listener, ack response
+    ack(f"on it")
+
+
+def with_event_id(message, body):
+    # slack retries an event with the same event_id, the worker dedupes on it
+    if body and body.get("event_id"):
+        message["event_id"] = body["event_id"]
+    return message
+
+
+def greetings(message, body):
+    message = with_event_id(message, body)
+    message["entrypoint"] = "greetings"
+    logger.debug(message)
+    send_pubsub_message(message)
+
+
+slack_app.message("hello ai|howdy ai|<!here>|hey ai")(ack=ack_message, lazy=[greetings])
+
+
+def thread_reply(message, body):
+    # should be subtype of message_replied, but a bug in events api omits it
+    # so we check for thread_ts
+    logger.debug(f"app.event message received: {message}")
+    if "parent_user_id" in message and "thread_ts" in message:
+        # don't pay for pubsub and a worker wake up on threads that aren't ours
+        try:
+            ours = bot_in_thread(message["channel"], message["thread_ts"])
+        except Exception as e:
+            # let the worker decide
+            logger.error(f"thread lookup error: {e}")
+            ours = True
+        if not ours:
+            logger.debug("not our thread, skipping")
+            return
+        message = with_event_id(message, body)
+        message["entrypoint"] = "thread_reply"
+        logger.debug(message)
+        send_pubsub_message(message)
+
+
+slack_app.event("message")(ack=ack_message, lazy=[thread_reply])
+
+
+def summarize(ack, command, respond):
+    logger.debug(command)
+    command["entrypoint"] = "summarize_channel_request"
+    send_pubsub_message(command)
+    respond("")
+
+
+slack_app.command("/summarize")(ack=ack_message, lazy=[summarize])
+
+
+def reaction_handler(event, body, client, say, context):
+    logger.info(event)
+
+    # we trigger on any emoji named summary, summarize, etc
+    if "summar" not in event["reaction"]:
+        # early exit
+        return
+
+    logger.info("summarize emoji request")
+
+    # start with the event
+    # type: reaction_added, user: slack userid, reaction: emoji name, item_user, event_ts, item (type, channel, ts)
+    message = event
+    channel = event["item"]["channel"]
+    message["channel"] = channel
+    message["ts"] = event["item"]["ts"]
+    message["entrypoint"] = "summarize_thread_request"
+    message = with_event_id(message, body)
+    # send to pubsub, do the rest async
+    send_pubsub_message(message=message)
+
+
+slack_app.event("reaction_added")(ack=ack_message, lazy=[reaction_handler])
+
+flask_app = Flask(__name__)
+
+
+@flask_app.route("/", methods=["GET"])
+def hello_world():
+    # a simple hello to help debug cloud run url access
+    name = os.environ.get("NAME", "World")
+    return "HELLO {}!".format(name)
+
+
+# slack event entry point
+slack_handler = SlackRequestHandler(slack_app)
+
+
+@flask_app.route("/slack/events", methods=["POST"])
+def slack_events():
+    return slack_handler.handle(request)
+
+
+# publisher counters, read when /metrics is scraped
+# (confirm latency is the slackbot_pubsub_publish_seconds histogram)
+metrics_registry.gauge(
+    "slackbot_pubsub_published_total",
+    "Messages published to pubsub.",
+    lambda: message_publisher.stats()["published"],
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_pubsub_failed_total",
+    "Pubsub publishes that failed.",
+    lambda: message_publisher.stats()["failed"],
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_pubsub_dropped_total",
+    "Messages dropped with too many publishes in flight.",
+    lambda: message_publisher.stats()["dropped"],
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_pubsub_bytes_total",
+    "Bytes of message data published to pubsub.",
+    lambda: message_publisher.stats()["bytes"],
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_pubsub_in_flight",
+    "Pubsub publishes waiting on a result.",
+    lambda: message_publisher.stats()["in_flight"],
+)
+
+
+@flask_app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # prometheus scrape endpoint
+    return (metrics_registry.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE})
@@ -1,27 +1,62 @@
 import logging
+import atexit
 import base64
 import os
 import json
-import requests
-from slack_bolt import App
+import functools
 from slack_sdk.errors import SlackApiError
 
-from flask import Flask, request
-from utils import get_secret, get_channel_messages, get_message_thread
-from google.cloud import pubsub_v1
-import vertexai
+from flask import request
+from utils import (
+    parse_lookback_hours,
+    valid_lookback,
+    iter_channel_pages,
+    iter_channel_messages,
+    get_message_thread,
+    get_message_threads,
+    TokenBucket,
+)
+from dedupe import dedupe_store_from_env, message_keys
+from publisher import decode_message
+from model_cache import ResponseCache, GreetingPool
+from admission import AdmissionController
+from model_router import ModelRouter, Route, load_routes, target_name
+from metrics import (
+    stage,
+    timed_request,
+    record_usage,
+    counted_stream,
+    registry as metrics_registry,
+)
+from attachments import AttachmentFetcher, AttachmentCache
+from thread_state import ThreadStateStore
+from context_builder import ContextBuilder, estimate_tokens, FILE_PART_TOKENS
+from summarizer import SummarizationEngine
+from summary_checkpoints import SummaryCheckpoints
+from single_flight import SingleFlight
+from user_directory import UserDirectory
+from streaming import StreamingReply, markdown_blocks, still_streaming
+from message_record import MessageRecord, by_ts
 from datetime import datetime, date, timezone, timedelta
 import time
-from operator import itemgetter
-from fastnumbers import try_float
-
-
-# from vertexai.language_models import TextGenerationModel
-from vertexai.generative_models import GenerativeModel, Part, Content
 
+# the slack app, listeners and pubsub publishing, shared with the ingress service
+from ingress import (
+    PROJECT_ID,
+    slack_token,
+    slack_app,
+    slack_client,
+    clients,
+    message_publisher,
+    thread_index,
+    remember_bot_thread,
+    bot_in_thread,
+    send_pubsub_message,
+    flask_app,
+)
 
-# Flask adapter
-from slack_bolt.adapter.flask import SlackRequestHandler
+# vertexai, pubsub and requests are imported where they are used, importing
+# vertexai alone takes seconds and the slack ingress path never needs it
 
 
 # TODOs
@@ -29,28 +64,307 @@ from slack_bolt.adapter.flask import SlackRequestHandler
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-PROJECT_ID = os.environ.get("PROJECT_ID", "")
-# just the ID not the projects/project-id replace if exists
-PROJECT_ID = PROJECT_ID.replace("projects/", "")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-1.5-pro")
+GEMINI_LOCATION = os.environ.get("GEMINI_LOCATION", "us-central1")
+# for the short calls, the /summarize time frame and greetings
+GEMINI_FAST_MODEL = os.environ.get("GEMINI_FAST_MODEL", "gemini-1.5-flash")
+# json, task name to a route replacing the default, e.g.
+# {"classify": {"targets": ["gemini-1.5-flash@us-east4", "gemini-1.5-flash@us-central1"], "hedge_after": 2, "fastest": true}}
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES")
+# seconds before a /summarize time frame call is raced against the next model
+MODEL_CLASSIFY_HEDGE_AFTER = float(os.environ.get("MODEL_CLASSIFY_HEDGE_AFTER", "3"))
+# a model or region failing more than this share of calls in the window goes last
+MODEL_MAX_ERROR_RATE = float(os.environ.get("MODEL_MAX_ERROR_RATE", "0.5"))
+MODEL_STATS_WINDOW = int(os.environ.get("MODEL_STATS_WINDOW", "300"))
+# threads for hedged calls, a slow call that lost a race holds one until it ends
+MODEL_HEDGE_WORKERS = int(os.environ.get("MODEL_HEDGE_WORKERS", "64"))
+# size of the pooled http session, matches the gunicorn thread count
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+# thread file downloads
+ATTACHMENT_WORKERS = int(os.environ.get("ATTACHMENT_WORKERS", "4"))
+ATTACHMENT_MAX_FILE_BYTES = int(
+    os.environ.get("ATTACHMENT_MAX_FILE_BYTES", str(20 * 1024 * 1024))
+)
+ATTACHMENT_MAX_THREAD_BYTES = int(
+    os.environ.get("ATTACHMENT_MAX_THREAD_BYTES", str(50 * 1024 * 1024))
+)
+ATTACHMENT_CACHE_BYTES = int(
+    os.environ.get("ATTACHMENT_CACHE_BYTES", str(100 * 1024 * 1024))
+)
+# per thread gemini history kept between replies
+THREAD_STATE_MAX_BYTES = int(
+    os.environ.get("THREAD_STATE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+THREAD_STATE_MAX_THREADS = int(os.environ.get("THREAD_STATE_MAX_THREADS", "1000"))
+THREAD_STATE_TTL = int(os.environ.get("THREAD_STATE_TTL", str(6 * 60 * 60)))
+# token budget for what we send gemini, older context is folded into summaries
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "32000"))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "1024"))
+CONTEXT_CHUNK_TOKENS = int(os.environ.get("CONTEXT_CHUNK_TOKENS", "16000"))
+# concurrent thread fetches, conversations.replies is a tier 3 method (50+/min)
+SLACK_THREAD_WORKERS = int(os.environ.get("SLACK_THREAD_WORKERS", "4"))
+SLACK_REPLIES_PER_MINUTE = int(os.environ.get("SLACK_REPLIES_PER_MINUTE", "50"))
+# messages per history/replies page
+SLACK_PAGE_SIZE = int(os.environ.get("SLACK_PAGE_SIZE", "200"))
+# stream thread replies into slack as gemini generates them
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "true").lower() == "true"
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", "1.5"))
+# user id to name cache, optionally persisted between restarts
+USER_DIRECTORY_TTL = int(os.environ.get("USER_DIRECTORY_TTL", str(24 * 60 * 60)))
+USER_DIRECTORY_PATH = os.environ.get("USER_DIRECTORY_PATH")
+# channel summaries
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "4"))
+SUMMARY_THREAD_MIN_TOKENS = int(os.environ.get("SUMMARY_THREAD_MIN_TOKENS", "1000"))
+# partial summaries of past hours kept per channel, 0 turns them off
+SUMMARY_BUCKET_SECONDS = int(os.environ.get("SUMMARY_BUCKET_SECONDS", "3600"))
+SUMMARY_SETTLE_SECONDS = int(os.environ.get("SUMMARY_SETTLE_SECONDS", "900"))
+SUMMARY_CHECKPOINT_CHANNELS = int(os.environ.get("SUMMARY_CHECKPOINT_CHANNELS", "200"))
+SUMMARY_CHECKPOINT_BUCKETS = int(os.environ.get("SUMMARY_CHECKPOINT_BUCKETS", "168"))
+# fair share of the workers and gemini, requests over these are turned away
+ADMISSION_USER_PER_MINUTE = float(os.environ.get("ADMISSION_USER_PER_MINUTE", "10"))
+ADMISSION_USER_BURST = int(os.environ.get("ADMISSION_USER_BURST", "5"))
+ADMISSION_CHANNEL_PER_MINUTE = float(
+    os.environ.get("ADMISSION_CHANNEL_PER_MINUTE", "30")
+)
+ADMISSION_CHANNEL_BURST = int(os.environ.get("ADMISSION_CHANNEL_BURST", "10"))
+# requests working with gemini at once, and how long others wait for a turn
+MODEL_MAX_CONCURRENT = int(os.environ.get("MODEL_MAX_CONCURRENT", "8"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "30"))
+# answers to repeatable prompts (summaries, /summarize time frames)
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", "1000"))
+MODEL_CACHE_TTL = int(os.environ.get("MODEL_CACHE_TTL", str(60 * 60)))
+# welcome messages are generated in batches and reused
+GREETING_POOL_SIZE = int(os.environ.get("GREETING_POOL_SIZE", "20"))
+GREETING_POOL_TTL = int(os.environ.get("GREETING_POOL_TTL", str(6 * 60 * 60)))
+# summaries of the same thread or channel time frame requested together are
+# made once, and handed to requests for this many seconds after
+SUMMARY_COALESCE_TTL = int(os.environ.get("SUMMARY_COALESCE_TTL", "60"))
+# slack events and pubsub deliveries already handled, to skip retries
+DEDUPE_TTL = int(os.environ.get("DEDUPE_TTL", str(6 * 60 * 60)))
+DEDUPE_SIZE = int(os.environ.get("DEDUPE_SIZE", "20000"))
+# search over channel history for thread replies, off by default
+RETRIEVAL_ENABLED = os.environ.get("RETRIEVAL_ENABLED", "false").lower() == "true"
+# vertex, or hash for offline runs
+RETRIEVAL_EMBEDDER = os.environ.get("RETRIEVAL_EMBEDDER", "vertex")
+RETRIEVAL_EMBEDDING_MODEL = os.environ.get(
+    "RETRIEVAL_EMBEDDING_MODEL", "text-embedding-004"
+)
+RETRIEVAL_BATCH_SIZE = int(os.environ.get("RETRIEVAL_BATCH_SIZE", "100"))
+# cloud run's /tmp is memory, point this at a mounted volume for big channels
+RETRIEVAL_PATH = os.environ.get("RETRIEVAL_PATH", "/tmp/retrieval")
+RETRIEVAL_MAX_CHANNELS = int(os.environ.get("RETRIEVAL_MAX_CHANNELS", "100"))
+RETRIEVAL_BACKFILL_DAYS = float(os.environ.get("RETRIEVAL_BACKFILL_DAYS", "30"))
+RETRIEVAL_REFRESH_SECONDS = int(os.environ.get("RETRIEVAL_REFRESH_SECONDS", "60"))
+# background threads fetching and embedding channel history
+RETRIEVAL_INDEX_WORKERS = int(os.environ.get("RETRIEVAL_INDEX_WORKERS", "2"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "8"))
+RETRIEVAL_MIN_SCORE = float(os.environ.get("RETRIEVAL_MIN_SCORE", "0.5"))
+
+
+def get_generation_model(model_name=GEMINI_MODEL, location=GEMINI_LOCATION):
+    def build_model():
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+
+        # vertexai.init sets process wide defaults the model picks up on creation
+        vertexai.init(project=PROJECT_ID, location=location)
+        return GenerativeModel(model_name)
+
+    return clients.get(f"model:{location}:{model_name}", build_model)
+
+
+def get_embedding_model():
+    def build_model():
+        import vertexai
+        from vertexai.language_models import TextEmbeddingModel
 
+        vertexai.init(project=PROJECT_ID, location=GEMINI_LOCATION)
+        return TextEmbeddingModel.from_pretrained(RETRIEVAL_EMBEDDING_MODEL)
 
-# we may use the slack_token later for file retrieval
-slack_token = get_secret(
-    PROJECT_ID, os.environ.get("SLACK_BOT_TOKEN_NAME", "slack_bot_token")
+    return clients.get(f"embedding:{RETRIEVAL_EMBEDDING_MODEL}", build_model)
+
+
+def get_http_session():
+    def build_session():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # keep-alive connections to slack's file servers
+        session = requests.Session()
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE),
+        )
+        session.headers.update({"Authorization": "Bearer %s" % slack_token})
+        return session
+
+    return clients.get("http_session", build_session, closer=lambda s: s.close())
+
+
+def warm_clients():
+    # build the shared clients up front so the first request doesn't pay for it
+    # (ingress warms the publisher)
+    factories = [get_http_session]
+    # the first choice model of every route
+    for target in {route.targets[0] for route in model_router.routes.values()}:
+        factories.append(functools.partial(get_generation_model, *target))
+    for factory in factories:
+        try:
+            factory()
+        except Exception as e:
+            logger.error(f"client warm up error: {e}")
+
+
+attachment_fetcher = AttachmentFetcher(
+    get_http_session,
+    max_workers=ATTACHMENT_WORKERS,
+    max_file_bytes=ATTACHMENT_MAX_FILE_BYTES,
+    max_thread_bytes=ATTACHMENT_MAX_THREAD_BYTES,
+    cache=AttachmentCache(max_bytes=ATTACHMENT_CACHE_BYTES),
 )
-# initialize slack
-# process_before_response must be True when running on cloud functions, must be false for cloud run
-# no ssl check needed, no way to deploy cloud run without it
-slack_app = App(
-    process_before_response=False,
-    ssl_check_enabled=False,
-    token=slack_token,
-    signing_secret=get_secret(
-        PROJECT_ID, os.environ.get("SLACK_SIGNING_SECRET_NAME", "slack_signing_secret")
+atexit.register(attachment_fetcher.close)
+
+context_builder = ContextBuilder(
+    budget_tokens=CONTEXT_TOKEN_BUDGET,
+    summary_tokens=CONTEXT_SUMMARY_TOKENS,
+    chunk_tokens=CONTEXT_CHUNK_TOKENS,
+)
+GREETING_PROMPT = "You are a slack bot. The user has summoned you into a slack thread. Generate a friendly welcome message"
+generation_config = {
+    "temperature": 1,
+    "max_output_tokens": 2048,
+    "top_p": 1.0,
+    "top_k": 20,
+}
+lookback_generation_config = {
+    "temperature": 0.1,
+    "max_output_tokens": 8,
+    "top_p": 1.0,
+    "top_k": 40,
+}
+summary_generation_config = {
+    "temperature": 0.2,
+    "max_output_tokens": CONTEXT_SUMMARY_TOKENS,
+    "top_p": 1.0,
+    "top_k": 20,
+}
+
+slack_replies_limiter = TokenBucket(
+    rate=SLACK_REPLIES_PER_MINUTE / 60, capacity=max(1, SLACK_REPLIES_PER_MINUTE // 5)
+)
+
+user_directory = UserDirectory(
+    slack_client, ttl=USER_DIRECTORY_TTL, path=USER_DIRECTORY_PATH
+)
+atexit.register(user_directory.save)
+
+summarizer = SummarizationEngine(
+    lambda prompt: generate_text(prompt),
+    chunk_tokens=CONTEXT_CHUNK_TOKENS,
+    thread_min_tokens=SUMMARY_THREAD_MIN_TOKENS,
+    max_workers=SUMMARY_WORKERS,
+)
+atexit.register(summarizer.close)
+
+summary_flights = SingleFlight(ttl=SUMMARY_COALESCE_TTL)
+
+summary_checkpoints = None
+if SUMMARY_BUCKET_SECONDS > 0:
+    summary_checkpoints = SummaryCheckpoints(
+        bucket_seconds=SUMMARY_BUCKET_SECONDS,
+        settle_seconds=SUMMARY_SETTLE_SECONDS,
+        max_channels=SUMMARY_CHECKPOINT_CHANNELS,
+        max_buckets=SUMMARY_CHECKPOINT_BUCKETS,
+    )
+
+
+def make_content(role, parts):
+    from vertexai.generative_models import Content
+
+    return Content(role=role, parts=parts)
+
+
+# the model and region for each kind of call, thread replies and summaries
+# on pro, the short ones on flash, each falling back to the other
+pro_target = (GEMINI_MODEL, GEMINI_LOCATION)
+fast_target = (GEMINI_FAST_MODEL, GEMINI_LOCATION)
+model_router = ModelRouter(
+    lambda model_name, location: get_generation_model(model_name, location),
+    load_routes(
+        {
+            "default": Route([pro_target, fast_target]),
+            "reply": Route([pro_target, fast_target]),
+            "summary": Route([pro_target, fast_target]),
+            "classify": Route(
+                [fast_target, pro_target], hedge_after=MODEL_CLASSIFY_HEDGE_AFTER
+            ),
+            "greet": Route([fast_target, pro_target]),
+        },
+        MODEL_ROUTES,
+        GEMINI_LOCATION,
     ),
+    window_seconds=MODEL_STATS_WINDOW,
+    max_error_rate=MODEL_MAX_ERROR_RATE,
+    hedge_workers=MODEL_HEDGE_WORKERS,
+)
+atexit.register(model_router.close)
+
+response_cache = ResponseCache(max_size=MODEL_CACHE_SIZE, ttl=MODEL_CACHE_TTL)
+greeting_pool = GreetingPool(
+    lambda prompt: generate_text(prompt, task="greet"),
+    size=GREETING_POOL_SIZE,
+    ttl=GREETING_POOL_TTL,
+)
+
+admission = AdmissionController(
+    user_rate=ADMISSION_USER_PER_MINUTE / 60,
+    user_burst=ADMISSION_USER_BURST,
+    channel_rate=ADMISSION_CHANNEL_PER_MINUTE / 60,
+    channel_burst=ADMISSION_CHANNEL_BURST,
+    max_concurrent=MODEL_MAX_CONCURRENT,
+    max_wait=ADMISSION_MAX_WAIT,
+)
+# posted to everyone waiting on a summary that couldn't be made
+SUMMARY_FAILED_NOTICE = {
+    "text": "Sorry, I couldn't put that summary together, try again in a minute."
+}
+BUSY_NOTICES = {
+    "user": "You've asked me for a lot in the last few minutes, give me a minute and try again.",
+    "channel": "This channel is keeping me very busy, try again in a minute.",
+    "busy": "I'm swamped right now, try again in a minute.",
+}
+
+thread_states = ThreadStateStore(
+    make_content=make_content,
+    max_bytes=THREAD_STATE_MAX_BYTES,
+    max_threads=THREAD_STATE_MAX_THREADS,
+    ttl=THREAD_STATE_TTL,
 )
 
-slack_client = slack_app.client
+
+if os.environ.get("WARM_CLIENTS", "true").lower() == "true":
+    warm_clients()
+
+
+# messages already handled, optionally shared across instances
+dedupe_store = dedupe_store_from_env(ttl=DEDUPE_TTL, max_size=DEDUPE_SIZE)
+
+retrieval_index = None
+if RETRIEVAL_ENABLED:
+    # numpy is only imported when retrieval is on
+    from retrieval import RetrievalIndex, VertexEmbedder, HashEmbedder
+
+    retrieval_index = RetrievalIndex(
+        (
+            HashEmbedder()
+            if RETRIEVAL_EMBEDDER == "hash"
+            else VertexEmbedder(get_embedding_model, batch_size=RETRIEVAL_BATCH_SIZE)
+        ),
+        RETRIEVAL_PATH,
+        max_channels=RETRIEVAL_MAX_CHANNELS,
+        workers=RETRIEVAL_INDEX_WORKERS,
+    )
+    atexit.register(retrieval_index.close)
 
 
 def slack_markdown(text):
@@ -58,178 +372,625 @@ def slack_markdown(text):
     return text
 
 
-def send_pubsub_message(message):
-    # send a slack message to our pubsub topic
+def message_parts(thread_message, thread_files):
+    # text and any files of one slack message as gemini parts
+    from vertexai.generative_models import Part
+
+    parts = []
+    size = 0
+    tokens = 0
+    if thread_message.get("text"):
+        parts.append(Part.from_text(thread_message["text"]))
+        size += len(thread_message["text"])
+        tokens += estimate_tokens(thread_message["text"])
+    for thread_file in thread_message.get("files", []):
+        file_data = thread_files.get(thread_file["id"])
+        if file_data is None:
+            continue
+        parts.append(Part.from_data(file_data, thread_file["mimetype"]))
+        size += len(file_data)
+        tokens += FILE_PART_TOKENS
+    return parts, size, tokens
+
+
+def with_user_text(contents, text):
+    # add text to the end of the chat keeping user/model turns alternating
+    from vertexai.generative_models import Part, Content
+
+    if contents and contents[-1].role == "user":
+        last = contents[-1]
+        return contents[:-1] + [
+            Content(role="user", parts=list(last.parts) + [Part.from_text(text)])
+        ]
+    return contents + [Content(role="user", parts=[Part.from_text(text)])]
+
+
+def fold_turns(summary, turns):
+    # summarize older thread turns so they can be dropped from the context
+    instruction = "Summarize the conversation so far, keeping any facts, decisions and open questions needed to continue it."
+    if summary:
+        instruction = f"The conversation before this point was summarized as:\n{summary}\n\n{instruction}"
+    with stage("model"):
+        vertext_response = model_router.generate(
+            "summary",
+            contents=with_user_text(turns, instruction),
+            generation_config=summary_generation_config,
+        )
+    record_usage(vertext_response)
+    return vertext_response.text
+
+
+def fold_lines(summary, lines):
+    # summarize older transcript lines so they can be dropped from the prompt
+    prompt = "Summarize the following slack conversation, keeping any facts, decisions and open questions.\n"
+    if summary:
+        prompt += (
+            f"The conversation before this point was summarized as:\n{summary}\n\n"
+        )
+    prompt += "".join(lines)
+    with stage("model"):
+        vertext_response = model_router.generate(
+            "summary", contents=prompt, generation_config=summary_generation_config
+        )
+    record_usage(vertext_response)
+    return vertext_response.text
+
+
+def generate_text(prompt, config=generation_config, task="summary"):
+    # plain text prompts, repeats within MODEL_CACHE_TTL are served from the cache.
+    # answers are cached per model, a fallback's answer is only reused while
+    # the task's preferred model is still failing
+    def generate():
+        with stage("model"):
+            vertext_response, target = model_router.generate_from(
+                task, contents=prompt, generation_config=config
+            )
+        record_usage(vertext_response)
+        logger.debug(f"vertext response: {vertext_response}")
+        return vertext_response.text, target_name(target)
+
+    return response_cache.generate(
+        target_name(model_router.targets(task)[0]), prompt, config, generate
+    )
+
+
+def greeting_text():
+    # one from the pool, or a fresh one if the pool couldn't be filled
+    return greeting_pool.get() or generate_text(GREETING_PROMPT, task="greet")
+
+
+def conversation_line(record):
+    # (ts, "name: text") for a MessageRecord, names come from the shared user directory
+    user_name = user_directory.name_for_record(record)
+    return (record.ts, f"{user_name}: {record.text}\n")
+
+
+def fit_transcript(key, lines, line_ids):
+    # keep the transcript under the token budget, older lines folded into a summary
+    summary, recent = context_builder.fit(
+        key,
+        lines,
+        [estimate_tokens(line) for line in lines],
+        line_ids,
+        fold=fold_lines,
+    )
+    transcript = "".join(recent)
+    if summary:
+        transcript = f"Summary of the earlier conversation:\n{summary}\n\nMost recent messages:\n{transcript}"
+    return transcript
+
+
+def channel_conversation(channel_id, oldest, latest=None):
+    # (channel_lines, thread_lines) of the channel history with all threads
+    # history is streamed a page at a time, only lines and thread ids are kept
+    history = []
+    thread_roots = []
+    try:
+        with stage("channel_history"):
+            for page in iter_channel_pages(
+                slack_client,
+                channel_id,
+                oldest=oldest,
+                latest=latest,
+                page_size=SLACK_PAGE_SIZE,
+            ):
+                # resolve names in bulk if there are many people we don't know yet
+                user_directory.prepare(page)
+                # only the line is kept, the page's dicts are dropped
+                for record in map(MessageRecord.from_slack, page):
+                    ts, line = conversation_line(record)
+                    history.append((ts, line, record.thread_ts))
+                    if record.thread_ts:
+                        thread_roots.append({"thread_ts": record.thread_ts})
+    except SlackApiError as e:
+        # summarize what we could read
+        logger.error(f"Error accessing history: {e}")
+    # get every thread concurrently, within slack's rate limits
+    # as compact records, a busy channel's threads are most of its messages
+    threads = get_message_threads(
+        slack_client,
+        channel_id,
+        thread_roots,
+        rate_limiter=slack_replies_limiter,
+        max_workers=SLACK_THREAD_WORKERS,
+        convert=MessageRecord.from_slack,
+    )
+    user_directory.prepare_users(
+        record.user
+        for thread_records in threads.values()
+        for record in thread_records
+        if record.user
+    )
+    # top level messages, thread roots are summarized with their thread
+    channel_lines = sorted(
+        ((ts, line) for ts, line, thread_ts in history if not threads.get(thread_ts)),
+        key=lambda item: float(item[0]),
+    )
+    thread_lines = {
+        thread_ts: [conversation_line(record) for record in thread_records]
+        for thread_ts, thread_records in threads.items()
+    }
+    return channel_lines, thread_lines
+
+
+def summarize_channel(channel_id, oldest, latest):
+    # summary of the channel from oldest to latest
+    segments = []
+    if summary_checkpoints is not None:
+        segments = summary_checkpoints.plan(channel_id, oldest, latest)
+    if sum(1 for segment in segments if segment[2] is not None) < 2:
+        # an hour or two is read in one go, in parallel chunks if it's a lot
+        conversation = channel_conversation(channel_id, oldest)
+        with stage("summarize"):
+            return summarizer.summarize(channel_id, *conversation)
+
+    # fetch each run of hours we have no checkpoint for at once
+    # and split it back into its hours
+    pieces = []
+    run = []
+    for segment in segments + [None]:
+        if segment is not None and segment[3] is None:
+            run.append(segment)
+            continue
+        if run:
+            channel_lines, thread_lines = channel_conversation(
+                channel_id, run[0][0], run[-1][1]
+            )
+            for start, end, _, _ in run:
+
+                def in_segment(ts):
+                    ts = float(ts)
+                    return start <= ts < end or ts == end == latest
+
+                pieces.append(
+                    (
+                        None,
+                        [line for line in channel_lines if in_segment(line[0])],
+                        {
+                            thread_ts: lines
+                            for thread_ts, lines in thread_lines.items()
+                            if in_segment(thread_ts)
+                        },
+                    )
+                )
+            run = []
+        if segment is not None:
+            pieces.append((segment[3], [], {}))
+
+    with stage("summarize"):
+        summary, segment_partials = summarizer.summarize_segments(channel_id, pieces)
+    for segment, piece, partials in zip(segments, pieces, segment_partials):
+        start, _, bucket, saved = segment
+        if bucket is None or saved is not None or partials is None:
+            continue
+        _, channel_lines, thread_lines = piece
+        latest_ts = max(
+            [ts for ts, _ in channel_lines]
+            + [lines[-1][0] for lines in thread_lines.values() if lines],
+            key=float,
+            default=str(start),
+        )
+        summary_checkpoints.save(channel_id, bucket, latest_ts, partials)
+    return summary
+
+
+def add_thread_messages(state, new_messages, thread_files):
+    # append new slack messages to a thread's gemini turns, hold state.lock
+    for thread_message in new_messages:
+        # another request may have added it while we were fetching
+        if not state.is_new(thread_message["ts"]):
+            continue
+        role = "user"
+        if "bot_id" in thread_message:
+            role = "model"
+            if still_streaming(thread_message):
+                # a reply still being written, fetch it again next time
+                state.stale = True
+        parts, size, tokens = message_parts(thread_message, thread_files)
+        state.add_message(role, parts, thread_message["ts"], size, tokens)
+
+
+def fit_thread_contents(channel, thread_ts, state):
+    # the thread's turns, with the oldest folded into a summary if over budget
+    with state.lock:
+        contents = list(state.contents)
+        tokens = list(state.tokens)
+        turn_ts = list(state.turn_ts)
+    thread_states.account(state)
+
+    # keep the most recent turns under the token budget
+    summary, contents = context_builder.fit(
+        ("thread", channel, thread_ts), contents, tokens, turn_ts, fold=fold_turns
+    )
+    if summary:
+        contents = with_context(
+            contents, f"Summary of the earlier conversation in this thread:\n{summary}"
+        )
+    return contents
+
+
+def with_context(contents, text):
+    # text at the start of the chat, keeping user/model turns alternating
+    from vertexai.generative_models import Part, Content
+
+    context_part = Part.from_text(text)
+    if contents and contents[0].role == "user":
+        return [
+            Content(role="user", parts=[context_part] + list(contents[0].parts))
+        ] + contents[1:]
+    return [Content(role="user", parts=[context_part])] + contents
+
+
+def update_channel_index(channel_id):
+    # index channel history newer than what we have, a backfill the first time
+    oldest = retrieval_index.latest_ts(channel_id)
+    if oldest is None:
+        oldest = time.time() - RETRIEVAL_BACKFILL_DAYS * 24 * 60 * 60
+    # pages come newest first, so a fetch that fails part way isn't indexed
+    # at all, the newer half alone would leave a hole behind latest_ts
+    records = sorted(
+        map(
+            MessageRecord.from_slack,
+            iter_channel_messages(slack_client, channel_id, oldest=oldest),
+        ),
+        key=by_ts,
+    )
+    user_directory.prepare_users(record.user for record in records if record.user)
+    added = retrieval_index.add(
+        channel_id, [conversation_line(record) for record in records if record.text]
+    )
+    logger.debug(f"indexed {added} messages in {channel_id}")
+
+
+def relevant_history(channel_id, thread_ts, question):
+    # earlier channel messages related to the question as context text, or None
+    try:
+        with stage("retrieval"):
+            # indexing runs in the background, this searches what's there now
+            retrieval_index.refresh(
+                channel_id, RETRIEVAL_REFRESH_SECONDS, update_channel_index
+            )
+            hits = retrieval_index.search(
+                channel_id, question, k=RETRIEVAL_TOP_K, min_score=RETRIEVAL_MIN_SCORE
+            )
+    except Exception as e:
+        logger.error(f"Error searching channel history: {e}")
+        return None
+    # the thread's own root is already in the chat
+    lines = [
+        line
+        for _, ts, line in sorted(hits, key=lambda hit: float(hit[1]))
+        if ts != thread_ts
+    ]
+    if not lines:
+        return None
+    return "Earlier messages from this channel that may be relevant:\n" + "".join(lines)
+
+
+def build_thread_contents(channel, thread_ts):
+    # create the ai chat history for gemini
+    # ensuring that multiturn requests alternate between user and model.
+    # adding 'parts' if multiple messages are from either a user or a model
+    # accounting for any files uploaded to the thread
+    # only messages newer than what we've already seen are fetched
+    state = thread_states.get(channel, thread_ts)
+    with state.lock:
+        thread_history = get_message_thread(
+            slack_client=slack_client,
+            channel_id=channel,
+            thread_ts=thread_ts,
+            oldest=state.last_ts,
+        )
+        new_messages = [m for m in thread_history or [] if state.is_new(m["ts"])]
+
+        # fetch every new file in the thread up front, in parallel
+        with stage("attachments"):
+            thread_files = attachment_fetcher.fetch_all(
+                [
+                    thread_file
+                    for thread_message in new_messages
+                    for thread_file in thread_message.get("files", [])
+                ]
+            )
+        with stage("build_contents"):
+            add_thread_messages(state, new_messages, thread_files)
+    with stage("build_contents"):
+        return fit_thread_contents(channel, thread_ts, state)
+
+
+def thread_summary(channel, thread_ts):
+    # the summary of a thread as chat_postEphemeral arguments
+    thread_messages = []
+    if thread_ts:
+        # get the thread messages
+        thread_messages = get_message_thread(
+            slack_client,
+            channel_id=channel,
+            thread_ts=thread_ts,
+        )
+    # anything to summarize?
+    if not len(thread_messages):
+        return {"text": "Sorry, doesn't appear to be any messages to summarize"}
+
+    # compact records in ts order, numerically, not as strings
+    sorted_history = sorted(map(MessageRecord.from_slack, thread_messages), key=by_ts)
+    # the raw dicts aren't needed during the model call
+    thread_messages = None
+    # format thread for ai
+    with stage("build_contents"):
+        user_directory.prepare_users(
+            record.user for record in sorted_history if record.user
+        )
+        conversation_lines = [conversation_line(record)[1] for record in sorted_history]
+        channel_conversation = fit_transcript(
+            ("thread_summary", channel, thread_ts),
+            conversation_lines,
+            [record.ts for record in sorted_history],
+        )
+
+    # Prompt the AI
+    logger.debug(f"CONVERSATION PROMPT: {channel_conversation}")
+    prompt = f"You are a slackbot and have been asked to summarize the following conversation:\n {channel_conversation}"
+    with stage("model"):
+        vertext_response = model_router.generate(
+            "summary", contents=prompt, generation_config=generation_config
+        )
+    record_usage(vertext_response)
+    logger.debug(f"vertext response: {vertext_response}")
+    ai_response = vertext_response.text
+    if not ai_response:
+        ai_response = "Hrm.. dunno how to respond"
+
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": slack_markdown(f"Summary of the thread:\n {ai_response}"),
+            },
+        }
+    ]
+    return {"thread_ts": thread_ts, "blocks": blocks}
+
+
+def summary_lookback(text):
+    # hours to summarize, common time frames don't need gemini
+    lookback = parse_lookback_hours(text)
+    if lookback is not None:
+        return lookback
+    lookback = 1
     try:
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = f"projects/{PROJECT_ID}/topics/slack-messages"
-        # the message we send
-        message_body = json.dumps(message).encode("utf-8")
-        logger.debug(
-            f"message is {type(message)} and message_body is {type(message_body)}"
+        prompt = f"""
+        A person asked you to summarize content for a slack channel. The person invoking you said: 
+
+        'summarize {text} '
+
+        If the person gave you a time frame, what number of hours? 
+        If the person did not give a time frame assume 1 hour. 
+        Answer with only the number.
+        """
+        lookback = float(
+            generate_text(prompt, config=lookback_generation_config, task="classify")
         )
-        _ = publisher.publish(topic_path, message_body)
     except Exception as e:
-        logger.error(f"pubsub message error: {e}")
+        logger.error(f"Error determining lookback period: {e}")
+    if not valid_lookback(lookback):
+        # nan or nonsense from the model
+        lookback = 1
+    return lookback
+
+
+def channel_summary(channel_id, lookback):
+    # the summary of the last lookback hours of a channel as chat_postEphemeral arguments
+    # what's the latest in the channel?
+    with stage("channel_lookup"):
+        slack_result = slack_client.conversations_history(limit=1, channel=channel_id)
+    # anything to summarize?
+    if "messages" not in slack_result.data or not len(slack_result.data["messages"]):
+        return {"text": "Doesn't appear to be any messages to summarize"}
+    # get the latest timestamp
+    latest_timestamp = slack_result.data["messages"][0]["ts"]
+    search_timestamp = datetime.fromtimestamp(float(latest_timestamp)) - timedelta(
+        hours=lookback
+    )
+    # convert to a timestamp
+    search_timestamp = time.mktime(search_timestamp.timetuple())
+    # search the channel, reusing summaries of hours we've already read
+    ai_response = summarize_channel(
+        channel_id, search_timestamp, float(latest_timestamp)
+    )
+    if not ai_response:
+        ai_response = "Hrm.. dunno how to respond"
+    lookback_timeperiod = "hour"
+    if lookback > 1:
+        lookback_timeperiod = "hours"
+
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": slack_markdown(
+                    f"Summary of the last {lookback} {lookback_timeperiod}:\n {ai_response}"
+                ),
+            },
+        }
+    ]
+    return {"blocks": blocks}
+
+
+def coalesced_summary(key, requester, summarize):
+    """
+    Post the ephemeral summarize() makes, chat_postEphemeral arguments, to
+    requester, a (channel, user). Requests for the same key while it runs
+    join it and are posted the same summary by this request, so are ones in
+    the SUMMARY_COALESCE_TTL seconds after. If summarize() fails they are
+    all posted SUMMARY_FAILED_NOTICE instead.
+    """
+    state, post = summary_flights.begin(key, requester)
+    if state == "joined":
+        # the request in progress posts to us too, this worker thread is free
+        logger.info(f"joined the summary in progress for {key}")
+        return
+    requesters = [requester]
+    if state == "lead":
+        post = None
+        try:
+            post = summarize()
+        except Exception as e:
+            logger.error(f"Error summarizing {key}: {e}")
+        finally:
+            requesters = summary_flights.finish(key, post)
+        if post is None:
+            # everyone that joined is told, rather than left waiting
+            post = SUMMARY_FAILED_NOTICE
+    for channel, user in requesters:
+        try:
+            with stage("post"):
+                slack_client.chat_postEphemeral(channel=channel, user=user, **post)
+        except Exception as e:
+            logger.error(f"Error posting summary to {user}: {e}")
+
+
+def busy_notice(message, reason):
+    # chat_postEphemeral kwargs telling the person why their request was shed
+    user = message.get("user") or message.get("user_id")
+    channel = message.get("channel") or message.get("channel_id")
+    if not (user and channel):
+        return None
+    notice = {"channel": channel, "user": user, "text": BUSY_NOTICES[reason]}
+    if "thread_ts" in message:
+        notice["thread_ts"] = message["thread_ts"]
+    return notice
+
+
+def admit_message(message):
+    # None once the message may run, call admission.release() when it's done
+    # otherwise the person is told we're busy and the reason is returned
+    user = message.get("user") or message.get("user_id")
+    channel = message.get("channel") or message.get("channel_id")
+    reason = admission.admit(message.get("entrypoint"), user, channel)
+    notice = busy_notice(message, reason) if reason else None
+    if notice:
+        try:
+            slack_client.chat_postEphemeral(**notice)
+        except Exception as e:
+            logger.error(f"Error posting busy notice: {e}")
+    return reason
+
+
+def handle_admitted_message(message):
+    # handle_slack_message behind per user/channel limits and the model cap
+    with stage("admission", entrypoint=message.get("entrypoint")):
+        reason = admit_message(message)
+    if reason:
+        return
+    try:
+        handle_slack_message(message)
+    finally:
+        admission.release()
 
 
+@timed_request
 def handle_slack_message(message):
     logger.debug(f"handle_slack_message received: {message}")
     try:
-        # init vertexAI wth gemini
-        vertexai.init(project=PROJECT_ID, location="us-central1")
-        generation_model = GenerativeModel("gemini-1.5-pro")
-        generation_config = {
-            "temperature": 1,
-            "max_output_tokens": 2048,
-            "top_p": 1.0,
-            "top_k": 20,
-        }
-
         # if we haven't already started a thread, start one
         if message["entrypoint"] == "greetings" and "thread_ts" not in message:
-            # get a welcome from AI
-
-            prompt = "You are a slack bot. The user has summoned you into a slack thread. Generate a friendly welcome message"
-            vertext_response = generation_model.generate_content(
-                contents=prompt, generation_config=generation_config
-            )
-            logger.debug(f"vertext response: {vertext_response}")
-
-            slack_result = slack_client.chat_postMessage(
-                channel=message["channel"],
-                text=f".. <@{message['user']}> {vertext_response.text}",
-                mrkdwn=True,
-                thread_ts=message["ts"],
-            )
+            # get a welcome from AI, pre-generated in batches
+            greeting = greeting_text()
+            with stage("post"):
+                slack_result = slack_client.chat_postMessage(
+                    channel=message["channel"],
+                    text=f".. <@{message['user']}> {greeting}",
+                    mrkdwn=True,
+                    thread_ts=message["ts"],
+                )
             logger.debug(slack_result)
+            remember_bot_thread(message["channel"], message["ts"])
         # is it an existing thread
         if message["entrypoint"] == "thread_reply" and "thread_ts" in message:
-            # check if we are in the thread so we don't reply to random threads
-            reply_with_ai = False
-            slack_identity = slack_client.auth_test()
-            SLACK_USER_ID = slack_identity["user_id"]
-            # see if this thread involves us
-            # search the history based on this thread timestamp
-            slack_result = slack_client.conversations_history(
-                channel=message["channel"],
-                oldest=message["thread_ts"],
-                inclusive=True,
-                limit=1,
-            )
-            logger.debug("HERE IS THE THREAD LEAD IN")
-            logger.debug(slack_result)
-
-            if (
-                slack_result
-                and "messages" in slack_result
-                and SLACK_USER_ID in slack_result["messages"][0]["reply_users"]
-            ):
+            with stage("thread_lookup"):
+                reply_with_ai = bot_in_thread(message["channel"], message["thread_ts"])
+            if reply_with_ai:
                 logger.debug("WE ARE IN THE THREAD")
-                reply_with_ai = True
             else:
                 logger.debug("THIS ISN'T A THREAD FOR US")
             if reply_with_ai:
-                # get the thread history to send to the ai as context
-                thread_history = get_message_thread(
-                    slack_client=slack_client,
-                    channel_id=message["channel"],
-                    thread_ts=message["thread_ts"],
+                # the gemini chat history for the thread, built incrementally
+                thread_messages = build_thread_contents(
+                    message["channel"], message["thread_ts"]
                 )
+                if retrieval_index is not None and message.get("text"):
+                    # what the channel said about it before, not just this thread
+                    history = relevant_history(
+                        message["channel"], message["thread_ts"], message["text"]
+                    )
+                    if history:
+                        thread_messages = with_context(thread_messages, history)
+                logger.debug(thread_messages)
 
-                prompt = f"You are a slack bot in a thread with a person. Please respond kindly to this prompt using slack markdown formatting: \n {message['text']}"
-                # vertext_response = generation_model.predict(
-                #     prompt=prompt, temperature=1, max_output_tokens=2048
-                # )
-                # create the ai chat history for gemini
-                # ensuring that multiturn requests alternate between user and model.
-                # adding 'parts' if multiple messages are from either a user or a model
-                # accounting for any files uploaded to the thread
-
-                thread_messages = []
-                for thread_message in thread_history:
-                    role = "user"
-                    if "bot_id" in thread_message:
-                        role = "model"
-                    # was the last message the same role? Append a new part
-                    if (
-                        thread_messages
-                        and thread_messages[(len(thread_messages) - 1)].role == role
-                    ):
-                        # append this as another part
-                        # the native objects in Content are read only, so we serialize to manipulate
-                        d_message = thread_messages[len(thread_messages) - 1].to_dict()
-                        if thread_message["text"]:
-                            d_message["parts"].append({"text": thread_message["text"]})
-
-                        # files?
-                        if "files" in thread_message:
-                            for thread_file in thread_message["files"]:
-                                r = requests.get(
-                                    thread_file["url_private"],
-                                    headers={
-                                        "Authorization": "Bearer %s" % slack_token
-                                    },
-                                )
-                                file_data = r.content  # get binary content
-                                file_part = Part.from_data(
-                                    file_data, thread_file["mimetype"]
-                                ).to_dict()
-                                d_message["parts"].append(file_part)
-                        thread_messages[len(thread_messages) - 1] = Content.from_dict(
-                            d_message
-                        )
-
-                    else:
-                        # make a new turn in the chat
-                        # we can make and append parts since this is new Content and not read only
-                        chat_parts = []
-                        # text?
-                        if thread_message["text"]:
-                            chat_parts.append(Part.from_text(thread_message["text"]))
-                        # files?
-                        if "files" in thread_message:
-                            for thread_file in thread_message["files"]:
-                                r = requests.get(
-                                    thread_file["url_private"],
-                                    headers={
-                                        "Authorization": "Bearer %s" % slack_token
-                                    },
+                if STREAM_REPLIES:
+                    # post the answer as it's generated
+                    # generation and slack updates overlap, timed as one stage
+                    with stage("stream_reply"):
+                        StreamingReply(
+                            slack_client,
+                            channel=message["channel"],
+                            thread_ts=message["ts"],
+                            format_text=slack_markdown,
+                            min_interval=STREAM_UPDATE_INTERVAL,
+                        ).run(
+                            counted_stream(
+                                model_router.stream(
+                                    "reply",
+                                    contents=thread_messages,
+                                    generation_config=generation_config,
                                 )
-                                file_data = r.content  # get binary content
-                                chat_parts.append(
-                                    Part.from_data(file_data, thread_file["mimetype"])
-                                )
-
-                        thread_messages.append(
-                            Content(
-                                role=role,
-                                parts=chat_parts,
                             )
                         )
-                logger.debug(thread_messages)
-
-                vertext_response = generation_model.generate_content(
-                    contents=thread_messages, generation_config=generation_config
-                )
-                logger.debug(f"vertext response: {vertext_response}")
-                ai_response = vertext_response.text
-
-                if not ai_response:
-                    ai_response = "Hrm.. dunno how to respond"
-
-                blocks = [
-                    {
-                        "type": "section",
-                        "text": {"type": "mrkdwn", "text": slack_markdown(ai_response)},
-                    }
-                ]
-                slack_result = slack_client.chat_postMessage(
-                    channel=message["channel"],
-                    blocks=blocks,
-                    thread_ts=message["ts"],
-                )
-                logger.debug(slack_result)
+                else:
+                    with stage("model"):
+                        vertext_response = model_router.generate(
+                            "reply",
+                            contents=thread_messages,
+                            generation_config=generation_config,
+                        )
+                    record_usage(vertext_response)
+                    logger.debug(f"vertext response: {vertext_response}")
+                    ai_response = vertext_response.text
+
+                    if not ai_response:
+                        ai_response = "Hrm.. dunno how to respond"
+
+                    with stage("post"):
+                        slack_result = slack_client.chat_postMessage(
+                            channel=message["channel"],
+                            blocks=markdown_blocks(slack_markdown(ai_response)),
+                            thread_ts=message["ts"],
+                        )
+                    logger.debug(slack_result)
+                remember_bot_thread(message["channel"], message["thread_ts"])
             return
 
         if message["entrypoint"] == "summarize_thread_request":
@@ -237,77 +998,25 @@ def handle_slack_message(message):
             logger.debug(message)
             # we get the message reacted to, not the thread
             # figure out the thread ts
-            slack_result = slack_client.conversations_replies(
-                channel=message["channel"], ts=message["ts"]
-            )
+            with stage("thread_lookup"):
+                slack_result = slack_client.conversations_replies(
+                    channel=message["channel"], ts=message["ts"]
+                )
             logger.debug("MESSAGE IN CONTEXT OF THREAD")
             logger.debug(slack_result)
-            thread_messages = []
             thread_ts = None
             if "messages" in slack_result:
                 # now we get the thread ts
                 thread_ts = slack_result["messages"][0]["thread_ts"]
-                # get the thread messages
-                thread_messages = get_message_thread(
-                    slack_client,
-                    channel_id=message["channel"],
-                    thread_ts=thread_ts,
-                )
-            # anything to summarize?
-            if not len(thread_messages):
-                slack_client.chat_postEphemeral(
-                    channel=message["channel"],
-                    user=message["user"],
-                    text="Sorry, doesn't appear to be any messages to summarize",
-                )
-                return
-
-            sorted_history = sorted(thread_messages, key=itemgetter("ts"))
-            # format thread for ai
-            channel_conversation = ""
-            # cache of user id to name
-            slack_users = {}
-            for slack_message in sorted_history:
-                # resolve user ids if we don't already know them
-                slack_user_id = slack_message["user"]
-                user_name = ""
-                if slack_user_id not in slack_users:
-                    user_result = slack_client.users_info(user=slack_message["user"])
-                    user_name = user_result["user"]["profile"]["real_name"]
-                    slack_users[slack_user_id] = user_name
-                else:
-                    user_name = slack_users[slack_user_id]
-                channel_conversation += f"{user_name}: {slack_message['text']}\n"
-
-            # Prompt the AI
-            logger.debug(f"CONVERSATION PROMPT: {channel_conversation}")
-            prompt = f"You are a slackbot and have been asked to summarize the following conversation:\n {channel_conversation}"
-            vertext_response = generation_model.generate_content(
-                contents=prompt, generation_config=generation_config
-            )
-            logger.debug(f"vertext response: {vertext_response}")
-            ai_response = vertext_response.text
-            if not ai_response:
-                ai_response = "Hrm.. dunno how to respond"
-
-            blocks = [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": slack_markdown(
-                            f"Summary of the thread:\n {ai_response}"
-                        ),
-                    },
-                }
-            ]
-
-            # return result as an ephemeral message
-            slack_result = slack_client.chat_postEphemeral(
-                channel=message["channel"],
-                user=message["user"],
-                thread_ts=thread_ts,
-                blocks=blocks,
+            # everyone reacting on the thread at once gets the one summary
+            coalesced_summary(
+                (
+                    "summarize_thread_request",
+                    message["channel"],
+                    thread_ts or message["ts"],
+                ),
+                (message["channel"], message["user"]),
+                lambda: thread_summary(message["channel"], thread_ts),
             )
             return
 
@@ -329,199 +1038,75 @@ def handle_slack_message(message):
                     text="I don't seem to have access to the channel to summarize for you, sorry!",
                 )
                 return
-            # what's the latest in the channel?
-            slack_result = slack_client.conversations_history(
-                limit=1, channel=message["channel_id"]
-            )
-            # anything to summarize?
-            if "messages" not in slack_result.data or not len(
-                slack_result.data["messages"]
-            ):
-                slack_client.chat_postEphemeral(
-                    channel=message["channel_id"],
-                    user=message["user_id"],
-                    text="Doesn't appear to be any messages to summarize",
-                )
-                return
-            # get the latest timestamp
-            latest_timestamp = slack_result.data["messages"][0]["ts"]
-            # set the lookback period
-            lookback = 1
-            try:
-                prompt = f"""
-                A person asked you to summarize content for a slack channel. The person invoking you said: 
-
-                'summarize {message['text']} '
-
-                If the person gave you a time frame, what number of hours? 
-                If the person did not give a time frame assume 1 hour. 
-                Answer with only the number.
-                """
-
-                response = generation_model.generate_content(
-                    contents=prompt,
-                    generation_config={
-                        "temperature": 0.1,
-                        "max_output_tokens": 8,
-                        "top_p": 1.0,
-                        "top_k": 40,
-                    },
-                )
-                lookback = try_float(response.text, nan=1, on_fail=1)
-
-            except Exception as e:
-                logger.error(f"Error determining lookback period: {e}")
-
-            search_timestamp = datetime.fromtimestamp(
-                float(latest_timestamp)
-            ) - timedelta(hours=lookback)
-            # convert to a timestamp
-            search_timestamp = time.mktime(search_timestamp.timetuple())
-            # search the channel
-            # get full channel history with all threads
-            channel_id = message["channel_id"]
-            channel_history = get_channel_messages(
-                slack_client, channel_id, oldest=search_timestamp
-            )
-            thread_history = []
-            for history_message in channel_history:
-                if "thread_ts" in history_message:
-                    thread_messages = get_message_thread(
-                        slack_client,
-                        channel_id=channel_id,
-                        thread_ts=history_message["thread_ts"],
-                    )
-                    thread_history.extend(thread_messages)
-            # add the threads
-            channel_history.extend(thread_history)
-            # sort it all by ts
-            sorted_history = sorted(channel_history, key=itemgetter("ts"))
-            # add any threads
-            channel_conversation = ""
-            # cache of user id to name
-            slack_users = {}
-            for slack_message in sorted_history:
-                # resolve user ids if we don't already know them
-                slack_user_id = slack_message["user"]
-                user_name = ""
-                if slack_user_id not in slack_users:
-                    user_result = slack_client.users_info(user=slack_message["user"])
-                    user_name = user_result["user"]["profile"]["real_name"]
-                    slack_users[slack_user_id] = user_name
-                else:
-                    user_name = slack_users[slack_user_id]
-                channel_conversation += f"{user_name}: {slack_message['text']}\n"
-
-            # Prompt the AI
-            prompt = f"You are a slackbot and have been asked to summarize the following conversation:\n {channel_conversation}"
-            vertext_response = generation_model.generate_content(
-                contents=prompt, generation_config=generation_config
-            )
-            logger.debug(f"vertext response: {vertext_response}")
-            ai_response = vertext_response.text
-            if not ai_response:
-                ai_response = "Hrm.. dunno how to respond"
-            lookback_timeperiod = "hour"
-            if lookback > 1:
-                lookback_timeperiod = "hours"
-
-            blocks = [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": slack_markdown(
-                            f"Summary of the last {lookback} {lookback_timeperiod}:\n {ai_response}"
-                        ),
-                    },
-                }
-            ]
-            slack_result = slack_client.chat_postEphemeral(
-                channel=message["channel_id"], user=message["user_id"], blocks=blocks
+            lookback = summary_lookback(message.get("text"))
+            # the same time frame of the same channel is summarized once
+            coalesced_summary(
+                ("summarize_channel_request", message["channel_id"], lookback),
+                (message["channel_id"], message["user_id"]),
+                lambda: channel_summary(message["channel_id"], lookback),
             )
             return
 
     except Exception as e:
         logger.error(f"Error posting message: {e}")
+        # the pull worker nacks the message so it's tried again
+        raise
 
 
-def ack_message(ack):
-    # lazy listener, ack response
-    ack(f"on it")
-
-
-def greetings(message):
-    message["entrypoint"] = "greetings"
-    logger.debug(message)
-    send_pubsub_message(message)
-
-
-slack_app.message("hello ai|howdy ai|<!here>|hey ai")(ack=ack_message, lazy=[greetings])
-
-
-def thread_reply(message):
-    # should be subtype of message_replied, but a bug in events api omits it
-    # so we check for thread_ts
-    logger.debug(f"app.event message received: {message}")
-    if "parent_user_id" in message and "thread_ts" in message:
-        message["entrypoint"] = "thread_reply"
-        logger.debug(message)
-        send_pubsub_message(message)
-
-
-slack_app.event("message")(ack=ack_message, lazy=[thread_reply])
-
-
-def summarize(ack, command, respond):
-    logger.debug(command)
-    command["entrypoint"] = "summarize_channel_request"
-    send_pubsub_message(command)
-    respond("")
-
-
-slack_app.command("/summarize")(ack=ack_message, lazy=[summarize])
-
-
-def reaction_handler(event, client, say, context):
-    logger.info(event)
-
-    # we trigger on any emoji named summary, summarize, etc
-    if "summar" not in event["reaction"]:
-        # early exit
-        return
-
-    logger.info("summarize emoji request")
-
-    # start with the event
-    # type: reaction_added, user: slack userid, reaction: emoji name, item_user, event_ts, item (type, channel, ts)
-    message = event
-    channel = event["item"]["channel"]
-    message["channel"] = channel
-    message["ts"] = event["item"]["ts"]
-    message["entrypoint"] = "summarize_thread_request"
-    # send to pubsub, do the rest async
-    send_pubsub_message(message=message)
-
-
-slack_app.event("reaction_added")(ack=ack_message, lazy=[reaction_handler])
-
-flask_app = Flask(__name__)
+metrics_registry.gauge(
+    "slackbot_admission_active",
+    "Requests holding a model slot.",
+    lambda: admission.active,
+)
+metrics_registry.gauge(
+    "slackbot_admission_shed_total",
+    "Requests turned away by admission control.",
+    lambda: admission.shed,
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_model_cache_hits_total",
+    "Model responses served from the cache.",
+    lambda: response_cache.hits,
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_model_cache_misses_total",
+    "Model responses that needed a model call.",
+    lambda: response_cache.misses,
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_summary_coalesced_total",
+    "Summary requests that joined one already in progress.",
+    lambda: summary_flights.joined,
+    metric_type="counter",
+)
+metrics_registry.gauge(
+    "slackbot_summary_reused_total",
+    "Summary requests answered with a summary made moments before.",
+    lambda: summary_flights.cached,
+    metric_type="counter",
+)
 
 
-@flask_app.route("/", methods=["GET"])
-def hello_world():
-    # a simple hello to help debug cloud run url access
-    name = os.environ.get("NAME", "World")
-    return "HELLO {}!".format(name)
+def delivery_keys(envelope, message):
+    pubsub_message = envelope.get("message") or {}
+    message_id = pubsub_message.get("messageId") or pubsub_message.get("message_id")
+    return message_keys(message, message_id)
 
 
-# slack event entry point
-slack_handler = SlackRequestHandler(slack_app)
+def first_delivery(envelope, message):
+    # False for a slack retry or pubsub redelivery of a message we already took
+    if dedupe_store.claim(delivery_keys(envelope, message)):
+        return True
+    logger.info(f"skipping duplicate {message.get('entrypoint')} message")
+    return False
 
 
-@flask_app.route("/slack/events", methods=["POST"])
-def slack_events():
-    return slack_handler.handle(request)
+def release_delivery(envelope, message):
+    # undo first_delivery for a message that failed, so its redelivery is handled
+    dedupe_store.release(delivery_keys(envelope, message))
 
 
 # pubsub callbacks
@@ -529,6 +1114,24 @@ def slack_events():
 # we ack every request within the limit and queue it in pubsub for the actual response
 
 
+def decode_pubsub_envelope(envelope):
+    # the slack message inside a pubsub push envelope, or None
+    if "message" in envelope and "subscription" in envelope:
+        pubsub_message = envelope["message"]
+
+        if isinstance(pubsub_message, dict) and "data" in pubsub_message:
+            try:
+                message_body = decode_message(
+                    base64.b64decode(pubsub_message["data"]),
+                    pubsub_message.get("attributes"),
+                )
+                logger.debug(f"pubsub message is: {message_body}")
+                return message_body
+            except Exception as e:
+                logger.error(f"pubsub message decode error: {e}")
+    return None
+
+
 @flask_app.route("/", methods=["POST"])
 def default_post_route():
     envelope = {}
@@ -545,20 +1148,13 @@ def default_post_route():
     logger.debug(f"post envelope is {envelope}")
 
     # pubsub message?
-    if "message" in envelope and "subscription" in envelope:
-        pubsub_message = envelope["message"]
-
-        if isinstance(pubsub_message, dict) and "data" in pubsub_message:
-            message_body_string = (
-                base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-            )
-            logger.debug(f"pubsub message is: {message_body_string}")
-            try:
-                message_dict = json.loads(message_body_string)
-                handle_slack_message(message_dict)
-            except Exception as e:
-                logger.error(f"handle_slack_message call error: {e}")
-                pass
+    message_dict = decode_pubsub_envelope(envelope)
+    if message_dict is not None and first_delivery(envelope, message_dict):
+        try:
+            handle_admitted_message(message_dict)
+        except Exception as e:
+            logger.error(f"handle_slack_message call error: {e}")
+            pass
 
     # let pubsub know we are done with this message
     return ("", 204)
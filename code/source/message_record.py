@@ -0,0 +1,50 @@
+from operator import attrgetter
+
+
+class MessageRecord:
+    """
+    The parts of a slack message the summaries read. A message dict from
+    the api carries blocks, attachments, reactions, edit history and bot
+    profiles too, a record is a small fraction of its size, so long channel
+    histories are converted as each page arrives and the dicts dropped.
+
+    sender is the display name for messages without a user (bots, webhooks).
+    """
+
+    __slots__ = ("ts", "ts_key", "user", "sender", "text", "thread_ts")
+
+    def __init__(self, ts, user=None, text="", thread_ts=None, sender=None):
+        self.ts = ts
+        # parsed once, records are sorted and merged on it
+        self.ts_key = float(ts)
+        self.user = user
+        self.sender = sender
+        self.text = text
+        self.thread_ts = thread_ts
+
+    @classmethod
+    def from_slack(cls, message):
+        user = message.get("user")
+        sender = None
+        if not user:
+            bot_profile = message.get("bot_profile") or {}
+            sender = (
+                message.get("username")
+                or bot_profile.get("name")
+                or message.get("bot_id")
+                or "unknown"
+            )
+        return cls(
+            message["ts"],
+            user=user,
+            text=message.get("text", ""),
+            thread_ts=message.get("thread_ts"),
+            sender=sender,
+        )
+
+    def __repr__(self):
+        return f"MessageRecord(ts={self.ts!r}, user={self.user!r}, thread_ts={self.thread_ts!r})"
+
+
+# sort key for records
+by_ts = attrgetter("ts_key")
@@ -0,0 +1,362 @@
+import logging
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+
+
+# in process metrics, rendered in the prometheus text format on /metrics
+# recording is a perf_counter() pair, a bisect and a dict update under a lock,
+# cheap enough to leave on. with METRICS_OTEL=true every stage is also an
+# opentelemetry span, exported wherever the opentelemetry sdk is configured to
+
+logger = logging.getLogger()
+
+# seconds, from a cached thread lookup to a long channel summary
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# the entrypoint being handled, for stages deep in helpers that don't know it
+current_entrypoint = contextvars.ContextVar("entrypoint", default="none")
+
+
+def _label_text(label_names, values, extra=()):
+    pairs = list(zip(label_names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        + "}"
+    )
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_label_text(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def count(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            counts = self._values.get(key)
+            return sum(counts[0]) if counts else 0
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = sorted(
+                (key, (list(c[0]), c[1])) for key, c in self._values.items()
+            )
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _label_text(self.label_names, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # name -> (help, type, fn returning the current value), read at render time
+        self.gauges = {}
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, fn, metric_type="gauge"):
+        # metric_type="counter" for running totals kept elsewhere
+        self.gauges[name] = (help_text, metric_type, fn)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, (help_text, metric_type, fn) in self.gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {e}")
+                continue
+            lines.extend(
+                [
+                    f"# HELP {name} {help_text}",
+                    f"# TYPE {name} {metric_type}",
+                    f"{name} {value}",
+                ]
+            )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "slackbot_request_seconds",
+    "Time to handle one slack message, per entrypoint.",
+    ("entrypoint",),
+)
+STAGE_SECONDS = registry.histogram(
+    "slackbot_stage_seconds",
+    "Time spent in each stage of handling a message.",
+    ("entrypoint", "stage"),
+)
+SLACK_API_CALLS = registry.counter(
+    "slackbot_slack_api_calls_total",
+    "Slack web api calls by method and outcome.",
+    ("method", "outcome"),
+)
+SLACK_API_SECONDS = registry.histogram(
+    "slackbot_slack_api_seconds", "Slack web api call latency.", ("method",)
+)
+MODEL_TOKENS = registry.counter(
+    "slackbot_model_tokens_total",
+    "Gemini tokens reported by the model, prompt and response.",
+    ("entrypoint", "kind"),
+)
+MODEL_CALLS = registry.counter(
+    "slackbot_model_calls_total",
+    "Gemini calls by task, model, region and outcome.",
+    ("task", "model", "location", "outcome"),
+)
+MODEL_SECONDS = registry.histogram(
+    "slackbot_model_seconds",
+    "Gemini call latency, to the first chunk for streams.",
+    ("task", "model", "location"),
+)
+MODEL_HEDGES = registry.counter(
+    "slackbot_model_hedges_total",
+    "Slow gemini calls raced against the next model in their route.",
+    ("task",),
+)
+PUBLISH_SECONDS = registry.histogram(
+    "slackbot_pubsub_publish_seconds",
+    "Time for pubsub to confirm a publish, by outcome.",
+    ("outcome",),
+)
+DOWNLOAD_BYTES = registry.counter(
+    "slackbot_download_bytes_total", "Bytes of slack files downloaded."
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_tracer = None
+if os.environ.get("METRICS_OTEL", "false").lower() == "true":
+    try:
+        from opentelemetry import trace
+
+        _tracer = trace.get_tracer("slackbot")
+    except ImportError:
+        logger.error("METRICS_OTEL is set but opentelemetry-api isn't installed")
+
+
+def _span(name, entrypoint):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(
+        name, attributes={"slackbot.entrypoint": entrypoint}
+    )
+
+
+@contextlib.contextmanager
+def stage(name, entrypoint=None):
+    """
+    Time a stage of the current request into slackbot_stage_seconds, pass
+    entrypoint for stages outside of request().
+    """
+    entrypoint = entrypoint or current_entrypoint.get()
+    start = time.perf_counter()
+    with _span(name, entrypoint):
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.observe(
+                time.perf_counter() - start, entrypoint=entrypoint, stage=name
+            )
+
+
+def timed_stage(name):
+    # stage() as a decorator
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def request(entrypoint):
+    # time a whole message, stages inside it are labelled with the entrypoint
+    entrypoint = entrypoint or "none"
+    token = current_entrypoint.set(entrypoint)
+    start = time.perf_counter()
+    try:
+        with _span("handle_slack_message", entrypoint):
+            yield
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, entrypoint=entrypoint)
+        current_entrypoint.reset(token)
+
+
+def timed_request(fn):
+    # request() around fn(message), labelled with message["entrypoint"]
+    @functools.wraps(fn)
+    def wrapper(message, *args, **kwargs):
+        with request(message.get("entrypoint")):
+            return fn(message, *args, **kwargs)
+
+    return wrapper
+
+
+def record_usage(response):
+    # token counts gemini reports on a response, or the last chunk of a stream
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    entrypoint = current_entrypoint.get()
+    MODEL_TOKENS.inc(
+        getattr(usage, "prompt_token_count", 0) or 0,
+        entrypoint=entrypoint,
+        kind="prompt",
+    )
+    MODEL_TOKENS.inc(
+        getattr(usage, "candidates_token_count", 0) or 0,
+        entrypoint=entrypoint,
+        kind="response",
+    )
+
+
+def counted_stream(chunks):
+    # pass a streamed response through, counting the tokens once it ends
+    # every chunk carries the running totals, only the last one is recorded
+    last = None
+    try:
+        for chunk in chunks:
+            last = chunk
+            yield chunk
+    finally:
+        if last is not None:
+            record_usage(last)
+
+
+async def counted_stream_async(chunks):
+    # counted_stream() for an async model stream
+    last = None
+    try:
+        async for chunk in chunks:
+            last = chunk
+            yield chunk
+    finally:
+        if last is not None:
+            record_usage(last)
+
+
+def instrument_slack_client(client):
+    """
+    Count and time every web api call a WebClient or AsyncWebClient makes,
+    all of its methods go through api_call.
+    """
+    api_call = client.api_call
+
+    if inspect.iscoroutinefunction(api_call):
+
+        async def counted_api_call(api_method, *args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await api_call(api_method, *args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                SLACK_API_CALLS.inc(method=api_method, outcome=outcome)
+                SLACK_API_SECONDS.observe(
+                    time.perf_counter() - start, method=api_method
+                )
+
+    else:
+
+        def counted_api_call(api_method, *args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = api_call(api_method, *args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                SLACK_API_CALLS.inc(method=api_method, outcome=outcome)
+                SLACK_API_SECONDS.observe(
+                    time.perf_counter() - start, method=api_method
+                )
+
+    client.api_call = counted_api_call
+    return client
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,94 @@
+import logging
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from utils import TTLCache
+
+
+logger = logging.getLogger()
+
+
+def response_key(model_name, prompt, generation_config):
+    # (model, prompt hash, config), config keys sorted so dict order doesn't matter
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return (model_name, digest, json.dumps(generation_config or {}, sort_keys=True))
+
+
+class ResponseCache:
+    """
+    Text responses to plain text prompts, for calls whose answer doesn't need
+    to change from one request to the next (summaries of the same messages,
+    the /summarize time frame). Thread replies aren't cached.
+    """
+
+    def __init__(self, max_size=1000, ttl=60 * 60, clock=time.monotonic):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+        self.hits = 0
+        self.misses = 0
+
+    def generate(self, model_name, prompt, generation_config, generate):
+        # generate() makes the model call and returns the response text and
+        # the model that answered, which may not be model_name if it failed
+        # over. The text is cached under the model that answered.
+        text = self.cache.get(response_key(model_name, prompt, generation_config))
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text, answered_by = generate()
+        if text:
+            self.cache.set(response_key(answered_by, prompt, generation_config), text)
+        return text
+
+
+GREETING_POOL_PROMPT = "You are a slack bot. Users summon you into slack threads. Write {size} different friendly welcome messages, one per line, without numbering"
+
+
+class GreetingPool:
+    """
+    Welcome messages generated in one batch and handed out at random,
+    regenerated every ttl seconds. get() returns None if there are none,
+    callers then ask the model for a single greeting.
+    """
+
+    def __init__(
+        self, generate, size=20, ttl=6 * 60 * 60, clock=time.monotonic, rng=random
+    ):
+        self.generate = generate
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.rng = rng
+        self._lock = threading.Lock()
+        self._greetings = []
+        self._expires_at = None
+
+    def _refill(self):
+        try:
+            text = self.generate(GREETING_POOL_PROMPT.format(size=self.size))
+        except Exception as e:
+            logger.error(f"Error generating greetings: {e}")
+            text = ""
+        greetings = [
+            # drop any list markers the model added anyway
+            re.sub(r"^\s*(?:[-*]|\d+[.)])\s*", "", line).strip()
+            for line in (text or "").splitlines()
+        ]
+        greetings = [greeting for greeting in greetings if greeting]
+        if greetings:
+            self._greetings = greetings
+            self._expires_at = self.clock() + self.ttl
+        else:
+            # keep what we had, try again in a minute
+            self._expires_at = self.clock() + 60
+
+    def get(self):
+        with self._lock:
+            if self._expires_at is None or self._expires_at <= self.clock():
+                self._refill()
+            if not self._greetings:
+                return None
+            return self.rng.choice(self._greetings)
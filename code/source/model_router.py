@@ -0,0 +1,413 @@
+import logging
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from metrics import MODEL_CALLS, MODEL_HEDGES, MODEL_SECONDS
+
+
+logger = logging.getLogger()
+
+
+def parse_target(text, default_location):
+    # "model@location", or just "model" in the default location
+    model_name, _, location = text.strip().partition("@")
+    return (model_name, location or default_location)
+
+
+def target_name(target):
+    return f"{target[0]}@{target[1]}"
+
+
+class Route:
+    """
+    Where a task's calls go: targets, (model, location) pairs, in order of
+    preference. The next target is tried when one fails, or raced against
+    it once hedge_after seconds pass without an answer. With fastest the
+    healthy targets are ordered by their recent latency for the task
+    instead, for routes listing the same model in several regions.
+    """
+
+    def __init__(self, targets, hedge_after=None, fastest=False):
+        self.targets = list(targets)
+        self.hedge_after = hedge_after
+        self.fastest = fastest
+
+    @classmethod
+    def from_config(cls, config, default_location):
+        # {"targets": ["gemini-1.5-flash@us-central1", ...], "hedge_after": 2}
+        # or just the list of targets
+        if isinstance(config, (list, str)):
+            config = {"targets": config}
+        targets = config["targets"]
+        if isinstance(targets, str):
+            targets = targets.split(",")
+        return cls(
+            [parse_target(target, default_location) for target in targets],
+            hedge_after=config.get("hedge_after") or None,
+            fastest=bool(config.get("fastest", False)),
+        )
+
+
+def load_routes(defaults, config, default_location):
+    """
+    The default routes with any from config, json text mapping task names to
+    Route configs, replacing them. Bad config is logged and ignored.
+    """
+    routes = dict(defaults)
+    if not config:
+        return routes
+    try:
+        for task, route in json.loads(config).items():
+            routes[task] = Route.from_config(route, default_location)
+    except Exception as e:
+        logger.error(f"Error loading model routes, using the defaults: {e}")
+        return dict(defaults)
+    return routes
+
+
+class RollingWindow:
+    # the values added in the last window_seconds, at most max_samples of them
+    def __init__(self, window_seconds, max_samples, clock):
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=max_samples)
+        self.clock = clock
+
+    def add(self, value):
+        self.samples.append((self.clock(), value))
+
+    def values(self):
+        cutoff = self.clock() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return [value for _, value in self.samples]
+
+
+class ModelRouter:
+    """
+    Picks the model and region for each kind of call (a thread reply, a
+    summary, the /summarize time frame, a greeting) from its Route and
+    keeps the rolling error rate of every target and its latency per task.
+
+    get_model(model_name, location) returns a GenerativeModel, or anything
+    with the same generate_content(_async) methods. A target that failed
+    more than max_error_rate of at least min_samples calls in the last
+    window_seconds is tried after the healthy ones, and again on its own
+    once those failures age out of the window.
+
+    Hedged calls run on hedge_workers threads. The losing call of a race
+    can't be stopped and keeps its thread until it ends, so the pool needs
+    room for those too or hedges start queueing behind them.
+    """
+
+    def __init__(
+        self,
+        get_model,
+        routes,
+        window_seconds=300,
+        max_samples=100,
+        min_samples=5,
+        max_error_rate=0.5,
+        hedge_workers=64,
+        clock=time.monotonic,
+    ):
+        self.get_model = get_model
+        self.routes = routes
+        self.window_seconds = window_seconds
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.hedge_workers = hedge_workers
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._errors = {}
+        self._latencies = {}
+        self._executor = None
+        # abandoned async hedges, referenced until they finish
+        self._background = set()
+
+    def _add(self, windows, key, value):
+        with self._lock:
+            window = windows.get(key)
+            if window is None:
+                window = RollingWindow(
+                    self.window_seconds, self.max_samples, self.clock
+                )
+                windows[key] = window
+            window.add(value)
+
+    def route(self, task):
+        return self.routes.get(task) or self.routes["default"]
+
+    def error_rate(self, target):
+        with self._lock:
+            window = self._errors.get(target)
+            errors = window.values() if window else []
+        if len(errors) < self.min_samples:
+            return 0.0
+        return sum(errors) / len(errors)
+
+    def latency(self, task, target):
+        # median seconds of the recent successful calls, None if there were none
+        with self._lock:
+            window = self._latencies.get((task, target))
+            latencies = sorted(window.values()) if window else []
+        if not latencies:
+            return None
+        return latencies[len(latencies) // 2]
+
+    def healthy(self, target):
+        return self.error_rate(target) <= self.max_error_rate
+
+    def targets(self, task):
+        # the order to try a task's targets in, healthy ones first
+        route = self.route(task)
+        healthy = [target for target in route.targets if self.healthy(target)]
+        unhealthy = [target for target in route.targets if target not in healthy]
+        if route.fastest:
+            # targets without a recent call go first so their latency gets measured
+            healthy.sort(key=lambda target: self.latency(task, target) or 0.0)
+        return healthy + unhealthy
+
+    def record(self, task, target, elapsed, error=None):
+        model_name, location = target
+        outcome = "error" if error is not None else "ok"
+        MODEL_CALLS.inc(task=task, model=model_name, location=location, outcome=outcome)
+        self._add(self._errors, target, 1 if error is not None else 0)
+        if error is None:
+            self._add(self._latencies, (task, target), elapsed)
+            MODEL_SECONDS.observe(
+                elapsed, task=task, model=model_name, location=location
+            )
+        else:
+            logger.error(f"model {target_name(target)} failed for {task}: {error}")
+
+    def stats(self):
+        # {task: [(target, error rate, median latency)]} for logs and debugging
+        return {
+            task: [
+                (
+                    target_name(target),
+                    self.error_rate(target),
+                    self.latency(task, target),
+                )
+                for target in route.targets
+            ]
+            for task, route in self.routes.items()
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _call(self, task, target, contents, generation_config):
+        start = time.perf_counter()
+        try:
+            response = self.get_model(*target).generate_content(
+                contents=contents, generation_config=generation_config
+            )
+        except Exception as e:
+            self.record(task, target, time.perf_counter() - start, e)
+            raise
+        self.record(task, target, time.perf_counter() - start)
+        return response, target
+
+    def generate(self, task, contents, generation_config=None):
+        """
+        A response from the first target that gives one, racing the next
+        target against a call that takes longer than the route's hedge_after.
+        Raises the last error if every target fails.
+        """
+        return self.generate_from(task, contents, generation_config)[0]
+
+    def generate_from(self, task, contents, generation_config=None):
+        # generate(), and the target that answered
+        route = self.route(task)
+        targets = self.targets(task)
+        if route.hedge_after and len(targets) > 1:
+            return self._hedged(
+                task, targets, route.hedge_after, contents, generation_config
+            )
+        error = None
+        for target in targets:
+            try:
+                return self._call(task, target, contents, generation_config)
+            except Exception as e:
+                error = e
+        raise error
+
+    def _submit(self, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.hedge_workers, thread_name_prefix="model-hedge"
+                )
+        # stages and token counts are labelled from the caller's context
+        return self._executor.submit(contextvars.copy_context().run, self._call, *args)
+
+    def _hedged(self, task, targets, hedge_after, contents, generation_config):
+        remaining = list(targets)
+        pending = set()
+        hedged = False
+        error = None
+        pending.add(self._submit(task, remaining.pop(0), contents, generation_config))
+        while pending:
+            can_hedge = not hedged and remaining and self.healthy(remaining[0])
+            done, pending = wait(
+                pending,
+                timeout=hedge_after if can_hedge else None,
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                # slow, race the next target, whichever answers first wins
+                # (the loser runs on, its outcome still counts in the stats)
+                hedged = True
+                MODEL_HEDGES.inc(task=task)
+                pending.add(
+                    self._submit(task, remaining.pop(0), contents, generation_config)
+                )
+                continue
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            if not pending and remaining:
+                # fail over
+                pending.add(
+                    self._submit(task, remaining.pop(0), contents, generation_config)
+                )
+        raise error
+
+    def stream(self, task, contents, generation_config=None):
+        """
+        A streamed response from the first target that starts one. Once a
+        chunk has arrived the stream is committed to its target, errors after
+        that are the caller's, so streams fail over but aren't hedged.
+        """
+        error = None
+        for target in self.targets(task):
+            start = time.perf_counter()
+            try:
+                chunks = iter(
+                    self.get_model(*target).generate_content(
+                        contents=contents,
+                        generation_config=generation_config,
+                        stream=True,
+                    )
+                )
+                first = next(chunks, None)
+            except Exception as e:
+                self.record(task, target, time.perf_counter() - start, e)
+                error = e
+                continue
+            # latency to the first chunk
+            self.record(task, target, time.perf_counter() - start)
+            return self._resume(first, chunks)
+        raise error
+
+    def _resume(self, first, chunks):
+        if first is None:
+            return
+        yield first
+        yield from chunks
+
+    async def _call_async(self, task, target, contents, generation_config):
+        start = time.perf_counter()
+        try:
+            response = await self.get_model(*target).generate_content_async(
+                contents=contents, generation_config=generation_config
+            )
+        except asyncio.CancelledError:
+            # lost a hedge race
+            raise
+        except Exception as e:
+            self.record(task, target, time.perf_counter() - start, e)
+            raise
+        self.record(task, target, time.perf_counter() - start)
+        return response
+
+    async def generate_async(self, task, contents, generation_config=None):
+        # generate() for the event loop, the losing call of a hedge is cancelled
+        route = self.route(task)
+        remaining = self.targets(task)
+        hedge_after = route.hedge_after if len(remaining) > 1 else None
+        pending = set()
+        hedged = False
+        error = None
+
+        def launch():
+            pending.add(
+                asyncio.ensure_future(
+                    self._call_async(
+                        task, remaining.pop(0), contents, generation_config
+                    )
+                )
+            )
+
+        launch()
+        try:
+            while pending:
+                can_hedge = (
+                    hedge_after
+                    and not hedged
+                    and remaining
+                    and self.healthy(remaining[0])
+                )
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=hedge_after if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedged = True
+                    MODEL_HEDGES.inc(task=task)
+                    launch()
+                    continue
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        error = e
+                if not pending and remaining:
+                    launch()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+                self._background.add(future)
+                future.add_done_callback(self._background.discard)
+
+    async def stream_async(self, task, contents, generation_config=None):
+        # stream() for the event loop, an async iterator of chunks
+        error = None
+        for target in self.targets(task):
+            start = time.perf_counter()
+            try:
+                chunks = await self.get_model(*target).generate_content_async(
+                    contents=contents,
+                    generation_config=generation_config,
+                    stream=True,
+                )
+                chunks = chunks.__aiter__()
+                try:
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    first = None
+            except Exception as e:
+                self.record(task, target, time.perf_counter() - start, e)
+                error = e
+                continue
+            self.record(task, target, time.perf_counter() - start)
+            return self._resume_async(first, chunks)
+        raise error
+
+    async def _resume_async(self, first, chunks):
+        if first is None:
+            return
+        yield first
+        async for chunk in chunks:
+            yield chunk
@@ -0,0 +1,131 @@
+import logging
+import json
+import threading
+import time
+import zlib
+from metrics import PUBLISH_SECONDS
+
+
+logger = logging.getLogger()
+
+# everything the worker reads from a published slack message
+MESSAGE_FIELDS = (
+    "entrypoint",
+    "channel",
+    "channel_id",
+    "user",
+    "user_id",
+    "ts",
+    "thread_ts",
+    "event_ts",
+    "text",
+    "event_id",
+    "client_msg_id",
+    "trigger_id",
+)
+
+
+def slim_message(message, fields=MESSAGE_FIELDS):
+    # slack events carry blocks, profiles etc. the worker never looks at
+    return {field: message[field] for field in fields if field in message}
+
+
+def encode_message(message, compress_min_bytes=None):
+    # (data, attributes) for a pubsub message, large bodies are deflated
+    data = json.dumps(slim_message(message), separators=(",", ":")).encode("utf-8")
+    if compress_min_bytes is not None and len(data) >= compress_min_bytes:
+        return zlib.compress(data), {"encoding": "deflate"}
+    return data, {}
+
+
+def decode_message(data, attributes=None):
+    if (attributes or {}).get("encoding") == "deflate":
+        data = zlib.decompress(data)
+    return json.loads(data.decode("utf-8").strip())
+
+
+class MessagePublisher:
+    """
+    Publishes slack messages to a pubsub topic without losing track of them.
+
+    Batching is left to the client's BatchSettings, this keeps at most
+    max_in_flight publishes outstanding (waiting up to block_timeout for
+    room, then dropping the message) and counts what succeeded, failed and
+    how long pubsub took to confirm, in stats() and the
+    slackbot_pubsub_publish_seconds histogram. get_client returns the publisher
+    client, the real one, one pointed at the emulator or a fake.
+    """
+
+    def __init__(
+        self,
+        get_client,
+        topic_path,
+        max_in_flight=1000,
+        block_timeout=5,
+        compress_min_bytes=None,
+        clock=time.monotonic,
+    ):
+        self.get_client = get_client
+        self.topic_path = topic_path
+        self.block_timeout = block_timeout
+        self.compress_min_bytes = compress_min_bytes
+        self.clock = clock
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.in_flight = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def publish(self, message):
+        data, attributes = encode_message(message, self.compress_min_bytes)
+        if not self._slots.acquire(timeout=self.block_timeout):
+            with self._lock:
+                self.dropped += 1
+            logger.error("pubsub publish dropped, too many messages in flight")
+            return None
+        with self._lock:
+            self.in_flight += 1
+        started = self.clock()
+        try:
+            future = self.get_client().publish(self.topic_path, data, **attributes)
+        except Exception:
+            self._done(None, started, len(data), failed=True)
+            raise
+        future.add_done_callback(
+            lambda f: self._done(f, started, len(data), failed=bool(f.exception()))
+        )
+        return future
+
+    def _done(self, future, started, size, failed):
+        latency = self.clock() - started
+        PUBLISH_SECONDS.observe(latency, outcome="error" if failed else "ok")
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.published += 1
+                self.bytes += size
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        self._slots.release()
+        if failed and future is not None:
+            logger.error(f"pubsub publish failed: {future.exception()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "published": self.published,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "in_flight": self.in_flight,
+                "bytes": self.bytes,
+                "latency_avg": (
+                    self.latency_total / self.published if self.published else 0.0
+                ),
+                "latency_max": self.latency_max,
+            }
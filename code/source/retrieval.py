@@ -0,0 +1,314 @@
+import logging
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+logger = logging.getLogger()
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+# messages embedded and written per step of add()
+ADD_CHUNK = 1000
+
+
+def normalize(vectors):
+    # unit length rows, so cosine similarity is a dot product
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class HashEmbedder:
+    """
+    Deterministic bag of words vectors by feature hashing, no model calls.
+    Only messages sharing words match, for offline runs and benchmarks.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def embed(self, texts, task="RETRIEVAL_DOCUMENT"):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in WORD_PATTERN.findall(text.lower()):
+                value = int.from_bytes(
+                    hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(),
+                    "little",
+                )
+                vectors[row, value % self.dim] += 1.0 if value >> 63 else -1.0
+        return vectors
+
+
+class VertexEmbedder:
+    """
+    Vertex AI text embeddings, batch_size texts per call. get_model returns
+    the TextEmbeddingModel.
+    """
+
+    def __init__(self, get_model, batch_size=100):
+        self.get_model = get_model
+        self.batch_size = batch_size
+
+    def embed(self, texts, task="RETRIEVAL_DOCUMENT"):
+        from vertexai.language_models import TextEmbeddingInput
+
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [
+                TextEmbeddingInput(text, task)
+                for text in texts[start : start + self.batch_size]
+            ]
+            rows.extend(
+                embedding.values for embedding in self.get_model().get_embeddings(batch)
+            )
+        return np.asarray(rows, dtype=np.float32)
+
+
+class ChannelVectors:
+    """
+    One channel's message vectors, appended to a float32 file that is
+    memory mapped for search, with each row's ts and transcript line in a
+    json lines file next to it (the first line holds the dimension).
+    Only one process should write a channel's files.
+    """
+
+    def __init__(self, path_prefix):
+        self.vectors_path = path_prefix + ".f32"
+        self.lines_path = path_prefix + ".jsonl"
+        self.lock = threading.Lock()
+        # held through embedding by add(), so rows aren't added twice
+        self.update_lock = threading.Lock()
+        self.dim = None
+        self.ts = []
+        self.lines = []
+        self._matrix = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.lines_path):
+            return
+        try:
+            cut_short = False
+            with open(self.lines_path, "r") as f:
+                self.dim = json.loads(f.readline())["dim"]
+                for row in f:
+                    if not row.endswith("\n"):
+                        # the last line was cut short
+                        cut_short = True
+                        break
+                    ts, line = json.loads(row)
+                    self.ts.append(ts)
+                    self.lines.append(line)
+            # a write cut short leaves the two files out of step, keep the
+            # rows both have so later rows are appended in line with each other
+            row_bytes = 4 * self.dim
+            vectors_size = os.path.getsize(self.vectors_path)
+            rows = min(len(self.ts), vectors_size // row_bytes)
+            if vectors_size != rows * row_bytes:
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(rows * row_bytes)
+            if cut_short or rows < len(self.ts):
+                del self.ts[rows:]
+                del self.lines[rows:]
+                self._rewrite_lines()
+        except Exception as e:
+            logger.error(f"Error loading {self.lines_path}, starting over: {e}")
+            self._clear()
+
+    def _clear(self):
+        self.dim = None
+        self.ts = []
+        self.lines = []
+        self._matrix = None
+        for path in (self.vectors_path, self.lines_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def reset(self):
+        # drop every row, for when they came from another embedder
+        with self.lock:
+            self._clear()
+
+    def _rewrite_lines(self):
+        temp_path = self.lines_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps({"dim": self.dim}) + "\n")
+            f.write(
+                "".join(
+                    json.dumps([ts, line]) + "\n"
+                    for ts, line in zip(self.ts, self.lines)
+                )
+            )
+        os.replace(temp_path, self.lines_path)
+
+    @property
+    def latest_ts(self):
+        return self.ts[-1] if self.ts else None
+
+    def add(self, items, vectors):
+        # items is a ts ordered list of (ts, line), vectors their normalized rows
+        with self.lock:
+            if self.dim is not None and vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"{vectors.shape[1]} dimension vectors for {self.dim} dimension rows"
+                )
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.lines_path, "w") as f:
+                    f.write(json.dumps({"dim": self.dim}) + "\n")
+                # a fresh vectors file to go with the fresh lines file
+                open(self.vectors_path, "wb").close()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self.lines_path, "a") as f:
+                f.write("".join(json.dumps([ts, line]) + "\n" for ts, line in items))
+            self.ts.extend(ts for ts, _ in items)
+            self.lines.extend(line for _, line in items)
+            self._matrix = None
+
+    def matrix(self):
+        with self.lock:
+            if self._matrix is None and self.ts:
+                self._matrix = np.memmap(
+                    self.vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(len(self.ts), self.dim),
+                )
+            return self._matrix
+
+    def search(self, query, k):
+        # the k best (score, ts, line) by cosine similarity, best first
+        matrix = self.matrix()
+        if matrix is None:
+            return []
+        scores = matrix @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.ts[i], self.lines[i]) for i in top]
+
+
+class RetrievalIndex:
+    """
+    Incremental per channel vector index of channel history, so a thread
+    reply can pull in earlier messages related to the question without
+    sending the whole channel to gemini.
+
+    add() embeds only messages newer than what the channel already holds,
+    in batches. search() embeds the question and returns the top k rows by
+    cosine similarity. A channel indexed with an embedder of another
+    dimension is dropped by add(), so the next update backfills it. At
+    most max_channels channels are kept open, the least recently used are
+    closed (their files stay on disk).
+
+    refresh() runs a channel's update on one of workers background threads,
+    so the first reply in a channel doesn't wait for its history backfill
+    and searches whatever is indexed so far.
+    """
+
+    def __init__(
+        self, embedder, directory, max_channels=100, workers=2, clock=time.monotonic
+    ):
+        self.embedder = embedder
+        self.directory = directory
+        self.max_channels = max_channels
+        self.workers = workers
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._channels = OrderedDict()
+        self._refreshed = {}
+        self._refreshing = set()
+        self._executor = None
+        os.makedirs(directory, exist_ok=True)
+
+    def channel(self, channel_id):
+        with self._lock:
+            vectors = self._channels.get(channel_id)
+            if vectors is None:
+                name = re.sub(r"[^A-Za-z0-9_-]", "_", channel_id)
+                vectors = ChannelVectors(os.path.join(self.directory, name))
+                self._channels[channel_id] = vectors
+                while len(self._channels) > self.max_channels:
+                    self._channels.popitem(last=False)
+            self._channels.move_to_end(channel_id)
+            return vectors
+
+    def latest_ts(self, channel_id):
+        return self.channel(channel_id).latest_ts
+
+    def refresh(self, channel_id, interval, update):
+        """
+        Run update(channel_id) in the background, at most once every interval
+        seconds per channel and never while the last one is still running.
+        Returns its future, or None if it wasn't due.
+        """
+        with self._lock:
+            now = self.clock()
+            if channel_id in self._refreshing:
+                return None
+            if now - self._refreshed.get(channel_id, float("-inf")) < interval:
+                return None
+            self._refreshed[channel_id] = now
+            self._refreshing.add(channel_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="retrieval"
+                )
+        return self._executor.submit(self._refresh, channel_id, update)
+
+    def _refresh(self, channel_id, update):
+        try:
+            update(channel_id)
+        except Exception as e:
+            logger.error(f"Error indexing {channel_id}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(channel_id)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def add(self, channel_id, items):
+        """
+        Index a ts ordered list of (ts, line), anything not newer than the
+        channel's latest row is skipped. Returns how many rows were added.
+        """
+        vectors = self.channel(channel_id)
+        with vectors.update_lock:
+            latest = vectors.latest_ts
+            if latest is not None:
+                items = [item for item in items if float(item[0]) > float(latest)]
+            # a chunk at a time, so a long backfill keeps what it got if it fails
+            for start in range(0, len(items), ADD_CHUNK):
+                chunk = items[start : start + ADD_CHUNK]
+                embedded = self.embedder.embed([line for _, line in chunk])
+                if vectors.dim is not None and embedded.shape[1] != vectors.dim:
+                    # only newer messages are here, adding them alone would
+                    # leave the older ones out, so the next update backfills
+                    logger.warning(
+                        f"{channel_id} was indexed with {vectors.dim} dimensions, "
+                        f"the embedder now has {embedded.shape[1]}, starting over"
+                    )
+                    vectors.reset()
+                    return start
+                vectors.add(chunk, normalize(embedded))
+        return len(items)
+
+    def search(self, channel_id, query, k=8, min_score=0.0):
+        vectors = self.channel(channel_id)
+        if vectors.latest_ts is None:
+            return []
+        query = normalize(self.embedder.embed([query], task="RETRIEVAL_QUERY"))[0]
+        if query.shape[0] != vectors.dim:
+            # indexed with another embedder, the next update starts it over
+            return []
+        return [hit for hit in vectors.search(query, k) if hit[0] >= min_score]
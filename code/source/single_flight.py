@@ -0,0 +1,55 @@
+import logging
+import threading
+import time
+from utils import TTLCache
+
+
+logger = logging.getLogger()
+
+
+class SingleFlight:
+    """
+    One computation per key at a time, for summaries several people ask for
+    at once. The first caller for a key leads and computes the result, the
+    ones that come while it runs join it and are handed back to the leader
+    to deliver to, instead of each waiting on a worker thread. Results are
+    kept for ttl seconds for requests that arrive just after.
+
+    begin(key, requester) returns ("cached", result), ("joined", None) or
+    ("lead", None). The leader must call finish(key, result) when done,
+    result None if it failed, and gets back every requester to deliver to,
+    its own first. Only calls in this process are coalesced.
+    """
+
+    def __init__(self, ttl=60, max_size=1000, clock=time.monotonic):
+        self.results = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.led = 0
+        self.joined = 0
+        self.cached = 0
+
+    def begin(self, key, requester):
+        with self._lock:
+            # checked under the lock, finish() caches before the flight ends
+            result = self.results.get(key)
+            if result is not None:
+                self.cached += 1
+                return "cached", result
+            requesters = self._flights.get(key)
+            if requesters is not None:
+                requesters.append(requester)
+                self.joined += 1
+                return "joined", None
+            self._flights[key] = [requester]
+            self.led += 1
+            return "lead", None
+
+    def finish(self, key, result):
+        with self._lock:
+            if result is not None:
+                self.results.set(key, result)
+            return self._flights.pop(key, [])
+
+    def stats(self):
+        return {"led": self.led, "joined": self.joined, "cached": self.cached}
@@ -0,0 +1,218 @@
+import logging
+import time
+from utils import slack_call, async_slack_call
+
+
+logger = logging.getLogger()
+
+# slack caps a section block's text at 3000 characters
+SECTION_LIMIT = 3000
+# shown after the text of a reply until it's finished
+CURSOR = " ..."
+# replaces the cursor when the model's stream fails part way through
+INCOMPLETE_NOTICE = "\n\n_Sorry, something went wrong and this answer is incomplete._"
+
+
+def markdown_blocks(text, limit=SECTION_LIMIT):
+    # split text into mrkdwn sections, preferring paragraph then line breaks
+    blocks = []
+    while text:
+        if len(text) <= limit:
+            chunk, text = text, ""
+        else:
+            cut = text.rfind("\n\n", 0, limit)
+            if cut <= 0:
+                cut = text.rfind("\n", 0, limit)
+            if cut <= 0:
+                cut = text.rfind(" ", 0, limit)
+            if cut <= 0:
+                cut = limit
+            chunk, text = text[:cut], text[cut:].lstrip("\n")
+        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": chunk}})
+    return blocks
+
+
+def still_streaming(message, cursor=CURSOR):
+    # a bot reply part way through streaming, interim posts are plain text
+    # ending in the cursor, the final update adds blocks
+    return (
+        "bot_id" in message
+        and not message.get("blocks")
+        and message.get("text", "").endswith(cursor)
+    )
+
+
+def chunk_text(chunk):
+    # stream chunks without text (safety, finish reason) raise on .text
+    try:
+        return chunk.text
+    except Exception:
+        return ""
+
+
+class StreamingReply:
+    """
+    Posts a model's streamed response into a slack thread as it arrives.
+
+    The first chunk with text is posted right away, later chunks are
+    coalesced into chat.update calls no more often than min_interval
+    seconds (slack allows roughly one update per second per message).
+    A final update applies format_text and splits the answer into blocks.
+    If the stream fails the final update says the answer is incomplete.
+    """
+
+    def __init__(
+        self,
+        slack_client,
+        channel,
+        thread_ts,
+        format_text=lambda text: text,
+        min_interval=1.5,
+        cursor=CURSOR,
+        clock=time.monotonic,
+    ):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.format_text = format_text
+        self.min_interval = min_interval
+        self.cursor = cursor
+        self.clock = clock
+        self.ts = None
+        self.text = ""
+        self._last_update = None
+
+    def _post(self):
+        slack_result = self.slack_client.chat_postMessage(
+            channel=self.channel,
+            text=self.format_text(self.text) + self.cursor,
+            thread_ts=self.thread_ts,
+        )
+        self.ts = slack_result["ts"]
+        self._last_update = self.clock()
+
+    def _update(self):
+        try:
+            self.slack_client.chat_update(
+                channel=self.channel,
+                ts=self.ts,
+                text=self.format_text(self.text) + self.cursor,
+            )
+        except Exception as e:
+            # an interim update can be skipped, the final one carries everything
+            logger.error(f"Error updating streamed reply: {e}")
+        self._last_update = self.clock()
+
+    def add(self, text):
+        if not text:
+            return
+        self.text += text
+        if self.ts is None:
+            self._post()
+        elif self.clock() - self._last_update >= self.min_interval:
+            self._update()
+
+    def finish(self, fallback="Hrm.. dunno how to respond", notice=""):
+        text = ((self.text or fallback) + notice).lstrip("\n")
+        blocks = markdown_blocks(self.format_text(text))
+        if self.ts is None:
+            slack_result = slack_call(
+                self.slack_client.chat_postMessage,
+                channel=self.channel,
+                text=text[:SECTION_LIMIT],
+                blocks=blocks,
+                thread_ts=self.thread_ts,
+            )
+            self.ts = slack_result["ts"]
+        else:
+            slack_call(
+                self.slack_client.chat_update,
+                channel=self.channel,
+                ts=self.ts,
+                text=text[:SECTION_LIMIT],
+                blocks=blocks,
+            )
+        return text
+
+    def run(self, chunks):
+        # consume the whole stream, returns the final text
+        try:
+            for chunk in chunks:
+                self.add(chunk_text(chunk))
+        except Exception:
+            # don't leave what we got looking like the whole answer
+            try:
+                self.finish(fallback="", notice=INCOMPLETE_NOTICE)
+            except Exception as e:
+                logger.error(f"Error marking streamed reply incomplete: {e}")
+            raise
+        return self.finish()
+
+
+class AsyncStreamingReply(StreamingReply):
+    """
+    StreamingReply for an AsyncWebClient and an async model stream.
+    """
+
+    async def _post(self):
+        slack_result = await self.slack_client.chat_postMessage(
+            channel=self.channel,
+            text=self.format_text(self.text) + self.cursor,
+            thread_ts=self.thread_ts,
+        )
+        self.ts = slack_result["ts"]
+        self._last_update = self.clock()
+
+    async def _update(self):
+        try:
+            await self.slack_client.chat_update(
+                channel=self.channel,
+                ts=self.ts,
+                text=self.format_text(self.text) + self.cursor,
+            )
+        except Exception as e:
+            logger.error(f"Error updating streamed reply: {e}")
+        self._last_update = self.clock()
+
+    async def add(self, text):
+        if not text:
+            return
+        self.text += text
+        if self.ts is None:
+            await self._post()
+        elif self.clock() - self._last_update >= self.min_interval:
+            await self._update()
+
+    async def finish(self, fallback="Hrm.. dunno how to respond", notice=""):
+        text = ((self.text or fallback) + notice).lstrip("\n")
+        blocks = markdown_blocks(self.format_text(text))
+        if self.ts is None:
+            slack_result = await async_slack_call(
+                self.slack_client.chat_postMessage,
+                channel=self.channel,
+                text=text[:SECTION_LIMIT],
+                blocks=blocks,
+                thread_ts=self.thread_ts,
+            )
+            self.ts = slack_result["ts"]
+        else:
+            await async_slack_call(
+                self.slack_client.chat_update,
+                channel=self.channel,
+                ts=self.ts,
+                text=text[:SECTION_LIMIT],
+                blocks=blocks,
+            )
+        return text
+
+    async def run(self, chunks):
+        try:
+            async for chunk in chunks:
+                await self.add(chunk_text(chunk))
+        except Exception:
+            try:
+                await self.finish(fallback="", notice=INCOMPLETE_NOTICE)
+            except Exception as e:
+                logger.error(f"Error marking streamed reply incomplete: {e}")
+            raise
+        return await self.finish()
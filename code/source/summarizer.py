@@ -0,0 +1,239 @@
+import logging
+import contextvars
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from context_builder import estimate_tokens
+from utils import TTLCache
+
+
+logger = logging.getLogger()
+
+
+class SummarizationError(Exception):
+    """
+    Raised when every part of a conversation failed to summarize, so there
+    is nothing left to write a summary from.
+    """
+
+
+SUMMARY_PROMPT = "You are a slackbot and have been asked to summarize the following conversation:\n {conversation}"
+CHUNK_PROMPT = "You are a slackbot summarizing one part of a longer slack channel conversation. Summarize these messages, keeping who said what, decisions and open questions:\n {conversation}"
+THREAD_PROMPT = "You are a slackbot summarizing one thread of a longer slack channel conversation. Summarize this thread, keeping who said what, decisions and open questions:\n {conversation}"
+COMBINE_PROMPT = "You are a slackbot combining partial summaries of a slack channel conversation, in time order. Merge them into one summary:\n {conversation}"
+FINAL_PROMPT = "You are a slackbot and have been asked to summarize a slack channel conversation. It was too long to read at once, so here are summaries of its parts in time order. Write one summary of the whole conversation:\n {conversation}"
+DROPPED_NOTE = "\n\n_{dropped} part(s) of the conversation couldn't be summarized and are missing from this summary._"
+
+
+class SummarizationEngine:
+    """
+    Map/reduce summaries for conversations too long for one model call.
+
+    Channel messages are packed into chunks of chunk_tokens and larger
+    threads become their own units. Units are summarized concurrently on a
+    bounded pool, then the partial summaries are combined, in batches if
+    need be, until one final call fits. Thread partials are memoized by
+    their last reply so overlapping /summarize windows reuse them.
+
+    generate(prompt) is the model call and returns the response text. Parts
+    whose call fails are left out and the summary says so, if none are left
+    SummarizationError is raised.
+    """
+
+    def __init__(
+        self,
+        generate,
+        chunk_tokens=16000,
+        thread_min_tokens=1000,
+        max_workers=4,
+        cache=None,
+    ):
+        self.generate = generate
+        self.chunk_tokens = chunk_tokens
+        self.thread_min_tokens = thread_min_tokens
+        self.cache = cache if cache is not None else TTLCache(max_size=5000, ttl=86400)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="summarizer"
+        )
+
+    def summarize(self, channel_id, channel_lines, threads):
+        """
+        channel_lines is a ts ordered list of (ts, line) for top level messages,
+        threads a dict of thread_ts to the ts ordered (ts, line) of the thread.
+        """
+        timeline, units = self._split(channel_id, channel_lines, threads)
+
+        if not units and (
+            sum(estimate_tokens(line) for _, line in timeline) <= self.chunk_tokens
+        ):
+            # fits in one call, same as before
+            return self.generate(
+                SUMMARY_PROMPT.format(conversation="".join(l for _, l in timeline))
+            )
+
+        summaries = self._map_units(self._units(channel_id, timeline, units))
+        partials = [summary for summary in summaries if summary]
+        return self._reduce(partials, dropped=summaries.count(None))
+
+    def summarize_segments(self, channel_id, segments):
+        """
+        Summary of a conversation already cut into time ordered segments of
+        (partials, channel_lines, threads). partials is a list of summaries
+        saved from an earlier call, or None to work through the lines.
+        Returns the summary and each segment's partials, None for a segment
+        that failed. Segments too small to be worth a call stay as text.
+        """
+        work = []
+        segment_partials = []
+        for index, (partials, channel_lines, threads) in enumerate(segments):
+            if partials is not None:
+                segment_partials.append(list(partials))
+                continue
+            timeline, units = self._split(channel_id, channel_lines, threads)
+            if not units and (
+                sum(estimate_tokens(line) for _, line in timeline)
+                < self.thread_min_tokens
+            ):
+                text = "".join(line for _, line in timeline)
+                segment_partials.append([text] if text else [])
+                continue
+            segment_partials.append([])
+            work.extend(
+                (index, unit) for unit in self._units(channel_id, timeline, units)
+            )
+
+        failed = set()
+        summaries = self._map_units([unit for _, unit in work])
+        for (index, _), summary in zip(work, summaries):
+            if summary is None:
+                failed.add(index)
+            elif summary:
+                segment_partials[index].append(summary)
+
+        partials = [partial for partials in segment_partials for partial in partials]
+        dropped = summaries.count(None)
+        summary = self._reduce(partials, dropped) if partials or dropped else ""
+        return summary, [
+            None if index in failed else partials
+            for index, partials in enumerate(segment_partials)
+        ]
+
+    def _split(self, channel_id, channel_lines, threads):
+        # threads big enough to summarize on their own, the rest inline
+        # every stream is already ts ordered, so they are merged, not sorted
+        inline = [channel_lines]
+        units = []
+        for thread_ts, thread_lines in threads.items():
+            if not thread_lines:
+                continue
+            tokens = sum(estimate_tokens(line) for _, line in thread_lines)
+            if tokens < self.thread_min_tokens:
+                # small threads read fine inline
+                inline.append(thread_lines)
+                continue
+            last_ts = thread_lines[-1][0]
+            units.append(
+                (
+                    float(thread_ts),
+                    ("thread", channel_id, thread_ts, last_ts, len(thread_lines)),
+                    THREAD_PROMPT,
+                    "".join(line for _, line in thread_lines),
+                )
+            )
+        timeline = list(heapq.merge(*inline, key=lambda item: float(item[0])))
+        return timeline, units
+
+    def _units(self, channel_id, timeline, units):
+        # the timeline in chunks plus the thread units, as (key, prompt, text)
+        units = list(units)
+        for chunk in self._chunks(timeline):
+            units.append(
+                (
+                    float(chunk[0][0]),
+                    ("chunk", channel_id, chunk[0][0], chunk[-1][0], len(chunk)),
+                    CHUNK_PROMPT,
+                    "".join(line for _, line in chunk),
+                )
+            )
+        units.sort(key=lambda unit: unit[0])
+        return [(key, prompt, text) for _, key, prompt, text in units]
+
+    def _chunks(self, timeline):
+        chunk = []
+        chunk_tokens = 0
+        for ts, line in timeline:
+            tokens = estimate_tokens(line)
+            if chunk and chunk_tokens + tokens > self.chunk_tokens:
+                yield chunk
+                chunk = []
+                chunk_tokens = 0
+            chunk.append((ts, line))
+            chunk_tokens += tokens
+        if chunk:
+            yield chunk
+
+    def _summarize_unit(self, key, prompt, text):
+        # key is None for intermediate combines, which aren't worth keeping
+        summary = self.cache.get(key) if key is not None else None
+        if summary is None:
+            summary = self.generate(prompt.format(conversation=text))
+            if summary and key is not None:
+                self.cache.set(key, summary)
+        return summary
+
+    def _map_units(self, units):
+        # each unit's summary in order, None where the call failed
+        # in a copy of our context, so tokens count towards the request
+        futures = [
+            self.executor.submit(
+                contextvars.copy_context().run, self._summarize_unit, key, prompt, text
+            )
+            for key, prompt, text in units
+        ]
+        summaries = []
+        for future in futures:
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                logger.error(f"Error summarizing part of the conversation: {e}")
+                summaries.append(None)
+        return summaries
+
+    def _reduce(self, partials, dropped=0):
+        # combine in batches until everything fits in one final call
+        # dropped counts the parts already lost to failed calls
+        if not partials:
+            raise SummarizationError("no part of the conversation could be summarized")
+        while len(partials) > 1 and (
+            sum(estimate_tokens(p) for p in partials) > self.chunk_tokens
+        ):
+            batches = []
+            batch = []
+            batch_tokens = 0
+            for partial in partials:
+                tokens = estimate_tokens(partial)
+                if batch and batch_tokens + tokens > self.chunk_tokens:
+                    batches.append(batch)
+                    batch = []
+                    batch_tokens = 0
+                batch.append(partial)
+                batch_tokens += tokens
+            batches.append(batch)
+            if len(batches) == len(partials):
+                # every partial is already a batch of its own, just finish
+                break
+            summaries = self._map_units(
+                [(None, COMBINE_PROMPT, "\n\n".join(batch)) for batch in batches]
+            )
+            partials = [summary for summary in summaries if summary]
+            dropped += sum(
+                len(batch) for batch, summary in zip(batches, summaries) if not summary
+            )
+            if not partials:
+                raise SummarizationError("no partial summaries could be combined")
+        summary = self.generate(FINAL_PROMPT.format(conversation="\n\n".join(partials)))
+        if summary and dropped:
+            summary += DROPPED_NOTE.format(dropped=dropped)
+        return summary
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,69 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class SummaryCheckpoints:
+    """
+    Per channel partial summaries of fixed time buckets (an hour by default),
+    so overlapping /summarize windows only fetch and summarize what's new.
+
+    Only whole buckets that ended settle_seconds ago are saved, later thread
+    replies to their messages aren't picked up until the checkpoint is
+    evicted. At most max_channels channels (least recently used first) and
+    max_buckets buckets per channel (oldest first) are kept.
+    """
+
+    def __init__(
+        self,
+        bucket_seconds=60 * 60,
+        settle_seconds=15 * 60,
+        max_channels=200,
+        max_buckets=24 * 7,
+        clock=time.time,
+    ):
+        self.bucket_seconds = bucket_seconds
+        self.settle_seconds = settle_seconds
+        self.max_channels = max_channels
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._lock = threading.Lock()
+        # channel -> bucket start -> (latest ts covered, partial summaries)
+        self._channels = OrderedDict()
+
+    def plan(self, channel_id, oldest, latest):
+        """
+        [oldest, latest] as time ordered (start, end, bucket, partials).
+        bucket is the bucket start for a whole settled bucket, which can be
+        saved, None for the partial first and open last segment. partials
+        is the saved list or None when the messages need fetching.
+        """
+        size = self.bucket_seconds
+        settled_before = self.clock() - self.settle_seconds
+        with self._lock:
+            buckets = dict(self._channels.get(channel_id, {}))
+            if channel_id in self._channels:
+                self._channels.move_to_end(channel_id)
+
+        segments = []
+        start = math.ceil(oldest / size) * size
+        if start > oldest:
+            segments.append((oldest, min(start, latest), None, None))
+        while start + size <= latest and start + size <= settled_before:
+            saved = buckets.get(start)
+            segments.append((start, start + size, start, saved and saved[1]))
+            start += size
+        if start < latest:
+            segments.append((start, latest, None, None))
+        return segments
+
+    def save(self, channel_id, bucket, latest_ts, partials):
+        with self._lock:
+            buckets = self._channels.setdefault(channel_id, {})
+            self._channels.move_to_end(channel_id)
+            buckets[bucket] = (latest_ts, list(partials))
+            while len(buckets) > self.max_buckets:
+                del buckets[min(buckets)]
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
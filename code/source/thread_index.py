@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+import time
+import fcntl
+from utils import TTLCache
+
+
+logger = logging.getLogger()
+
+
+class MemoryThreadBackend:
+    """
+    Default backend, only knows about threads this instance has seen.
+    """
+
+    shared = False
+
+    def __init__(self, max_size=10000, ttl=6 * 60 * 60, clock=time.monotonic):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+
+    def contains(self, key):
+        return self.cache.get(key, False)
+
+    def add(self, key, ttl):
+        self.cache.set(key, True, ttl=ttl)
+
+
+class FileThreadBackend:
+    """
+    Append only file of 'key expires_at' lines, for a volume shared across
+    instances (e.g. a Cloud Run GCS/NFS mount). Each instance tails the file
+    into memory and compacts it once it grows past max_size live entries.
+    """
+
+    shared = True
+
+    def __init__(self, path, max_size=10000, clock=time.time):
+        self.path = path
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._offset = 0
+        self._lines = 0
+        self._mtime = None
+
+    @staticmethod
+    def _parse(line, entries):
+        key, _, expires_at = line.rpartition(" ")
+        try:
+            entries[key] = float(expires_at)
+        except ValueError:
+            return False
+        return bool(key)
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < self._offset:
+                    # compacted by another instance, start over
+                    self._entries = {}
+                    self._offset = 0
+                    self._lines = 0
+                f.seek(self._offset)
+                data = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        # only consume complete lines
+        complete = data[: data.rfind("\n") + 1]
+        self._offset += len(complete.encode("utf-8"))
+        for line in complete.splitlines():
+            if self._parse(line, self._entries):
+                self._lines += 1
+        self._mtime = mtime
+
+    def _compact(self, now):
+        # rewrite the file with only live entries, under an exclusive lock
+        # so appends from other instances aren't lost
+        with open(self.path, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                entries = {}
+                for line in f.read().splitlines():
+                    self._parse(line, entries)
+                live = {k: v for k, v in entries.items() if v > now}
+                # keep the newest entries if we're still over budget
+                if len(live) > self.max_size:
+                    newest = sorted(live.items(), key=lambda kv: kv[1])
+                    live = dict(newest[-self.max_size :])
+                f.seek(0)
+                f.truncate()
+                f.writelines(f"{k} {v}\n" for k, v in live.items())
+                f.flush()
+                self._offset = f.tell()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self._entries = live
+        self._lines = len(live)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def contains(self, key):
+        with self._lock:
+            self._refresh()
+            expires_at = self._entries.get(key)
+        return expires_at is not None and expires_at > self.clock()
+
+    def add(self, key, ttl):
+        now = self.clock()
+        with self._lock:
+            with open(self.path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(f"{key} {now + ttl}\n")
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            self._refresh()
+            if self._lines > 2 * self.max_size:
+                self._compact(now)
+
+
+class RedisThreadBackend:
+    """
+    Any redis compatible client (redis-py, Memorystore, a local fake) that
+    supports set(key, value, ex=seconds) and exists(key).
+    """
+
+    shared = True
+
+    def __init__(self, client, prefix="slackbot:thread:"):
+        self.client = client
+        self.prefix = prefix
+
+    def contains(self, key):
+        return bool(self.client.exists(self.prefix + key))
+
+    def add(self, key, ttl):
+        self.client.set(self.prefix + key, 1, ex=int(ttl))
+
+
+class ThreadIndex:
+    """
+    Index of the (channel, thread_ts) threads the bot takes part in.
+    Positive entries live in the (possibly shared) backend, threads we
+    are not in are only remembered locally and for a shorter time. The
+    backend is asked first so another instance joining a thread wins over
+    our stale negative, a negative_ttl of 0 turns negatives off.
+
+    When authoritative is set every instance records its threads in the
+    shared backend, so a miss means the thread isn't ours.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        authoritative=False,
+        ttl=6 * 60 * 60,
+        negative_ttl=120,
+        max_size=10000,
+        clock=time.monotonic,
+    ):
+        self.backend = backend or MemoryThreadBackend(
+            max_size=max_size, ttl=ttl, clock=clock
+        )
+        self.authoritative = authoritative and self.backend.shared
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.negatives = TTLCache(max_size=max_size, ttl=negative_ttl, clock=clock)
+
+    @staticmethod
+    def _key(channel, thread_ts):
+        return f"{channel}:{thread_ts}"
+
+    def lookup(self, channel, thread_ts):
+        # True if ours, False if known not to be, None if we need to ask slack
+        key = self._key(channel, thread_ts)
+        try:
+            if self.backend.contains(key):
+                return True
+        except Exception as e:
+            logger.error(f"thread index lookup error: {e}")
+            return False if self.negatives.get(key) else None
+        if self.negatives.get(key) or self.authoritative:
+            return False
+        return None
+
+    def add(self, channel, thread_ts):
+        key = self._key(channel, thread_ts)
+        self.negatives.pop(key)
+        try:
+            self.backend.add(key, self.ttl)
+        except Exception as e:
+            logger.error(f"thread index update error: {e}")
+
+    def add_negative(self, channel, thread_ts):
+        if self.negative_ttl <= 0:
+            return
+        self.negatives.set(self._key(channel, thread_ts), True)
+
+
+def thread_index_from_env(ttl, negative_ttl, max_size):
+    # THREAD_INDEX_BACKEND is memory (default), file or redis. A configured
+    # shared backend that can't be built is an error rather than a quiet
+    # fallback to memory, other instances would never see our threads
+    backend_name = os.environ.get("THREAD_INDEX_BACKEND", "memory").lower()
+    authoritative = os.environ.get("THREAD_INDEX_AUTHORITATIVE", "false").lower()
+    backend = None
+    if backend_name == "file":
+        backend = FileThreadBackend(
+            os.environ.get("THREAD_INDEX_PATH", "/tmp/slackbot-threads"),
+            max_size=max_size,
+        )
+    elif backend_name == "redis":
+        import redis
+
+        backend = RedisThreadBackend(
+            redis.Redis.from_url(
+                os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+            )
+        )
+    elif backend_name != "memory":
+        raise ValueError(f"unknown THREAD_INDEX_BACKEND {backend_name}")
+    return ThreadIndex(
+        backend=backend,
+        authoritative=authoritative == "true",
+        ttl=ttl,
+        negative_ttl=negative_ttl,
+        max_size=max_size,
+    )
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ThreadState:
+    """
+    The gemini turns built so far for one slack thread. Consecutive messages
+    from the same role are merged into one turn, only the last turn is ever
+    rebuilt so each new reply costs O(new messages).
+    """
+
+    def __init__(self, key, make_content):
+        self.key = key
+        self.make_content = make_content
+        self.lock = threading.Lock()
+        self.contents = []
+        # estimated tokens and first message ts of each turn
+        self.tokens = []
+        self.turn_ts = []
+        self.last_role = None
+        self.last_parts = []
+        self.last_ts = None
+        self.size = 0
+        # holds a message that will still change, rebuilt on next use
+        self.stale = False
+
+    def is_new(self, ts):
+        return self.last_ts is None or float(ts) > float(self.last_ts)
+
+    def add_message(self, role, parts, ts, size=0, tokens=0):
+        self.last_ts = ts
+        if not parts:
+            return
+        self.size += size
+        if self.contents and self.last_role == role:
+            # extend the last turn
+            self.last_parts = self.last_parts + parts
+            self.contents[-1] = self.make_content(role, self.last_parts)
+            self.tokens[-1] += tokens
+        else:
+            self.last_role = role
+            self.last_parts = list(parts)
+            self.contents.append(self.make_content(role, self.last_parts))
+            self.tokens.append(tokens)
+            self.turn_ts.append(ts)
+
+
+class ThreadStateStore:
+    """
+    LRU of ThreadState per (channel, thread_ts) with a ttl since last use
+    and a total memory budget (text plus file bytes).
+    """
+
+    def __init__(
+        self,
+        make_content,
+        max_bytes=256 * 1024 * 1024,
+        max_threads=1000,
+        ttl=6 * 60 * 60,
+        clock=time.monotonic,
+    ):
+        self.make_content = make_content
+        self.max_bytes = max_bytes
+        self.max_threads = max_threads
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    def get(self, channel, thread_ts):
+        key = (channel, thread_ts)
+        now = self.clock()
+        with self._lock:
+            entry = self._states.get(key)
+            if entry is not None and entry[0] + self.ttl > now and not entry[1].stale:
+                state = entry[1]
+            else:
+                state = ThreadState(key, self.make_content)
+            self._states[key] = (now, state)
+            self._states.move_to_end(key)
+            self._evict(keep=key)
+        return state
+
+    def account(self, state):
+        # call after adding messages so the memory budget is enforced
+        with self._lock:
+            self._evict(keep=state.key)
+
+    def _evict(self, keep):
+        now = self.clock()
+        for key in [k for k, v in self._states.items() if v[0] + self.ttl <= now]:
+            del self._states[key]
+        total = sum(state.size for _, state in self._states.values())
+        while self._states and (
+            total > self.max_bytes or len(self._states) > self.max_threads
+        ):
+            key = next(iter(self._states))
+            if key == keep:
+                break
+            total -= self._states.pop(key)[1].size
+
+    def __len__(self):
+        return len(self._states)
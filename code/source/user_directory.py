@@ -0,0 +1,181 @@
+import logging
+import json
+import os
+import threading
+import time
+from utils import slack_call
+
+
+logger = logging.getLogger()
+
+
+class UserDirectory:
+    """
+    Process wide cache of slack user id to display name.
+
+    Names are kept for ttl seconds, ids slack can't resolve for negative_ttl.
+    When a batch of messages has several unknown users the whole workspace is
+    warmed from users.list (at most once per ttl) on a background thread, so
+    later batches don't need one users.info call per person. The batch that
+    started it looks its people up with users.info meanwhile. A failed warm
+    is retried after warm_retry seconds, doubling each time it fails again.
+    With a path the cache is persisted between restarts.
+    """
+
+    def __init__(
+        self,
+        slack_client,
+        ttl=24 * 60 * 60,
+        negative_ttl=10 * 60,
+        warm_threshold=5,
+        warm_retry=5 * 60,
+        path=None,
+        rate_limiter=None,
+        clock=time.time,
+    ):
+        self.slack_client = slack_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.warm_threshold = warm_threshold
+        self.warm_retry = warm_retry
+        self.path = path
+        self.rate_limiter = rate_limiter
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        # user id -> (name or None, expires_at)
+        self._names = {}
+        self._warmed_at = None
+        self._warming = None
+        self._warm_failures = 0
+        self._retry_at = None
+        self.load()
+
+    def _get(self, user_id):
+        entry = self._names.get(user_id)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        return entry
+
+    def _set(self, user_id, name, ttl):
+        with self._lock:
+            self._names[user_id] = (name, self.clock() + ttl)
+
+    def name(self, user_id):
+        entry = self._get(user_id)
+        if entry is None:
+            try:
+                user_result = slack_call(
+                    self.slack_client.users_info, self.rate_limiter, user=user_id
+                )
+                self._set(user_id, profile_name(user_result["user"]), self.ttl)
+            except Exception as e:
+                logger.error(f"Error resolving user {user_id}: {e}")
+                self._set(user_id, None, self.negative_ttl)
+            entry = self._get(user_id)
+        return entry[0] if entry and entry[0] else user_id
+
+    def name_for_record(self, record):
+        # bot messages don't always have a user, records carry their sender
+        if record.user:
+            return self.name(record.user)
+        return record.sender
+
+    def prepare(self, messages):
+        self.prepare_users(m["user"] for m in messages if "user" in m)
+
+    def prepare_users(self, user_ids):
+        # warm everyone in the background if a batch would need several lookups
+        unknown = {user_id for user_id in user_ids if self._get(user_id) is None}
+        if len(unknown) >= self.warm_threshold:
+            self.warm_in_background()
+
+    def _warm_due(self):
+        now = self.clock()
+        if self._warmed_at and self._warmed_at + self.ttl > now:
+            return False
+        return self._retry_at is None or self._retry_at <= now
+
+    def warm_in_background(self):
+        # starts warm() unless it's running or not due, returns the thread or None
+        with self._lock:
+            if self._warming is not None or not self._warm_due():
+                return None
+            self._warming = threading.Thread(
+                target=self.warm, name="user-directory-warm", daemon=True
+            )
+            warming = self._warming
+        warming.start()
+        return warming
+
+    def warm(self):
+        try:
+            with self._warm_lock:
+                if not self._warm_due():
+                    return
+                self._warm()
+        finally:
+            with self._lock:
+                self._warming = None
+
+    def _warm(self):
+        cursor = None
+        count = 0
+        try:
+            while True:
+                result = slack_call(
+                    self.slack_client.users_list,
+                    self.rate_limiter,
+                    limit=200,
+                    **({"cursor": cursor} if cursor else {}),
+                )
+                for member in result["members"]:
+                    self._set(member["id"], profile_name(member), self.ttl)
+                    count += 1
+                cursor = (result.get("response_metadata") or {}).get("next_cursor")
+                if not cursor:
+                    break
+        except Exception as e:
+            # what was listed is kept, the rest waits for the retry
+            self._warm_failures += 1
+            retry = min(self.warm_retry * 2 ** (self._warm_failures - 1), self.ttl)
+            self._retry_at = self.clock() + retry
+            logger.error(f"Error warming user directory, retrying in {retry}s: {e}")
+            return
+        self._warm_failures = 0
+        self._retry_at = None
+        self._warmed_at = self.clock()
+        logger.info(f"user directory warmed with {count} users")
+        self.save()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+            now = self.clock()
+            with self._lock:
+                for user_id, (name, expires_at) in saved.items():
+                    if expires_at > now:
+                        self._names[user_id] = (name, expires_at)
+        except Exception as e:
+            logger.error(f"Error loading user directory: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            saved = {k: v for k, v in self._names.items() if v[0]}
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving user directory: {e}")
+
+
+def profile_name(user):
+    profile = user.get("profile") or {}
+    return profile.get("real_name") or user.get("real_name") or user.get("name")
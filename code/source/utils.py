@@ -1,25 +1,54 @@
 import logging
-from google.cloud import secretmanager
+import asyncio
+import contextvars
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import google_crc32c
 from slack_sdk.errors import SlackApiError
+from metrics import timed_stage
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
 
-def get_secret(project_id, secret_id, version_id="latest"):
+# secrets are re-read after this many seconds so rotations get picked up
+SECRET_TTL = 60 * 60
+_secret_client = None
+_secret_lock = threading.Lock()
+_secrets = {}
+
+
+def get_secret_client():
+    # one client (and grpc channel) for every secret we read
+    global _secret_client
+    with _secret_lock:
+        if _secret_client is None:
+            # imported here, it's only needed when secrets aren't in the environment
+            from google.cloud import secretmanager
+
+            _secret_client = secretmanager.SecretManagerServiceClient()
+    return _secret_client
+
+
+def get_secret(project_id, secret_id, version_id="latest", ttl=SECRET_TTL):
     """
     Access the payload for the given secret version if one exists. The version
     can be a version number as a string (e.g. "5") or an alias (e.g. "latest").
+    Payloads are cached for ttl seconds.
     """
-    secret_client = secretmanager.SecretManagerServiceClient()
-
     # Build the resource name of the secret version.
     name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    cached = _secrets.get(name)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
 
     # Access the secret version.
-    response = secret_client.access_secret_version(request={"name": name})
+    response = get_secret_client().access_secret_version(request={"name": name})
 
     # Verify payload checksum.
     crc32c = google_crc32c.Checksum()
@@ -28,9 +57,205 @@ def get_secret(project_id, secret_id, version_id="latest"):
         logger.error(f"Data corruption detected when retrieving secret {secret_id}.")
         return "error"
     payload = response.payload.data.decode("UTF-8")
+    _secrets[name] = (payload, time.monotonic() + ttl)
     return f"{payload}"
 
 
+def get_secrets(project_id, secret_ids, version_id="latest"):
+    # several secrets concurrently, each read is its own round trip
+    if not secret_ids:
+        return []
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+        return list(
+            executor.map(
+                lambda secret_id: get_secret(project_id, secret_id, version_id),
+                secret_ids,
+            )
+        )
+
+
+class ClientRegistry:
+    """
+    Thread safe, process wide home for clients that are expensive to build
+    (grpc channels, auth handshakes, connection pools). Each client is built
+    once by its factory on first use and shared by every request after that.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._closers = {}
+
+    def get(self, name, factory, closer=None):
+        # fast path, no locking once the client exists
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = factory()
+                self._clients[name] = client
+                if closer is not None:
+                    self._closers[name] = closer
+        return client
+
+    def close(self):
+        # shut down everything we built, safe to call more than once
+        with self._lock:
+            clients, self._clients = self._clients, {}
+            closers, self._closers = self._closers, {}
+        for name, client in clients.items():
+            if name not in closers:
+                continue
+            try:
+                closers[name](client)
+            except Exception as e:
+                logger.error(f"Error closing client {name}: {e}")
+
+
+class TTLCache:
+    """
+    Small thread safe LRU cache whose entries also expire after ttl seconds.
+    The least recently used entry is evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenBucket:
+    """
+    Blocking token bucket for slack's per method rate limit tiers.
+    rate is tokens per second, capacity the burst size. pause() stops
+    everyone for a while, e.g. for a 429's Retry-After.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = clock()
+        self._paused_until = 0
+
+    def _take(self):
+        # 0 if a token was taken, otherwise how long until one is due, hold _lock
+        now = self.clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        if now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._take()
+            if not wait:
+                return
+            self.sleep(wait)
+
+    def try_acquire(self):
+        # take a token if one is available, never waits
+        with self._lock:
+            return not self._take()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+
+def retry_after_seconds(response, default=1):
+    # a 429's Retry-After, looked up in any case like slack_sdk's own retry
+    # handler does, since proxies and http clients differ in header case
+    for name, value in (response.headers or {}).items():
+        if name.lower() != "retry-after":
+            continue
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else default
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+    return default
+
+
+def slack_call(method, rate_limiter=None, max_retries=3, **kwargs):
+    # call a slack web api method, waiting out 429s as slack asks us to
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return method(**kwargs)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == max_retries:
+                raise
+            retry_after = retry_after_seconds(e.response)
+            # jitter so waiting callers don't all retry at once
+            retry_after += random.uniform(0, 1)
+            logger.info(f"slack rate limited, retrying in {retry_after:.1f}s")
+            if rate_limiter is not None:
+                rate_limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+
+
+async def async_slack_call(method, max_retries=3, **kwargs):
+    # slack_call for the AsyncWebClient
+    for attempt in range(max_retries + 1):
+        try:
+            return await method(**kwargs)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == max_retries:
+                raise
+            retry_after = retry_after_seconds(e.response)
+            retry_after += random.uniform(0, 1)
+            logger.info(f"slack rate limited, retrying in {retry_after:.1f}s")
+            await asyncio.sleep(retry_after)
+
+
 def getValueByPath(input_dict, path_string):
     """
     Gets data/value from a dictionary using a dotted accessor-string
@@ -43,59 +268,230 @@ def getValueByPath(input_dict, path_string):
     return return_data
 
 
-def get_channel_messages(slack_client, channel_id, message_count=0, oldest=1):
-    # return conversation history
-    conversation_history = []
+# messages per conversations.history / conversations.replies call
+SLACK_PAGE_SIZE = 200
 
-    try:
-        # Call the conversations.history method using the WebClient
-        # conversations.history returns the first 100 messages by default
-        # paginated, get the first page
-        result = slack_client.conversations_history(
-            channel=channel_id, limit=message_count, oldest=oldest
-        )
-        conversation_history = result["messages"] if "messages" in result else []
-        while result.data["has_more"]:
-
-            result = slack_client.conversations_history(
-                channel=channel_id,
-                limit=message_count,
-                cursor=result["response_metadata"]["next_cursor"],
-                latest=result["messages"][1]["ts"],
-            )
-            conversation_history.extend(result["messages"])
 
-        # results
-        logger.debug(
-            "{} messages found in {}".format(len(conversation_history), channel_id)
-        )
-        return conversation_history
+def iter_slack_pages(method, rate_limiter=None, page_size=SLACK_PAGE_SIZE, **kwargs):
+    # each page of messages from a cursor paginated slack method
+    cursor = None
+    while True:
+        if cursor:
+            kwargs["cursor"] = cursor
+        result = slack_call(method, rate_limiter, limit=page_size, **kwargs)
+        yield result.get("messages") or []
+        cursor = (result.get("response_metadata") or {}).get("next_cursor")
+        if not result.get("has_more") or not cursor:
+            return
+
 
+def iter_channel_pages(
+    slack_client,
+    channel_id,
+    oldest=None,
+    latest=None,
+    page_size=SLACK_PAGE_SIZE,
+    rate_limiter=None,
+):
+    """
+    Pages of a channel's top level messages, newest first, from oldest to
+    latest (inclusive when latest is given). Stops at the first message
+    older than oldest.
+    """
+    bounds = {}
+    if oldest is not None:
+        bounds["oldest"] = oldest
+    if latest is not None:
+        bounds.update(latest=latest, inclusive=True)
+    for page in iter_slack_pages(
+        slack_client.conversations_history,
+        rate_limiter,
+        page_size,
+        channel=channel_id,
+        **bounds,
+    ):
+        if oldest is not None and page and float(page[-1]["ts"]) < float(oldest):
+            yield [m for m in page if float(m["ts"]) >= float(oldest)]
+            return
+        yield page
+
+
+def iter_channel_messages(slack_client, channel_id, **kwargs):
+    # iter_channel_pages one message at a time
+    for page in iter_channel_pages(slack_client, channel_id, **kwargs):
+        yield from page
+
+
+def iter_message_thread(
+    slack_client,
+    channel_id,
+    thread_ts,
+    oldest=None,
+    page_size=SLACK_PAGE_SIZE,
+    rate_limiter=None,
+):
+    # a thread's messages oldest first, the parent is always included
+    bounds = {} if oldest is None else {"oldest": oldest}
+    for page in iter_slack_pages(
+        slack_client.conversations_replies,
+        rate_limiter,
+        page_size,
+        channel=channel_id,
+        ts=thread_ts,
+        **bounds,
+    ):
+        yield from page
+
+
+@timed_stage("channel_history")
+def get_channel_messages(
+    slack_client, channel_id, message_count=0, oldest=1, latest=None
+):
+    # return conversation history, from oldest to latest inclusive if given
+    conversation_history = []
+    try:
+        for message in iter_channel_messages(
+            slack_client,
+            channel_id,
+            oldest=oldest,
+            latest=latest,
+            page_size=message_count or SLACK_PAGE_SIZE,
+        ):
+            conversation_history.append(message)
     except SlackApiError as e:
+        # what we have so far is still worth summarizing
         logger.error("Error accessing history: {}".format(e))
+    logger.debug(
+        "{} messages found in {}".format(len(conversation_history), channel_id)
+    )
+    return conversation_history
 
 
-def get_message_thread(slack_client, channel_id, thread_ts):
+@timed_stage("thread_replies")
+def get_message_thread(
+    slack_client, channel_id, thread_ts, oldest=None, rate_limiter=None
+):
+    # oldest limits the replies to ones after that ts, the parent is always included
     thread_history = []
     try:
-        # Call the conversations.replies method using the WebClient
-        # conversations.history returns the first 100 messages by default
-        # paginated, get the first page
-        result = slack_client.conversations_replies(channel=channel_id, ts=thread_ts)
-        thread_history = result["messages"] if "messages" in result else []
-        while result.data["has_more"]:
-
-            result = slack_client.conversations_replies(
-                channel=channel_id,
-                ts=thread_ts,
-                cursor=result["response_metadata"]["next_cursor"],
-                latest=result["messages"][1]["ts"],
-            )
-            thread_history.extend(result["messages"])
-
-        # results
-        logger.debug("{} messages found in {}".format(len(thread_history), thread_ts))
-        return thread_history
-
+        for message in iter_message_thread(
+            slack_client,
+            channel_id,
+            thread_ts,
+            oldest=oldest,
+            rate_limiter=rate_limiter,
+        ):
+            thread_history.append(message)
     except SlackApiError as e:
         logger.error("Error accessing history: {}".format(e))
+    logger.debug("{} messages found in {}".format(len(thread_history), thread_ts))
+    return thread_history
+
+
+def get_message_threads(
+    slack_client, channel_id, messages, rate_limiter=None, max_workers=4, convert=None
+):
+    """
+    Fetch the threads of any threaded messages concurrently, each thread once.
+    Returns a dict of thread_ts to the ts ordered messages of that thread,
+    passed through convert(message) as each thread arrives if given.
+    """
+    thread_ids = []
+    for message in messages:
+        thread_ts = message.get("thread_ts")
+        if thread_ts and thread_ts not in thread_ids:
+            thread_ids.append(thread_ts)
+    if not thread_ids:
+        return {}
+
+    def fetch(thread_ts):
+        thread_messages = get_message_thread(
+            slack_client,
+            channel_id=channel_id,
+            thread_ts=thread_ts,
+            rate_limiter=rate_limiter,
+        )
+        thread_messages = sorted(thread_messages or [], key=lambda m: float(m["ts"]))
+        if convert is not None:
+            thread_messages = [convert(m) for m in thread_messages]
+        return thread_messages
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(thread_ids)),
+        thread_name_prefix="slack-threads",
+    ) as executor:
+        # each fetch runs in a copy of our context, so its stage is timed
+        # under the request's entrypoint
+        futures = [
+            executor.submit(contextvars.copy_context().run, fetch, thread_ts)
+            for thread_ts in thread_ids
+        ]
+        return {
+            thread_ts: future.result() for thread_ts, future in zip(thread_ids, futures)
+        }
+
+
+# hours per unit for /summarize time frames
+LOOKBACK_UNITS = {
+    "m": 1 / 60,
+    "min": 1 / 60,
+    "mins": 1 / 60,
+    "minute": 1 / 60,
+    "minutes": 1 / 60,
+    "h": 1,
+    "hr": 1,
+    "hrs": 1,
+    "hour": 1,
+    "hours": 1,
+    "d": 24,
+    "day": 24,
+    "days": 24,
+    "w": 24 * 7,
+    "wk": 24 * 7,
+    "wks": 24 * 7,
+    "week": 24 * 7,
+    "weeks": 24 * 7,
+}
+LOOKBACK_WORDS = {"today": 24, "yesterday": 48}
+LOOKBACK_PATTERN = re.compile(
+    r"^(?:(?:for|over|from|in)\s+)?(?:the\s+)?(?:(?:last|past|previous)\s+)?"
+    r"(\d+(?:\.\d+)?|an?|one)?\s*([a-z]+)?$"
+)
+
+
+def parse_lookback_hours(text):
+    """
+    Hours for common /summarize time frames ("2 hours", "3d", "last week",
+    "today"), 1 when none is given, None when it needs a closer read.
+    """
+    if re.search(r"-\s*\d", text or ""):
+        # a negative or range, not a time frame we can read as is
+        return None
+    text = re.sub(r"[^a-z0-9. ]", " ", (text or "").lower())
+    text = " ".join(text.split()).strip(" .")
+    if not text:
+        return 1
+    if text in LOOKBACK_WORDS:
+        return LOOKBACK_WORDS[text]
+    match = LOOKBACK_PATTERN.match(text)
+    if not match:
+        return None
+    amount, unit = match.groups()
+    if amount is None and unit is None:
+        return None
+    if unit is None:
+        # a bare number is hours
+        hours = float(amount)
+    elif unit not in LOOKBACK_UNITS:
+        return None
+    else:
+        amount = 1 if amount in (None, "a", "an", "one") else float(amount)
+        hours = amount * LOOKBACK_UNITS[unit]
+    if not valid_lookback(hours):
+        return None
+    return hours
+
+
+def valid_lookback(hours):
+    # a time frame we can summarize, not 0, negative, nan or infinite
+    return 0 < hours < float("inf")
@@ -0,0 +1,114 @@
+import logging
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+import main
+from publisher import decode_message
+
+
+# pull worker, an alternative to the push endpoint, run with
+#   python worker.py
+# it streams messages from a pull subscription and handles at most
+# WORKER_THREADS at once, so a fixed, always warm fleet gives a steady
+# throughput no matter how bursty slack is.
+
+logger = logging.getLogger()
+
+WORKER_SUBSCRIPTION = os.environ.get(
+    "WORKER_SUBSCRIPTION", "slack-messages-subscription"
+)
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "8"))
+# messages leased but not yet finished, beyond this the stream pauses
+WORKER_MAX_MESSAGES = int(os.environ.get("WORKER_MAX_MESSAGES", str(WORKER_THREADS)))
+WORKER_MAX_BYTES = int(os.environ.get("WORKER_MAX_BYTES", str(10 * 1024 * 1024)))
+# leases are extended in the background for up to this long, long summaries included
+WORKER_MAX_LEASE = int(os.environ.get("WORKER_MAX_LEASE", "3600"))
+# how long to let in progress messages finish after SIGTERM
+WORKER_DRAIN_TIMEOUT = float(os.environ.get("WORKER_DRAIN_TIMEOUT", "30"))
+
+
+def handle_pubsub_message(pubsub_message):
+    try:
+        message = decode_message(pubsub_message.data, pubsub_message.attributes)
+    except Exception as e:
+        # it won't decode any better next time
+        logger.error(f"pubsub message decode error: {e}")
+        pubsub_message.ack()
+        return
+    envelope = {"message": {"messageId": pubsub_message.message_id}}
+    if not main.first_delivery(envelope, message):
+        pubsub_message.ack()
+        return
+    try:
+        main.handle_admitted_message(message)
+    except Exception as e:
+        logger.error(f"handle_slack_message call error: {e}")
+        # retried on redelivery
+        main.release_delivery(envelope, message)
+        pubsub_message.nack()
+        return
+    pubsub_message.ack()
+
+
+def run(subscriber=None):
+    subscriber = subscriber or pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(
+        main.PROJECT_ID, WORKER_SUBSCRIPTION
+    )
+    streaming_pull = subscriber.subscribe(
+        subscription_path,
+        callback=handle_pubsub_message,
+        flow_control=pubsub_v1.types.FlowControl(
+            max_messages=WORKER_MAX_MESSAGES,
+            max_bytes=WORKER_MAX_BYTES,
+            max_lease_duration=WORKER_MAX_LEASE,
+        ),
+        scheduler=ThreadScheduler(
+            executor=ThreadPoolExecutor(
+                max_workers=WORKER_THREADS, thread_name_prefix="worker"
+            )
+        ),
+        # cancel() waits for running handlers instead of abandoning them
+        await_callbacks_on_shutdown=True,
+    )
+    logger.info(f"pulling from {subscription_path} with {WORKER_THREADS} threads")
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logger.info(f"received signal {signum}, draining")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping.wait(1):
+        if streaming_pull.done():
+            # the stream died on its own, let the platform restart us
+            logger.error(f"streaming pull stopped: {streaming_pull.exception()}")
+            break
+
+    # stop pulling, unstarted messages go back to pubsub, running ones finish
+    streaming_pull.cancel()
+
+    def wait_for_handlers():
+        try:
+            streaming_pull.result()
+        except Exception:
+            pass
+
+    drain = threading.Thread(target=wait_for_handlers, daemon=True)
+    drain.start()
+    drain.join(WORKER_DRAIN_TIMEOUT)
+    if drain.is_alive():
+        logger.error("drain timed out, remaining messages will be redelivered")
+    subscriber.close()
+    main.clients.close()
+
+
+if __name__ == "__main__":
+    run()
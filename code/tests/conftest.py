@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+# main can be imported without gcp or slack access
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-test")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "test")
+os.environ.setdefault("SLACK_TOKEN_VERIFICATION", "false")
+os.environ.setdefault("WARM_CLIENTS", "false")
+os.environ.setdefault("PROJECT_ID", "test")
+
+
+class FakeClock:
+    # a monotonic clock that only moves when told to
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+
+from admission import AdmissionController, AsyncAdmissionController
+from conftest import FakeClock
+
+
+def controller(cls=AdmissionController, **kwargs):
+    settings = dict(
+        user_rate=1 / 60,
+        user_burst=2,
+        channel_rate=1 / 60,
+        channel_burst=3,
+        max_concurrent=1,
+        max_wait=0,
+        clock=FakeClock(),
+    )
+    settings.update(kwargs)
+    return cls(**settings)
+
+
+def test_user_over_their_burst_is_shed_until_the_bucket_refills():
+    admission = controller(max_concurrent=10)
+    assert admission.admit("thread_reply", "U1", "C1") is None
+    assert admission.admit("thread_reply", "U1", "C2") is None
+    assert admission.admit("thread_reply", "U1", "C3") == "user"
+    # someone else is unaffected
+    assert admission.admit("thread_reply", "U2", "C3") is None
+    admission.clock.advance(60)
+    assert admission.admit("thread_reply", "U1", "C3") is None
+    assert admission.shed == 1
+
+
+def test_busy_channel_is_shed():
+    admission = controller(max_concurrent=10)
+    for user in ("U1", "U2", "U3"):
+        assert admission.admit("thread_reply", user, "C1") is None
+    assert admission.admit("thread_reply", "U4", "C1") == "channel"
+
+
+def test_shed_as_busy_when_no_slot_frees_up():
+    admission = controller()
+    assert admission.admit("thread_reply", "U1", "C1") is None
+    assert admission.admit("thread_reply", "U2", "C2") == "busy"
+    admission.release()
+    assert admission.admit("thread_reply", "U2", "C2") is None
+
+
+def test_shed_as_busy_when_too_many_are_waiting():
+    admission = controller(max_wait=30, max_waiting=0)
+    assert admission.admit("thread_reply", "U1", "C1") is None
+    assert admission.admit("thread_reply", "U2", "C2") == "busy"
+
+
+def test_freed_slot_goes_to_the_highest_priority_waiter():
+    admission = controller(max_wait=30)
+    assert admission.admit("thread_reply", "U1", "C1") is None
+    order = []
+
+    def wait(entrypoint, user):
+        admission.admit(entrypoint, user, user)
+        order.append(entrypoint)
+        admission.release()
+
+    waiters = []
+    for entrypoint, user in (
+        ("summarize_channel_request", "U2"),
+        ("summarize_thread_request", "U3"),
+        ("thread_reply", "U4"),
+    ):
+        waiter = threading.Thread(target=wait, args=(entrypoint, user))
+        waiter.start()
+        waiters.append(waiter)
+        while len(admission._waiting) < len(waiters):
+            time.sleep(0.001)
+    admission.release()
+    for waiter in waiters:
+        waiter.join(5)
+    assert order == [
+        "thread_reply",
+        "summarize_thread_request",
+        "summarize_channel_request",
+    ]
+    assert admission.active == 0
+
+
+def test_async_waiters_get_slots_by_priority_without_threads():
+    async def run():
+        admission = controller(AsyncAdmissionController, max_wait=30)
+        assert await admission.admit("thread_reply", "U1", "C1") is None
+        order = []
+
+        async def wait(entrypoint, user):
+            assert await admission.admit(entrypoint, user, user) is None
+            order.append(entrypoint)
+            admission.release()
+
+        summary = asyncio.ensure_future(wait("summarize_channel_request", "U2"))
+        reply = asyncio.ensure_future(wait("thread_reply", "U3"))
+        await asyncio.sleep(0)
+        assert len(admission._waiting) == 2
+        admission.release()
+        await asyncio.gather(summary, reply)
+        assert order == ["thread_reply", "summarize_channel_request"]
+        assert admission.active == 0
+
+    asyncio.run(run())
+
+
+def test_async_waiter_is_shed_after_max_wait():
+    async def run():
+        admission = controller(AsyncAdmissionController, max_wait=0.01)
+        assert await admission.admit("thread_reply", "U1", "C1") is None
+        assert await admission.admit("thread_reply", "U2", "C2") == "busy"
+        assert admission._waiting == []
+        # the slot isn't handed to the one that gave up
+        admission.release()
+        assert admission.active == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    async def run():
+        admission = controller(AsyncAdmissionController, max_wait=30)
+        assert await admission.admit("thread_reply", "U1", "C1") is None
+        waiter = asyncio.ensure_future(admission.admit("thread_reply", "U2", "C2"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert admission._waiting == []
+        admission.release()
+        assert admission.active == 0
+
+    asyncio.run(run())
@@ -0,0 +1,108 @@
+import asyncio
+
+from attachments import AttachmentCache, AttachmentFetcher
+
+
+class FakeResponse:
+    def __init__(self, body, chunk_size=10):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def chunks(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start : start + self.chunk_size]
+
+    def iter_content(self, size):
+        return self.chunks()
+
+    async def aiter_bytes(self, size):
+        for chunk in self.chunks():
+            yield chunk
+
+
+class FakeSession:
+    """requests.Session and httpx.AsyncClient over url to body"""
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.urls = []
+
+    def get(self, url, stream=True, timeout=None):
+        self.urls.append(url)
+        return FakeResponse(self.bodies[url])
+
+    def stream(self, method, url, timeout=None):
+        return self.get(url)
+
+
+def slack_file(file_id, size=None):
+    # slack's declared size is left out unless given
+    thread_file = {"id": file_id, "url_private": f"https://files/{file_id}"}
+    if size is not None:
+        thread_file["size"] = size
+    return thread_file
+
+
+def fetcher(session, **kwargs):
+    settings = dict(max_workers=1, max_file_bytes=100, max_thread_bytes=150)
+    settings.update(kwargs)
+    return AttachmentFetcher(lambda: session, **settings)
+
+
+def test_files_are_returned_whole():
+    session = FakeSession({"https://files/F1": b"x" * 45})
+    assert fetcher(session).fetch_all([slack_file("F1")]) == {"F1": b"x" * 45}
+
+
+def test_thread_cap_counts_bytes_received_not_declared():
+    session = FakeSession({f"https://files/F{i}": bytes([i]) * 80 for i in range(1, 4)})
+    files = fetcher(session).fetch_all(
+        [slack_file("F1"), slack_file("F2", size=1), slack_file("F3")]
+    )
+    # no size, or a wrong one, doesn't get past the 150 byte thread cap
+    assert list(files) == ["F1"]
+
+
+def test_dropped_file_gives_its_bytes_back():
+    session = FakeSession(
+        {"https://files/F1": b"x" * 120, "https://files/F2": b"y" * 90}
+    )
+    files = fetcher(session).fetch_all([slack_file("F1"), slack_file("F2")])
+    # F1 is over the file cap part way through, F2 still fits the thread
+    assert files == {"F2": b"y" * 90}
+
+
+def test_cached_files_count_against_the_thread():
+    session = FakeSession({"https://files/F2": b"y" * 90})
+    cache = AttachmentCache()
+    cache.put("F1", b"x" * 100)
+    files = fetcher(session, cache=cache).fetch_all(
+        [slack_file("F1"), slack_file("F2")]
+    )
+    assert files == {"F1": b"x" * 100}
+
+
+def test_async_thread_cap_counts_bytes_received():
+    session = FakeSession({f"https://files/F{i}": bytes([i]) * 80 for i in range(1, 4)})
+    files = asyncio.run(
+        fetcher(session).fetch_all_async(
+            session, [slack_file("F1"), slack_file("F2"), slack_file("F3")]
+        )
+    )
+    assert sorted(len(data) for data in files.values()) == [80]
@@ -0,0 +1,92 @@
+import json
+
+from dedupe import DedupeStore, RedisDedupeBackend, message_keys
+
+
+class FakeRedis:
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.keys.pop(key, None)
+
+
+class FakePubSubMessage:
+    def __init__(self, message, message_id="m1"):
+        self.data = json.dumps(message).encode("utf-8")
+        self.attributes = {}
+        self.message_id = message_id
+        self.acks = []
+
+    def ack(self):
+        self.acks.append("ack")
+
+    def nack(self):
+        self.acks.append("nack")
+
+
+MESSAGE = {"entrypoint": "thread_reply", "channel": "C1", "ts": "1.0", "user": "U1"}
+
+
+def test_claim_skips_a_redelivery():
+    store = DedupeStore()
+    keys = message_keys(MESSAGE, "m1")
+    assert store.claim(keys)
+    assert not store.claim(keys)
+    # a slack retry arrives with a new pubsub id
+    assert not store.claim(message_keys(MESSAGE, "m2"))
+
+
+def test_released_message_can_be_claimed_again():
+    redis = FakeRedis()
+    store = DedupeStore(backend=RedisDedupeBackend(redis))
+    keys = message_keys(MESSAGE, "m1")
+    assert store.claim(keys)
+    store.release(keys)
+    assert redis.keys == {}
+    assert store.claim(keys)
+    # another instance sharing the backend
+    assert not DedupeStore(backend=RedisDedupeBackend(redis)).claim(keys)
+
+
+class FlakySlack:
+    # chat.postMessage fails the first time, like a slack 5xx
+    def __init__(self):
+        self.posts = []
+
+    def chat_postMessage(self, **kwargs):
+        self.posts.append(kwargs)
+        if len(self.posts) == 1:
+            raise RuntimeError("slack unavailable")
+        return {"ok": True, "ts": "2.0"}
+
+
+def test_failed_pull_message_is_handled_on_redelivery(monkeypatch):
+    import main
+    import worker
+
+    slack = FlakySlack()
+    monkeypatch.setattr(main, "dedupe_store", DedupeStore())
+    monkeypatch.setattr(main, "slack_client", slack)
+    monkeypatch.setattr(main.greeting_pool, "get", lambda: "welcome!")
+    message = {"entrypoint": "greetings", "channel": "C1", "ts": "1.0", "user": "U1"}
+
+    first = FakePubSubMessage(message)
+    worker.handle_pubsub_message(first)
+    assert first.acks == ["nack"]
+    redelivery = FakePubSubMessage(message)
+    worker.handle_pubsub_message(redelivery)
+    assert redelivery.acks == ["ack"]
+    assert len(slack.posts) == 2
+    # a duplicate after it succeeded is still skipped
+    duplicate = FakePubSubMessage(message)
+    worker.handle_pubsub_message(duplicate)
+    assert duplicate.acks == ["ack"]
+    assert len(slack.posts) == 2
@@ -0,0 +1,37 @@
+import pytest
+
+from utils import parse_lookback_hours
+
+
+@pytest.mark.parametrize(
+    "text, hours",
+    [
+        ("", 1),
+        ("2 hours", 2),
+        ("3d", 72),
+        ("last week", 168),
+        ("the past 90 minutes", 1.5),
+        ("today", 24),
+        ("1.5", 1.5),
+    ],
+)
+def test_common_time_frames_are_read_locally(text, hours):
+    assert parse_lookback_hours(text) == hours
+
+
+@pytest.mark.parametrize(
+    "text", ["0", "0 hours", "-3", "- 3 days", "since monday", "1" * 400 + " weeks"]
+)
+def test_nonsense_needs_a_closer_read(text):
+    assert parse_lookback_hours(text) is None
+
+
+def test_model_answers_out_of_range_fall_back_to_an_hour(monkeypatch):
+    import main
+
+    answers = iter(["-3", "nan", "6"])
+    monkeypatch.setattr(main, "generate_text", lambda *args, **kwargs: next(answers))
+    assert main.summary_lookback("-3") == 1
+    assert main.summary_lookback("0") == 1
+    assert main.summary_lookback("since this morning") == 6
+    assert main.summary_lookback("2h") == 2
@@ -0,0 +1,39 @@
+from conftest import FakeClock
+from model_cache import ResponseCache
+
+
+def test_repeated_prompt_is_served_from_the_cache():
+    cache = ResponseCache(clock=FakeClock())
+    calls = []
+
+    def generate():
+        calls.append(1)
+        return "a summary", "pro"
+
+    assert cache.generate("pro", "summarize", {"t": 1}, generate) == "a summary"
+    assert cache.generate("pro", "summarize", {"t": 1}, generate) == "a summary"
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    # a different config is a different answer
+    cache.generate("pro", "summarize", {"t": 0}, generate)
+    assert len(calls) == 2
+
+
+def test_fallback_answer_is_not_served_as_the_preferred_model():
+    cache = ResponseCache(clock=FakeClock())
+    cache.generate("pro", "summarize", None, lambda: ("flash summary", "flash"))
+    assert (
+        cache.generate("pro", "summarize", None, lambda: ("pro summary", "pro"))
+        == "pro summary"
+    )
+    # while the preferred model is down the fallback's answer is reused
+    assert cache.generate("flash", "summarize", None, None) == "flash summary"
+
+
+def test_empty_answers_and_expired_ones_are_not_reused():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=60, clock=clock)
+    cache.generate("pro", "p", None, lambda: ("", "pro"))
+    assert cache.generate("pro", "p", None, lambda: ("text", "pro")) == "text"
+    clock.advance(61)
+    assert cache.generate("pro", "p", None, lambda: ("new", "pro")) == "new"
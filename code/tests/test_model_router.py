@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import FakeClock
+from model_router import ModelRouter, Route, load_routes, parse_target
+
+PRO = ("pro", "us-central1")
+FLASH = ("flash", "us-east1")
+
+
+class FakeModel:
+    """
+    A model client answering with its name after delay seconds, or raising
+    for the first fail calls.
+    """
+
+    def __init__(self, name, delay=0, fail=0, chunks=("a", "b")):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.chunks = chunks
+        self.calls = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            self.calls += 1
+            failing = self.calls <= self.fail
+        if failing:
+            raise RuntimeError(f"{self.name} unavailable")
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        self._start()
+        if stream:
+            return iter(SimpleNamespace(text=chunk) for chunk in self.chunks)
+        time.sleep(self.delay)
+        return SimpleNamespace(text=self.name)
+
+    async def generate_content_async(
+        self, contents, generation_config=None, stream=False
+    ):
+        self._start()
+        if stream:
+            return self._stream()
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return SimpleNamespace(text=self.name)
+
+    async def _stream(self):
+        for chunk in self.chunks:
+            yield SimpleNamespace(text=chunk)
+
+
+def router(models, clock=None, **route):
+    kwargs = {} if clock is None else {"clock": clock}
+    return ModelRouter(
+        lambda model_name, location: models[(model_name, location)],
+        {"default": Route(list(models), **route)},
+        min_samples=2,
+        **kwargs,
+    )
+
+
+def test_targets_parse_with_a_default_location():
+    assert parse_target("pro@europe-west4", "us-central1") == ("pro", "europe-west4")
+    assert parse_target(" flash ", "us-central1") == ("flash", "us-central1")
+
+
+def test_load_routes_replaces_defaults_and_ignores_bad_config():
+    defaults = {"default": Route([PRO])}
+    routes = load_routes(
+        defaults,
+        '{"classify": {"targets": "flash@us-east1,pro", "hedge_after": 2}}',
+        "us-central1",
+    )
+    assert routes["classify"].targets == [FLASH, PRO]
+    assert routes["classify"].hedge_after == 2
+    assert load_routes(defaults, "{not json", "us-central1") == defaults
+
+
+def test_fails_over_to_the_next_target():
+    models = {PRO: FakeModel("pro", fail=1), FLASH: FakeModel("flash")}
+    model_router = router(models)
+    response, target = model_router.generate_from("summary", "hi")
+    assert (response.text, target) == ("flash", FLASH)
+    assert model_router.generate("summary", "hi").text == "pro"
+
+
+def test_raises_the_last_error_when_every_target_fails():
+    models = {PRO: FakeModel("pro", fail=9), FLASH: FakeModel("flash", fail=9)}
+    with pytest.raises(RuntimeError, match="flash unavailable"):
+        router(models).generate("summary", "hi")
+
+
+def test_unhealthy_target_is_tried_last_until_its_errors_age_out():
+    clock = FakeClock()
+    models = {PRO: FakeModel("pro", fail=2), FLASH: FakeModel("flash")}
+    model_router = router(models, clock=clock)
+    model_router.generate("summary", "hi")
+    model_router.generate("summary", "hi")
+    assert model_router.targets("summary") == [FLASH, PRO]
+    assert model_router.generate("summary", "hi").text == "flash"
+    assert models[PRO].calls == 2
+    clock.advance(301)
+    assert model_router.targets("summary") == [PRO, FLASH]
+
+
+def test_fastest_orders_healthy_targets_by_latency():
+    models = {PRO: FakeModel("pro"), FLASH: FakeModel("flash")}
+    model_router = router(models, fastest=True)
+    model_router.record("summary", PRO, 2.0)
+    model_router.record("summary", FLASH, 0.5)
+    assert model_router.targets("summary") == [FLASH, PRO]
+
+
+def test_slow_call_is_hedged_with_the_next_target():
+    models = {PRO: FakeModel("pro", delay=1), FLASH: FakeModel("flash")}
+    model_router = router(models, hedge_after=0.05)
+    start = time.perf_counter()
+    response, target = model_router.generate_from("classify", "hi")
+    assert (response.text, target) == ("flash", FLASH)
+    assert time.perf_counter() - start < 0.5
+    model_router.close()
+
+
+def test_fast_call_is_not_hedged():
+    models = {PRO: FakeModel("pro"), FLASH: FakeModel("flash")}
+    model_router = router(models, hedge_after=1)
+    assert model_router.generate("classify", "hi").text == "pro"
+    assert models[FLASH].calls == 0
+    model_router.close()
+
+
+def test_hedged_call_still_fails_over():
+    models = {PRO: FakeModel("pro", fail=1), FLASH: FakeModel("flash")}
+    model_router = router(models, hedge_after=1)
+    assert model_router.generate("classify", "hi").text == "flash"
+    model_router.close()
+
+
+def test_stream_fails_over_before_the_first_chunk():
+    models = {PRO: FakeModel("pro", fail=1), FLASH: FakeModel("flash")}
+    chunks = router(models).stream("reply", "hi")
+    assert [chunk.text for chunk in chunks] == ["a", "b"]
+    assert models[FLASH].calls == 1
+
+
+def test_async_hedge_cancels_the_slower_call():
+    async def run():
+        models = {PRO: FakeModel("pro", delay=1), FLASH: FakeModel("flash")}
+        model_router = router(models, hedge_after=0.05)
+        response = await model_router.generate_async("classify", "hi")
+        await asyncio.sleep(0)
+        return response, models
+
+    response, models = asyncio.run(run())
+    assert response.text == "flash"
+    assert models[PRO].cancelled == 1
+
+
+def test_async_stream_fails_over():
+    async def run():
+        models = {PRO: FakeModel("pro", fail=1), FLASH: FakeModel("flash")}
+        chunks = await router(models).stream_async("reply", "hi")
+        return [chunk.text async for chunk in chunks]
+
+    assert asyncio.run(run()) == ["a", "b"]
@@ -0,0 +1,58 @@
+from concurrent.futures import Future
+
+from conftest import FakeClock
+from metrics import PUBLISH_SECONDS, registry
+from publisher import MessagePublisher, decode_message
+
+
+class FakePublisherClient:
+    # publish() futures stay pending until the test settles them
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic_path, data, **attributes):
+        future = Future()
+        self.published.append((data, attributes, future))
+        return future
+
+
+def test_confirm_latency_is_recorded_in_metrics():
+    clock = FakeClock()
+    client = FakePublisherClient()
+    publisher = MessagePublisher(
+        lambda: client, "projects/p/topics/t", compress_min_bytes=10, clock=clock
+    )
+    ok = PUBLISH_SECONDS.count(outcome="ok")
+    errors = PUBLISH_SECONDS.count(outcome="error")
+
+    publisher.publish({"entrypoint": "thread_reply", "text": "hi " * 10, "x": 1})
+    publisher.publish({"entrypoint": "greetings"})
+    assert publisher.stats()["in_flight"] == 2
+    clock.advance(0.2)
+    client.published[0][2].set_result("id-1")
+    client.published[1][2].set_exception(RuntimeError("unavailable"))
+
+    stats = publisher.stats()
+    assert (stats["published"], stats["failed"], stats["in_flight"]) == (1, 1, 0)
+    assert round(stats["latency_max"], 6) == 0.2
+    assert PUBLISH_SECONDS.count(outcome="ok") == ok + 1
+    assert PUBLISH_SECONDS.count(outcome="error") == errors + 1
+    assert 'slackbot_pubsub_publish_seconds_bucket{outcome="ok",le="0.25"}' in (
+        registry.render()
+    )
+    # slimmed and compressed
+    data, attributes, _ = client.published[0]
+    assert decode_message(data, attributes) == {
+        "entrypoint": "thread_reply",
+        "text": "hi " * 10,
+    }
+
+
+def test_publish_is_dropped_with_too_many_in_flight():
+    client = FakePublisherClient()
+    publisher = MessagePublisher(
+        lambda: client, "projects/p/topics/t", max_in_flight=1, block_timeout=0
+    )
+    assert publisher.publish({"entrypoint": "greetings"}) is not None
+    assert publisher.publish({"entrypoint": "greetings"}) is None
+    assert publisher.stats()["dropped"] == 1
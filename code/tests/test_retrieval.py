@@ -0,0 +1,161 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from slack_sdk.errors import SlackApiError
+
+from conftest import FakeClock
+from retrieval import HashEmbedder, RetrievalIndex, normalize
+
+LINES = [
+    ("1.0", "U1: alpha beta\n"),
+    ("2.0", "U2: gamma delta\n"),
+    ("3.0", "U3: epsilon zeta\n"),
+]
+
+
+def index(directory, **kwargs):
+    return RetrievalIndex(HashEmbedder(64), str(directory), **kwargs)
+
+
+def test_search_finds_messages_sharing_words(tmp_path):
+    retrieval = index(tmp_path)
+    assert retrieval.add("C1", LINES) == 3
+    hits = retrieval.search("C1", "what about gamma delta?", k=2)
+    assert hits[0][1:] == ("2.0", "U2: gamma delta\n")
+    assert hits[0][0] > 0.5
+    assert len(hits) == 2
+    assert retrieval.search("C1", "gamma", min_score=0.9) == []
+    assert retrieval.search("C2", "gamma") == []
+
+
+def test_only_newer_messages_are_added(tmp_path):
+    retrieval = index(tmp_path)
+    retrieval.add("C1", LINES[:2])
+    assert retrieval.add("C1", LINES) == 1
+    assert retrieval.channel("C1").ts == ["1.0", "2.0", "3.0"]
+
+
+def test_reload_from_disk(tmp_path):
+    index(tmp_path).add("C1", LINES)
+    reloaded = index(tmp_path)
+    assert reloaded.latest_ts("C1") == "3.0"
+    assert reloaded.search("C1", "epsilon zeta", k=1)[0][1] == "3.0"
+
+
+def test_reload_drops_vectors_written_without_their_lines(tmp_path):
+    retrieval = index(tmp_path)
+    retrieval.add("C1", LINES[:1])
+    vectors = retrieval.channel("C1")
+    # a crash after the vectors were written but before their lines
+    orphan = normalize(HashEmbedder(64).embed(["orphan row"]))
+    with open(vectors.vectors_path, "ab") as f:
+        f.write(orphan.astype(np.float32).tobytes())
+
+    reloaded = index(tmp_path)
+    reloaded.add("C1", LINES)
+    hits = reloaded.search("C1", "epsilon zeta", k=1)
+    assert hits[0][1:] == ("3.0", "U3: epsilon zeta\n")
+    assert hits[0][0] > 0.5
+    # and the files stay in step for the next restart
+    again = index(tmp_path).channel("C1")
+    assert again.ts == ["1.0", "2.0", "3.0"]
+    assert again.matrix().shape == (3, 64)
+
+
+def test_reload_drops_a_line_cut_short(tmp_path):
+    retrieval = index(tmp_path)
+    retrieval.add("C1", LINES[:2])
+    with open(retrieval.channel("C1").lines_path, "a") as f:
+        f.write('["3.0", "U3: eps')
+    reloaded = index(tmp_path)
+    assert reloaded.channel("C1").ts == ["1.0", "2.0"]
+    reloaded.add("C1", LINES)
+    assert index(tmp_path).search("C1", "epsilon zeta", k=1)[0][1] == "3.0"
+
+
+def test_refresh_runs_in_the_background_once_per_interval(tmp_path):
+    clock = FakeClock()
+    retrieval = index(tmp_path, clock=clock)
+    started = threading.Event()
+    release = threading.Event()
+    updates = []
+
+    def update(channel_id):
+        updates.append(channel_id)
+        started.set()
+        release.wait(5)
+        retrieval.add(channel_id, LINES)
+
+    running = retrieval.refresh("C1", 60, update)
+    assert running is not None
+    started.wait(5)
+    # the caller searches what's indexed while the backfill runs
+    assert retrieval.search("C1", "alpha") == []
+    clock.advance(120)
+    assert retrieval.refresh("C1", 60, update) is None
+    release.set()
+    running.result(5)
+    assert retrieval.search("C1", "alpha beta", k=1)[0][1] == "1.0"
+    # due again only once the interval has passed
+    assert retrieval.refresh("C1", 300, update) is None
+    clock.advance(300)
+    retrieval.refresh("C1", 300, update).result(5)
+    assert updates == ["C1", "C1"]
+    retrieval.close()
+
+
+def test_failed_refresh_is_retried_next_interval(tmp_path):
+    clock = FakeClock()
+    retrieval = index(tmp_path, clock=clock)
+
+    def update(channel_id):
+        raise RuntimeError("slack unavailable")
+
+    retrieval.refresh("C1", 60, update).result(5)
+    assert retrieval.refresh("C1", 60, update) is None
+    clock.advance(60)
+    assert retrieval.refresh("C1", 60, update) is not None
+    retrieval.close()
+
+
+def test_embedder_with_another_dimension_starts_the_channel_over(tmp_path):
+    index(tmp_path).add("C1", LINES[:2])
+    switched = RetrievalIndex(HashEmbedder(32), str(tmp_path))
+    # the old rows can't be searched with the new embedder
+    assert switched.search("C1", "alpha beta") == []
+    # nor can the newer messages be added behind them
+    assert switched.add("C1", LINES) == 0
+    assert switched.latest_ts("C1") is None
+    # so the next update is a full backfill
+    assert switched.add("C1", LINES) == 3
+    assert switched.channel("C1").matrix().shape == (3, 32)
+    assert switched.search("C1", "alpha beta", k=1)[0][1] == "1.0"
+
+
+class FailingHistory:
+    """conversations.history, newest first one message a page, failing on the second page"""
+
+    def conversations_history(self, channel, limit, cursor=None, **bounds):
+        if cursor:
+            response = SimpleNamespace(status_code=500, headers={})
+            raise SlackApiError("internal_error", response)
+        return {
+            "ok": True,
+            "messages": [{"ts": f"{time.time():.6f}", "user": "U3", "text": "newest"}],
+            "has_more": True,
+            "response_metadata": {"next_cursor": "page:1"},
+        }
+
+
+def test_fetch_failing_part_way_indexes_nothing(tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "slack_client", FailingHistory())
+    monkeypatch.setattr(main, "retrieval_index", index(tmp_path))
+    with pytest.raises(SlackApiError):
+        main.update_channel_index("C1")
+    # indexing the newest page alone would skip what came before it for good
+    assert main.retrieval_index.latest_ts("C1") is None
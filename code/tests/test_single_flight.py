@@ -0,0 +1,46 @@
+import main
+from conftest import FakeClock
+from single_flight import SingleFlight
+
+
+class FakeSlack:
+    def __init__(self):
+        self.ephemerals = []
+
+    def chat_postEphemeral(self, **kwargs):
+        self.ephemerals.append(kwargs)
+
+
+def test_joiners_are_handed_to_the_leader():
+    flights = SingleFlight(clock=FakeClock())
+    assert flights.begin("k", "a") == ("lead", None)
+    assert flights.begin("k", "b") == ("joined", None)
+    assert flights.finish("k", "summary") == ["a", "b"]
+    assert flights.begin("k", "c") == ("cached", "summary")
+
+
+def test_failed_flight_is_not_cached():
+    flights = SingleFlight(clock=FakeClock())
+    flights.begin("k", "a")
+    assert flights.finish("k", None) == ["a"]
+    assert flights.begin("k", "b") == ("lead", None)
+
+
+def test_everyone_is_told_when_the_summary_fails(monkeypatch):
+    slack = FakeSlack()
+    monkeypatch.setattr(main, "slack_client", slack)
+    monkeypatch.setattr(main, "summary_flights", SingleFlight(clock=FakeClock()))
+    key = ("summarize_channel_request", "C1", 24)
+
+    def summarize():
+        # a second request for the same summary arrives while this one runs
+        main.coalesced_summary(key, ("C1", "U2"), summarize)
+        raise RuntimeError("model unavailable")
+
+    main.coalesced_summary(key, ("C1", "U1"), summarize)
+    assert [post["user"] for post in slack.ephemerals] == ["U1", "U2"]
+    assert all(
+        post["text"] == main.SUMMARY_FAILED_NOTICE["text"] for post in slack.ephemerals
+    )
+    # the failure isn't handed to the next request
+    assert main.summary_flights.begin(key, ("C1", "U3")) == ("lead", None)
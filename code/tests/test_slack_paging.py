@@ -0,0 +1,150 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from slack_sdk.errors import SlackApiError
+
+import utils
+from utils import get_channel_messages, iter_channel_pages, iter_slack_pages
+
+
+def slack_error(status_code, headers=None):
+    response = SimpleNamespace(status_code=status_code, headers=headers or {})
+    return SlackApiError(f"{status_code}", response)
+
+
+class FakePagedSlack:
+    """
+    conversations.history over messages newest first, paged with opaque
+    cursors. Doesn't filter by oldest itself, so the early stop shows.
+    errors maps a call number to the SlackApiError it raises.
+    """
+
+    def __init__(self, count, errors=None):
+        self.messages = [
+            {"ts": f"{1000 + i}.000000", "text": f"message {i}"}
+            for i in reversed(range(count))
+        ]
+        self.errors = errors or {}
+        self.calls = []
+
+    def conversations_history(self, channel, limit, cursor=None, **bounds):
+        self.calls.append(dict(bounds, limit=limit, cursor=cursor))
+        error = self.errors.pop(len(self.calls), None)
+        if error is not None:
+            raise error
+        start = int(cursor.split(":")[1]) if cursor else 0
+        page = self.messages[start : start + limit]
+        more = start + limit < len(self.messages)
+        return {
+            "ok": True,
+            "messages": page,
+            "has_more": more,
+            # only the cursor says where the next page starts
+            "response_metadata": {
+                "next_cursor": f"page:{start + limit}" if more else ""
+            },
+        }
+
+
+@pytest.fixture(autouse=True)
+def no_sleeping(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+    monkeypatch.setattr(utils.random, "uniform", lambda low, high: 0)
+    return sleeps
+
+
+def test_pages_follow_the_cursor_only():
+    slack = FakePagedSlack(25)
+    pages = list(
+        iter_slack_pages(slack.conversations_history, page_size=10, channel="C1")
+    )
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [call["cursor"] for call in slack.calls] == [None, "page:10", "page:20"]
+    # no latest/ts bookkeeping between pages
+    assert all(set(call) == {"limit", "cursor"} for call in slack.calls)
+
+
+def test_paging_is_lazy():
+    slack = FakePagedSlack(25)
+    pages = iter_slack_pages(slack.conversations_history, page_size=10, channel="C1")
+    next(pages)
+    assert len(slack.calls) == 1
+
+
+def test_rate_limited_page_is_retried_after_retry_after(no_sleeping):
+    slack = FakePagedSlack(25, errors={2: slack_error(429, {"Retry-After": "3"})})
+    pages = list(iter_channel_pages(slack, "C1", page_size=10))
+    assert sum(len(page) for page in pages) == 25
+    assert no_sleeping == [3.0]
+    assert [call["cursor"] for call in slack.calls] == [
+        None,
+        "page:10",
+        "page:10",
+        "page:20",
+    ]
+
+
+def test_retry_after_is_read_in_any_case(no_sleeping):
+    errors = {
+        2: slack_error(429, {"retry-after": "4"}),
+        3: slack_error(429, {"RETRY-AFTER": ["5"]}),
+        4: slack_error(429, {}),
+    }
+    slack = FakePagedSlack(25, errors=errors)
+    pages = list(iter_channel_pages(slack, "C1", page_size=10))
+    assert sum(len(page) for page in pages) == 25
+    assert no_sleeping == [4.0, 5.0, 1.0]
+
+
+def test_async_retry_after_is_read_in_any_case(monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(utils.asyncio, "sleep", sleep)
+    errors = [slack_error(429, {"retry-after": "2"})]
+
+    async def method(**kwargs):
+        if errors:
+            raise errors.pop()
+        return {"ok": True}
+
+    assert asyncio.run(utils.async_slack_call(method)) == {"ok": True}
+    assert sleeps == [2.0]
+
+
+def test_channel_pages_stop_at_oldest():
+    slack = FakePagedSlack(100)
+    pages = list(iter_channel_pages(slack, "C1", oldest="1085.000000", page_size=10))
+    messages = [message for page in pages for message in page]
+    assert [m["ts"] for m in messages] == [
+        f"{1000 + i}.000000" for i in reversed(range(85, 100))
+    ]
+    # the second page reached past oldest, nothing older was fetched
+    assert len(slack.calls) == 2
+    assert slack.calls[0]["oldest"] == "1085.000000"
+
+
+def test_channel_pages_include_latest():
+    slack = FakePagedSlack(10)
+    list(iter_channel_pages(slack, "C1", latest="1005.000000"))
+    assert slack.calls[0]["latest"] == "1005.000000"
+    assert slack.calls[0]["inclusive"] is True
+
+
+def test_channel_messages_keep_what_arrived_before_an_error():
+    slack = FakePagedSlack(50, errors={3: slack_error(500)})
+    messages = get_channel_messages(slack, "C1", message_count=10)
+    assert len(messages) == 20
+    assert messages[0]["ts"] == "1049.000000"
+
+
+def test_channel_messages_give_up_after_repeated_rate_limits(no_sleeping):
+    errors = {call: slack_error(429, {"Retry-After": "1"}) for call in range(2, 6)}
+    slack = FakePagedSlack(50, errors=errors)
+    messages = get_channel_messages(slack, "C1", message_count=10)
+    assert len(messages) == 10
+    assert len(no_sleeping) == 3
@@ -0,0 +1,208 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from slack_sdk.errors import SlackApiError
+
+import utils
+from conftest import FakeClock
+from streaming import (
+    INCOMPLETE_NOTICE,
+    AsyncStreamingReply,
+    SECTION_LIMIT,
+    StreamingReply,
+    markdown_blocks,
+    still_streaming,
+)
+from thread_state import ThreadStateStore
+
+
+class FakeSlack:
+    """Records chat.postMessage and chat.update, failing the first few updates with 429s"""
+
+    def __init__(self, rate_limited=0):
+        self.calls = []
+        self.rate_limited = rate_limited
+
+    def chat_postMessage(self, **kwargs):
+        self.calls.append(("post", kwargs))
+        return {"ok": True, "ts": "2.0"}
+
+    def chat_update(self, **kwargs):
+        if self.rate_limited and "blocks" in kwargs:
+            self.rate_limited -= 1
+            response = SimpleNamespace(status_code=429, headers={"Retry-After": "2"})
+            raise SlackApiError("ratelimited", response)
+        self.calls.append(("update", kwargs))
+        return {"ok": True, "ts": kwargs["ts"]}
+
+
+class FakeAsyncSlack(FakeSlack):
+    async def chat_postMessage(self, **kwargs):
+        return FakeSlack.chat_postMessage(self, **kwargs)
+
+    async def chat_update(self, **kwargs):
+        return FakeSlack.chat_update(self, **kwargs)
+
+
+def chunks(*texts, clock=None, step=0.5):
+    # a fake model stream, the clock moves between chunks
+    for text in texts:
+        yield SimpleNamespace(text=text)
+        if clock is not None:
+            clock.advance(step)
+
+
+def test_first_chunk_is_posted_right_away():
+    slack = FakeSlack()
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    reply.add("Hello")
+    assert slack.calls == [
+        ("post", {"channel": "C1", "text": "Hello ...", "thread_ts": "1.0"})
+    ]
+    assert reply.ts == "2.0"
+
+
+def test_chunks_between_updates_are_coalesced():
+    slack = FakeSlack()
+    clock = FakeClock()
+    reply = StreamingReply(
+        slack, channel="C1", thread_ts="1.0", min_interval=1.5, clock=clock
+    )
+    # posted at 0, then chunks at 0.5, 1.0 ... 3.0
+    reply.run(chunks("a", "b", "c", "d", "e", "f", "g", clock=clock))
+    interim = [kwargs["text"] for kind, kwargs in slack.calls if kind == "update"]
+    assert slack.calls[0][0] == "post"
+    assert interim[:-1] == ["abcd ...", "abcdefg ..."]
+    final = slack.calls[-1][1]
+    assert final["text"] == "abcdefg"
+    assert final["blocks"] == markdown_blocks("abcdefg")
+
+
+def test_long_final_answer_is_split_into_blocks():
+    paragraphs = ["x" * 2000, "y" * 2000, "z" * 100]
+    text = "\n\n".join(paragraphs)
+    blocks = markdown_blocks(text)
+    assert [block["text"]["text"] for block in blocks] == paragraphs[:1] + [
+        "\n\n".join(paragraphs[1:])
+    ]
+    assert all(len(block["text"]["text"]) <= SECTION_LIMIT for block in blocks)
+
+    slack = FakeSlack()
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    assert reply.run(chunks(text)) == text
+    final = slack.calls[-1][1]
+    assert final["blocks"] == blocks
+    assert len(final["text"]) == SECTION_LIMIT
+
+
+def test_empty_stream_posts_the_fallback():
+    slack = FakeSlack()
+    StreamingReply(slack, channel="C1", thread_ts="1.0").run(chunks())
+    assert [kind for kind, _ in slack.calls] == ["post"]
+    assert slack.calls[0][1]["text"] == "Hrm.. dunno how to respond"
+
+
+def test_final_update_waits_out_a_429(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+    monkeypatch.setattr(utils.random, "uniform", lambda low, high: 0)
+    slack = FakeSlack(rate_limited=2)
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    assert reply.run(chunks("all ", "done")) == "all done"
+    assert sleeps == [2.0, 2.0]
+    assert slack.calls[-1][1]["text"] == "all done"
+
+
+def test_final_update_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+    slack = FakeSlack(rate_limited=10)
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    with pytest.raises(SlackApiError):
+        reply.run(chunks("all done"))
+
+
+def failing_stream(*texts):
+    # the model stream breaks after texts
+    yield from chunks(*texts)
+    raise RuntimeError("stream reset")
+
+
+def test_failed_stream_is_marked_incomplete():
+    slack = FakeSlack()
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    with pytest.raises(RuntimeError):
+        reply.run(failing_stream("half an ", "answer"))
+    final = slack.calls[-1][1]
+    assert final["text"] == "half an answer" + INCOMPLETE_NOTICE
+    assert final["blocks"] == markdown_blocks("half an answer" + INCOMPLETE_NOTICE)
+    assert not still_streaming(dict(final, bot_id="B1"))
+
+
+def test_stream_failing_before_any_text_posts_the_notice():
+    slack = FakeSlack()
+    reply = StreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    with pytest.raises(RuntimeError):
+        reply.run(failing_stream())
+    assert [kind for kind, _ in slack.calls] == ["post"]
+    assert slack.calls[0][1]["text"] == INCOMPLETE_NOTICE.lstrip("\n")
+
+
+def test_async_failed_stream_is_marked_incomplete():
+    async def stream():
+        for chunk in failing_stream("half"):
+            yield chunk
+
+    slack = FakeAsyncSlack()
+    reply = AsyncStreamingReply(slack, channel="C1", thread_ts="1.0", clock=FakeClock())
+    with pytest.raises(RuntimeError):
+        asyncio.run(reply.run(stream()))
+    assert slack.calls[-1][1]["text"] == "half" + INCOMPLETE_NOTICE
+
+
+def test_async_reply_streams_the_same_way():
+    async def stream(clock):
+        for chunk in chunks("a", "b", "c", "d", clock=clock):
+            yield chunk
+
+    slack = FakeAsyncSlack()
+    clock = FakeClock()
+    reply = AsyncStreamingReply(
+        slack, channel="C1", thread_ts="1.0", min_interval=1.5, clock=clock
+    )
+    assert asyncio.run(reply.run(stream(clock))) == "abcd"
+    assert [kind for kind, _ in slack.calls] == ["post", "update", "update"]
+    assert slack.calls[1][1]["text"] == "abcd ..."
+    assert slack.calls[-1][1]["blocks"] == markdown_blocks("abcd")
+
+
+def test_partial_reply_is_fetched_again():
+    partial = {"bot_id": "B1", "ts": "2.0", "text": "half an answer ..."}
+    final = dict(partial, text="the answer ...", blocks=markdown_blocks("x"))
+    assert still_streaming(partial)
+    assert not still_streaming(final)
+    assert not still_streaming({"user": "U1", "text": "hmm ..."})
+
+    store = ThreadStateStore(lambda role, parts: (role, parts), clock=FakeClock())
+    state = store.get("C1", "1.0")
+    state.add_message("model", ["half an answer"], "2.0")
+    assert store.get("C1", "1.0") is state
+    state.stale = True
+    assert store.get("C1", "1.0") is not state
+
+
+def test_thread_state_holding_a_partial_reply_is_rebuilt():
+    import main
+
+    state = main.thread_states.get("CSTREAM", "1.0")
+    main.add_thread_messages(
+        state,
+        [
+            {"user": "U1", "ts": "1.0", "text": "what changed?"},
+            {"bot_id": "B1", "ts": "2.0", "text": "the config ..."},
+            {"user": "U1", "ts": "3.0", "text": "which part?"},
+        ],
+        {},
+    )
+    assert state.stale
+    assert main.thread_states.get("CSTREAM", "1.0").last_ts is None
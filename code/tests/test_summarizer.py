@@ -0,0 +1,192 @@
+import threading
+
+import pytest
+
+from summarizer import (
+    CHUNK_PROMPT,
+    COMBINE_PROMPT,
+    FINAL_PROMPT,
+    SUMMARY_PROMPT,
+    THREAD_PROMPT,
+    SummarizationEngine,
+    SummarizationError,
+)
+
+
+class FakeModel:
+    """Records prompts and answers each with a short summary naming its kind"""
+
+    KINDS = {
+        SUMMARY_PROMPT: "whole",
+        CHUNK_PROMPT: "chunk",
+        THREAD_PROMPT: "thread",
+        COMBINE_PROMPT: "combined",
+        FINAL_PROMPT: "final",
+    }
+
+    def __init__(self, fail_on=None):
+        self.prompts = []
+        self.fail_on = fail_on
+        self._lock = threading.Lock()
+
+    def kind(self, prompt):
+        for template, kind in self.KINDS.items():
+            if prompt.startswith(template.split("{")[0]):
+                return kind
+
+    def __call__(self, prompt):
+        with self._lock:
+            self.prompts.append(prompt)
+        if self.fail_on and self.fail_on in prompt:
+            raise RuntimeError("model unavailable")
+        return f"{self.kind(prompt)} summary {len(self.prompts)}"
+
+    def kinds(self):
+        return sorted(self.kind(prompt) for prompt in self.prompts)
+
+
+def lines(start, count, width=40):
+    # (ts, line) of width characters, about width / 4 tokens each
+    return [
+        (f"{start + i}.000000", f"U{i}: {'x' * (width - 6)} {i % 10}\n")
+        for i in range(count)
+    ]
+
+
+def engine(model, **kwargs):
+    settings = dict(chunk_tokens=100, thread_min_tokens=50, max_workers=2)
+    settings.update(kwargs)
+    return SummarizationEngine(model, **settings)
+
+
+def test_short_conversation_is_one_call():
+    model = FakeModel()
+    summary = engine(model).summarize("C1", lines(1000, 5), {})
+    assert summary == "whole summary 1"
+    assert "U4:" in model.prompts[0]
+
+
+def test_long_conversation_is_chunked_then_combined():
+    model = FakeModel()
+    summarizer = engine(model)
+    # about 11 tokens a line, 9 lines a chunk
+    summary = summarizer.summarize("C1", lines(1000, 30), {})
+    assert summary.startswith("final summary")
+    assert model.kinds() == ["chunk"] * 4 + ["final"]
+    chunks = [prompt for prompt in model.prompts if model.kind(prompt) == "chunk"]
+    assert "".join(chunks).count("U") == 30
+    summarizer.close()
+
+
+def test_big_threads_are_their_own_units_small_ones_inline():
+    model = FakeModel()
+    summarizer = engine(model)
+    threads = {
+        "1000.000000": lines(1000, 8),  # ~88 tokens, its own unit
+        "1001.000000": lines(1001, 2),  # small, read inline
+    }
+    summarizer.summarize("C1", lines(1000, 3), threads)
+    assert model.kinds() == ["chunk", "final", "thread"]
+    summarizer.close()
+
+
+def test_combines_reduce_many_partials():
+    model = FakeModel()
+    summarizer = engine(model, chunk_tokens=100)
+    # ~28 tokens each, three to a combine call
+    partials = [f"partial {i} " + "y" * 100 for i in range(10)]
+    summary = summarizer._reduce(partials)
+    assert summary.startswith("final summary")
+    assert model.kinds() == ["combined"] * 4 + ["final"]
+    combines = [p for p in model.prompts if model.kind(p) == "combined"]
+    assert [p.count("y" * 100) for p in combines] == [3, 3, 3, 1]
+    summarizer.close()
+
+
+def test_thread_summaries_are_memoized_by_their_last_reply():
+    model = FakeModel()
+    summarizer = engine(model)
+    thread = lines(1000, 8)
+    summarizer.summarize("C1", lines(2000, 3), {"1000.000000": thread})
+    assert model.kinds().count("thread") == 1
+    # an overlapping window with the same thread
+    summarizer.summarize("C1", lines(2001, 3), {"1000.000000": thread})
+    assert model.kinds().count("thread") == 1
+    # a new reply means a new summary
+    summarizer.summarize("C1", lines(2001, 3), {"1000.000000": thread + lines(1100, 1)})
+    assert model.kinds().count("thread") == 2
+    summarizer.close()
+
+
+def test_failed_part_is_left_out():
+    # lines 9 to 17 are the second chunk
+    model = FakeModel(fail_on="U13:")
+    summarizer = engine(model)
+    summary = summarizer.summarize("C1", lines(1000, 30), {})
+    assert summary.startswith("final summary")
+    final = model.prompts[-1]
+    assert final.count("chunk summary") == 3
+    assert "1 part(s) of the conversation couldn't be summarized" in summary
+    summarizer.close()
+
+
+def test_every_part_failing_raises():
+    model = FakeModel(fail_on="U")
+    summarizer = engine(model)
+    with pytest.raises(SummarizationError):
+        summarizer.summarize("C1", lines(1000, 30), {})
+    # no final call over an empty conversation
+    assert "final" not in model.kinds()
+    summarizer.close()
+
+
+def test_every_combine_failing_raises():
+    model = FakeModel(fail_on="combining")
+    summarizer = engine(model)
+    with pytest.raises(SummarizationError):
+        summarizer._reduce([f"partial {i} " + "y" * 100 for i in range(10)])
+    assert "final" not in model.kinds()
+    summarizer.close()
+
+
+def test_failed_combine_is_noted():
+    model = FakeModel(fail_on="partial 0 ")
+    summarizer = engine(model)
+    summary = summarizer._reduce([f"partial {i} " + "y" * 100 for i in range(10)])
+    assert summary.startswith("final summary")
+    # the first combine held three partials
+    assert "3 part(s) of the conversation" in summary
+    summarizer.close()
+
+
+def test_segments_reuse_saved_partials():
+    model = FakeModel()
+    summarizer = engine(model)
+    summary, partials = summarizer.summarize_segments(
+        "C1",
+        [
+            (["saved hour"], [], {}),
+            (None, lines(1000, 2), {}),  # too small for a call, kept as text
+            (None, lines(2000, 12), {}),
+        ],
+    )
+    assert summary.startswith("final summary")
+    assert partials[0] == ["saved hour"]
+    assert partials[1][0].startswith("U0:")
+    assert all(p.startswith("chunk summary") for p in partials[2])
+    assert "saved hour" in model.prompts[-1]
+    summarizer.close()
+
+
+def test_failed_segment_is_reported():
+    model = FakeModel(fail_on="U")
+    summarizer = engine(model)
+    with pytest.raises(SummarizationError):
+        summarizer.summarize_segments("C1", [(None, lines(1000, 12), {})])
+    # one chunk of the segment fails, the segment isn't saved
+    model.fail_on = "U3:"
+    summary, partials = summarizer.summarize_segments(
+        "C1", [(["saved"], [], {}), (None, lines(1000, 12), {})]
+    )
+    assert partials == [["saved"], None]
+    summarizer.close()
@@ -0,0 +1,126 @@
+import pytest
+
+from conftest import FakeClock
+from thread_index import (
+    FileThreadBackend,
+    MemoryThreadBackend,
+    RedisThreadBackend,
+    ThreadIndex,
+    thread_index_from_env,
+)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, ex=None):
+        self.keys[key] = value
+
+    def exists(self, key):
+        return int(key in self.keys)
+
+
+class BrokenBackend:
+    shared = True
+
+    def contains(self, key):
+        raise ConnectionError("down")
+
+    def add(self, key, ttl):
+        raise ConnectionError("down")
+
+
+def test_memory_backend_expires():
+    clock = FakeClock()
+    index = ThreadIndex(ttl=60, clock=clock)
+    assert index.lookup("C1", "1.0") is None
+    index.add("C1", "1.0")
+    assert index.lookup("C1", "1.0") is True
+    clock.advance(61)
+    assert index.lookup("C1", "1.0") is None
+
+
+def test_negative_expires():
+    clock = FakeClock()
+    index = ThreadIndex(negative_ttl=30, clock=clock)
+    index.add_negative("C1", "1.0")
+    assert index.lookup("C1", "1.0") is False
+    clock.advance(31)
+    assert index.lookup("C1", "1.0") is None
+
+
+def test_add_clears_negative():
+    index = ThreadIndex(clock=FakeClock())
+    index.add_negative("C1", "1.0")
+    index.add("C1", "1.0")
+    assert index.lookup("C1", "1.0") is True
+
+
+def test_shared_positive_overrides_local_negative():
+    # ingress decided "not ours" before the worker joined the thread
+    backend = RedisThreadBackend(FakeRedis())
+    ingress = ThreadIndex(backend=backend, clock=FakeClock())
+    worker = ThreadIndex(backend=backend, clock=FakeClock())
+    ingress.add_negative("C1", "1.0")
+    assert ingress.lookup("C1", "1.0") is False
+    worker.add("C1", "1.0")
+    assert ingress.lookup("C1", "1.0") is True
+
+
+def test_negative_ttl_zero_disables_negatives():
+    index = ThreadIndex(negative_ttl=0, clock=FakeClock())
+    index.add_negative("C1", "1.0")
+    assert index.lookup("C1", "1.0") is None
+
+
+def test_authoritative_only_with_shared_backend():
+    memory = ThreadIndex(backend=MemoryThreadBackend(), authoritative=True)
+    assert memory.lookup("C1", "1.0") is None
+    shared = ThreadIndex(backend=RedisThreadBackend(FakeRedis()), authoritative=True)
+    assert shared.lookup("C1", "1.0") is False
+
+
+def test_backend_errors_fall_back_to_negatives():
+    index = ThreadIndex(backend=BrokenBackend(), authoritative=True)
+    assert index.lookup("C1", "1.0") is None
+    index.add_negative("C1", "1.0")
+    assert index.lookup("C1", "1.0") is False
+
+
+def test_file_backend_shared_between_instances(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "threads")
+    one = ThreadIndex(backend=FileThreadBackend(path, clock=clock), ttl=60)
+    two = ThreadIndex(
+        backend=FileThreadBackend(path, clock=clock), negative_ttl=90, clock=clock
+    )
+    two.add_negative("C1", "1.0")
+    one.add("C1", "1.0")
+    assert two.lookup("C1", "1.0") is True
+    # the shared entry expires, the local negative is still live
+    clock.advance(61)
+    assert two.lookup("C1", "1.0") is False
+
+
+def test_file_backend_compacts(tmp_path):
+    clock = FakeClock()
+    path = tmp_path / "threads"
+    writer = FileThreadBackend(str(path), max_size=2, clock=clock)
+    reader = FileThreadBackend(str(path), max_size=2, clock=clock)
+    writer.add("old", 10)
+    clock.advance(20)
+    for key in ["a", "b", "c", "d"]:
+        writer.add(key, 60)
+    assert len(path.read_text().splitlines()) <= 4
+    assert not reader.contains("old")
+    assert reader.contains("d")
+    # appends after the rewrite are still picked up
+    writer.add("e", 60)
+    assert reader.contains("e")
+
+
+def test_configured_backend_fails_loudly(monkeypatch):
+    monkeypatch.setenv("THREAD_INDEX_BACKEND", "memcache")
+    with pytest.raises(ValueError):
+        thread_index_from_env(60, 30, 100)
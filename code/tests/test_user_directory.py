@@ -0,0 +1,106 @@
+import threading
+
+from conftest import FakeClock
+from user_directory import UserDirectory
+
+
+class FakeSlack:
+    """users.list in pages of two, users.list can be held open or made to fail"""
+
+    def __init__(self, users):
+        self.users = users
+        self.list_calls = 0
+        self.info_calls = []
+        self.listing = threading.Event()
+        self.hold = threading.Event()
+        self.hold.set()
+        self.fail = False
+
+    def users_list(self, limit, cursor=None):
+        self.list_calls += 1
+        self.listing.set()
+        self.hold.wait(5)
+        if self.fail:
+            raise RuntimeError("users.list unavailable")
+        start = int(cursor or 0)
+        members = [
+            {"id": user_id, "profile": {"real_name": name}}
+            for user_id, name in list(self.users.items())[start : start + 2]
+        ]
+        more = start + 2 < len(self.users)
+        return {
+            "members": members,
+            "response_metadata": {"next_cursor": str(start + 2) if more else ""},
+        }
+
+    def users_info(self, user):
+        self.info_calls.append(user)
+        return {"user": {"id": user, "profile": {"real_name": self.users[user]}}}
+
+
+USERS = {f"U{i}": f"Person {i}" for i in range(6)}
+
+
+def directory(slack, **kwargs):
+    return UserDirectory(slack, warm_threshold=3, clock=FakeClock(), **kwargs)
+
+
+def test_names_are_looked_up_once():
+    slack = FakeSlack(USERS)
+    users = directory(slack)
+    assert users.name("U1") == "Person 1"
+    assert users.name("U1") == "Person 1"
+    assert slack.info_calls == ["U1"]
+
+
+def test_warm_runs_in_the_background_while_the_batch_resolves_its_own():
+    slack = FakeSlack(USERS)
+    slack.hold.clear()
+    users = directory(slack)
+    users.prepare_users(["U0", "U1", "U2"])
+    assert slack.listing.wait(5)
+    # users.list is still running, the batch's names come from users.info
+    assert [users.name(user_id) for user_id in ("U0", "U1")] == [
+        "Person 0",
+        "Person 1",
+    ]
+    assert slack.info_calls == ["U0", "U1"]
+    # a second batch doesn't start another warm
+    assert users.warm_in_background() is None
+    warming = users._warming
+    slack.hold.set()
+    warming.join(5)
+    assert users.name("U5") == "Person 5"
+    assert slack.info_calls == ["U0", "U1"]
+    assert slack.list_calls == 3
+
+
+def test_small_batches_dont_warm():
+    slack = FakeSlack(USERS)
+    users = directory(slack)
+    users.prepare_users(["U0", "U1"])
+    assert users._warming is None
+    assert slack.list_calls == 0
+
+
+def test_failed_warm_backs_off():
+    slack = FakeSlack(USERS)
+    slack.fail = True
+    users = directory(slack, warm_retry=60)
+    users.warm_in_background().join(5)
+    assert slack.list_calls == 1
+    assert users.warm_in_background() is None
+    users.clock.advance(60)
+    users.warm_in_background().join(5)
+    assert slack.list_calls == 2
+    # twice as long after a second failure
+    users.clock.advance(60)
+    assert users.warm_in_background() is None
+    users.clock.advance(60)
+    slack.fail = False
+    users.warm_in_background().join(5)
+    assert slack.list_calls == 5
+    # warmed, not again until the ttl is up
+    assert users.warm_in_background() is None
+    assert users.name("U3") == "Person 3"
+    assert slack.info_calls == []
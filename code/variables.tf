@@ -15,3 +15,39 @@ variable "default_region" {
   type        = string
   default     = "us-central1"
 }
+
+variable "pull_workers" {
+  description = "Leave the subscription as pull for a fleet running worker.py instead of pushing to cloud run."
+  type        = bool
+  default     = false
+}
+
+variable "split_ingress" {
+  description = "Run the slack facing ingress (Dockerfile.ingress) as its own service, the main service then only does the pubsub work."
+  type        = bool
+  default     = false
+}
+
+variable "ingress_min_instances" {
+  description = "Ingress instances kept warm so slack's 3 second ack window never waits on a cold start."
+  type        = number
+  default     = 1
+}
+
+variable "worker_concurrency" {
+  description = "Pubsub pushes one worker instance takes at once when split, matches the gunicorn threads in Dockerfile."
+  type        = number
+  default     = 8
+}
+
+variable "thread_index_redis_url" {
+  description = "Redis (e.g. Memorystore) url the split ingress and worker share thread membership through. Left empty the ingress doesn't cache threads as not ours."
+  type        = string
+  default     = ""
+}
+
+variable "vpc_connector" {
+  description = "Serverless VPC access connector the split services reach thread_index_redis_url through, if it's on a private network."
+  type        = string
+  default     = ""
+}